@@ -14,6 +14,10 @@ import tqdm
 import numpy as np
 from datetime import datetime
 
+# frame manifest of the image folders (helper/frame_manifest.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helper'))
+from frame_manifest import FrameManifest
+
 DATE = '20220718'
 MONKEY = 'Gandalf'
 
@@ -142,23 +146,15 @@ def img_to_vid():
 		#     specified_folder = image_folder[0]
 
 		specified_folder_path_list = []
-		images_cam0_list = []
-		images_cam1_list = []
-		# images_cam2_list = []
+		manifest_list = []
 		for specified_folder in image_folder:
 				print('Specified session: {}'.format(specified_folder))
 				specified_folder_path = os.path.join(IMAGES_FOLDER, specified_folder)
 				specified_folder_path_list.append(specified_folder_path)
-				print('  total images:', len(os.listdir(specified_folder_path)))
-				images_cam0 = [img for img in os.listdir(specified_folder_path) if img.endswith("cam0.jpg")]
-				images_cam0_list.append(images_cam0)
-				images_cam1 = [img for img in os.listdir(specified_folder_path) if img.endswith("cam1.jpg")]
-				images_cam1_list.append(images_cam1)
-				images_cam2 = [img for img in os.listdir(specified_folder_path) if img.endswith("cam2.jpg")]
-				# images_cam2_list.append(images_cam2)
-				print('    images (cam0 only):', len(images_cam1))
-				print('    images (cam1 only):', len(images_cam1))
-				# print('    images (cam2 only):', len(images_cam2))
+				# single scan of the folder (cached alongside the images)
+				manifest = FrameManifest.load(specified_folder_path)
+				manifest_list.append(manifest)
+				manifest.report()
 
 		# Frames timestamp data
 		min_dist_timestamp_list_t0_start = []
@@ -210,8 +206,7 @@ def img_to_vid():
 		frame_timestamp_start = min_dist_timestamp_list_t1_start[session_index]
 		frame_timestamp_end = min_dist_timestamp_list_t1_end[session_index]
 		frame_datetimes = timestamp_image_file_t1_list[session_index]
-		images_cam0 = images_cam0_list[session_index]
-		images_cam1 = images_cam1_list[session_index]
+		manifest = manifest_list[session_index]
 
 		frame_index_start = 0
 		frame_index_end = 0
@@ -237,37 +232,16 @@ def img_to_vid():
 		print('\nGenerating VIDEO file')
 
 		# Parse specified timestamps and recreate video
-		images_cam_list = [images_cam0, images_cam1]
 		for c_index, cam in enumerate(['cam0', 'cam1']):
 				print('\n  {}'.format(cam))
-				images_cam = images_cam_list[c_index]
 				video_name = DATE + '_' + MONKEY + '_trial_' + trial_number_str + '_' + cam + '.mp4'
-				frame = cv2.imread(os.path.join(session_closest_timestamp, images_cam[0]))
+				frame = cv2.imread(os.path.join(session_closest_timestamp, manifest.images(c_index)['filename'].iloc[0]))
 				height, width, layers = frame.shape
 
 				print('    HxWxL: {}x{}x{}'.format(height, width, layers))
 
-				image_order = []
-				for i_index, image in enumerate(images_cam):
-						num_frame = list(image.split('_'))[1] # check file format to make sure (i.e. Gandalf_XXXX_cam0.jpg)
-						image_order.append(int(num_frame))
-
-				zipped_list = zip(image_order, images_cam)
-				sort_image_order = sorted(zipped_list)
-				sorted_image_num = [element for element, _ in sort_image_order]
-				sorted_image_order = [element for _, element in sort_image_order]
-
-				correct_num_frames = np.arange(len(images_cam))
-				# print(set(sorted_image_num) ^ set(correct_num_frames))
-
-				selected_images = []
-				# only adds specified images (by frame number) and eliminates duplicates
-				for i_index, image in enumerate(sorted_image_order):
-						filename_num = int(image.split('_')[1])
-						if (filename_num >= frame_index_start) and \
-										(filename_num <= frame_index_end) and \
-										(image not in selected_images):
-								selected_images.append(image)
+				# images of frames frame_index_start to frame_index_end (one per frame number)
+				selected_images = manifest.frames(c_index, frame_index_start, frame_index_end)
 
 				#selected_images = selected_images[1:]
 
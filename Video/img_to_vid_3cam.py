@@ -10,10 +10,15 @@
 import sys
 import cv2
 import os
+import time
 import tqdm
 import numpy as np
 from datetime import datetime
 
+# frame manifest of the image folders (helper/frame_manifest.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helper'))
+from frame_manifest import FrameManifest, read_frames
+
 DATE = '20220902'
 MONKEY = 'Aragorn'
 
@@ -142,24 +147,16 @@ def img_to_vid(trial_number_str):
 				print('Image Files Found: {}'.format(image_folder))
 
 		specified_folder_path_list = []
-		images_cam0_list = []
-		images_cam1_list = []
-		images_cam2_list = []
+		manifest_list = []
 		for specified_folder in image_folder:
 				print('Specified session: {}'.format(specified_folder))
 				specified_folder_path = os.path.join(IMAGES_FOLDER, specified_folder)
 				specified_folder_path_list.append(specified_folder_path)
-				print('  total images:', len(os.listdir(specified_folder_path)))
-				images_cam0 = [img for img in os.listdir(specified_folder_path) if img.endswith("cam0.jpg")]
-				images_cam0_list.append(images_cam0)
-				images_cam1 = [img for img in os.listdir(specified_folder_path) if img.endswith("cam1.jpg")]
-				images_cam1_list.append(images_cam1)
-				images_cam2 = [img for img in os.listdir(specified_folder_path) if img.endswith("cam2.jpg")]
-				images_cam2_list.append(images_cam2)
-				print('    images (cam0 only):', len(images_cam1))
-				print('    images (cam1 only):', len(images_cam1))
-				print('    images (cam2 only):', len(images_cam2))
-		images_cam_list = [images_cam0_list, images_cam1_list, images_cam2_list]
+				# single scan of the folder (cached alongside the images)
+				manifest = FrameManifest.load(specified_folder_path)
+				manifest_list.append(manifest)
+				manifest.report()
+
 		# Frames timestamp data
 		min_dist_timestamp_list_t0_start = []
 		min_dist_timestamp_list_t0_end = []
@@ -235,7 +232,7 @@ def img_to_vid(trial_number_str):
 			frame_timestamp_start = min_dist_timestamp_list_cam_start[session_index]
 			frame_timestamp_end = min_dist_timestamp_list_end[cam_index][session_index]
 			frame_datetimes = timestamp_image_file_cam_list[cam_index][session_index]
-			images_cam = images_cam_list[cam_index][session_index]
+			manifest = manifest_list[session_index]
 
 			frame_index_start = 0
 			frame_index_end = 0
@@ -262,32 +259,13 @@ def img_to_vid(trial_number_str):
 			# Parse specified timestamps and recreate video
 			print('\n  {}'.format(cam_names[cam_index]))
 			video_name = DATE + '_' + MONKEY + '_trial_' + trial_number_str + '_' + cam_names[cam_index] + '.mp4'
-			frame = cv2.imread(os.path.join(session_closest_timestamp, images_cam[0]))
+			frame = cv2.imread(os.path.join(session_closest_timestamp, manifest.images(cam_index)['filename'].iloc[0]))
 			height, width, layers = frame.shape
 
 			print('    HxWxL: {}x{}x{}'.format(height, width, layers))
 
-			image_order = []
-			for i_index, image in enumerate(images_cam):
-					num_frame = list(image.split('_'))[1] # check file format to make sure (i.e. Gandalf_XXXX_cam0.jpg)
-					image_order.append(int(num_frame))
-
-			zipped_list = zip(image_order, images_cam)
-			sort_image_order = sorted(zipped_list)
-			sorted_image_num = [element for element, _ in sort_image_order]
-			sorted_image_order = [element for _, element in sort_image_order]
-
-			correct_num_frames = np.arange(len(images_cam))
-			# print(set(sorted_image_num) ^ set(correct_num_frames))
-
-			selected_images = []
-			# only adds specified images (by frame number) and eliminates duplicates
-			for i_index, image in enumerate(sorted_image_order):
-					filename_num = int(image.split('_')[1])
-					if (filename_num >= frame_index_start) and \
-									(filename_num <= frame_index_end) and \
-									(image not in selected_images):
-							selected_images.append(image)
+			# images of frames frame_index_start to frame_index_end (one per frame number)
+			selected_images = manifest.frames(cam_index, frame_index_start, frame_index_end)
 
 			print('    Number of frames: {}'.format(len(selected_images)))
 
@@ -298,10 +276,14 @@ def img_to_vid(trial_number_str):
 			fourcc = cv2.VideoWriter_fourcc('m','p','4','v')
 			video = cv2.VideoWriter(video_save_path, fourcc, frame_rate, (width,height))
 			video_path = session_closest_timestamp
-			for image in tqdm.tqdm(selected_images):
-					video.write(cv2.imread(os.path.join(session_closest_timestamp, image)))
+			# frames are decoded ahead (thread pool) while the writer encodes
+			encode_start = time.perf_counter()
+			for frame in tqdm.tqdm(read_frames(session_closest_timestamp, selected_images), total=len(selected_images)):
+					video.write(frame)
+			encode_time = time.perf_counter() - encode_start
 
 			print('    VIDEO complete.') 
+			print('    Throughput: {:.1f} frames/sec'.format(len(selected_images)/encode_time))
 			print('    Path: {}'.format(VIDEO_SAVE_PATH))
 			print('    Video name: {}'.format(video_name))
 			cv2.destroyAllWindows()
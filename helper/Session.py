@@ -5,6 +5,10 @@ import matplotlib as mpl
 from collections import defaultdict
 from datetime import datetime, timedelta
 
+from running_stats import SessionStats
+from add_fields import behavior_totals
+from profiling import profiled
+
 #COLORS = ['#905C99', '#907F9F', '#B0C7BD', '#B8EBD0']
 
 def colorFader(c1,c2,mix=0): #fade (linear interpolate) from color c1 (at mix=0) to c2 (mix=1)
@@ -13,11 +17,13 @@ def colorFader(c1,c2,mix=0): #fade (linear interpolate) from color c1 (at mix=0)
 	return mpl.colors.to_hex((1-mix)*c1 + mix*c2)
 
 class Session:
+	@profiled('Session')
 	def __init__(self, df, monkey_input, task, behavioral_code_dict):
 		print(' Creating Session Objects...')
 		self.df = df
 		self.monkey = monkey_input
 		self.task = task
+		self.features = None						# lazily computed fields (see feature_engine.FeatureSet)
 		self.window_lick = 750
 		self.window_blink = 1000
 		self.colors = []
@@ -37,6 +43,7 @@ class Session:
 		self.lick_duration = defaultdict(float)
 		self.blink_duration = defaultdict(float)
 		self.blink_signal = defaultdict(float)
+		self.stats = None								# running session metrics (see running_stats.SessionStats)
 		self.task_path = ''
 		self.figure_path = ''
 		self.tracker_path = ''
@@ -45,9 +52,50 @@ class Session:
 		self.generate_colors()
 		self.calculate_datetime()
 		self.find_offscreen_values()
+		self.accumulate_stats(behavioral_code_dict)
 		self.find_outcome_parameters()
 		self.behavior_summary(behavioral_code_dict)
 	
+	@property
+	def window_lick(self):
+		return self._window_lick
+
+	@window_lick.setter
+	def window_lick(self, window_lick):
+		self._window_lick = window_lick
+		self.invalidate_features('window_lick')
+
+	@property
+	def window_blink(self):
+		return self._window_blink
+
+	@window_blink.setter
+	def window_blink(self, window_blink):
+		self._window_blink = window_blink
+		self.invalidate_features('window_blink')
+
+	@property
+	def blink_signal(self):
+		return self._blink_signal
+
+	@blink_signal.setter
+	def blink_signal(self, blink_signal):
+		# (assign a new dict, changing it in place does not invalidate the features)
+		self._blink_signal = blink_signal
+		self.invalidate_features('blink_signal')
+
+	def invalidate_features(self, param):
+		"""
+		Recomputes the session_df columns that use param (see feature_engine.FeatureSet)
+		and the lick/blink measures and totals computed from them
+		"""
+		if self.features is None:
+			return
+		if self.features.invalidate(param):
+			self.stats.reset_behavior()
+			self.stats.update_behavior(self.features.df)
+			behavior_totals(self)
+
 	def parse_stim_labels(self):
 		unique_fractals = self.df['stimuli_name'].unique()
 		self.stim_labels = sorted([fractal.split('_')[-1] for fractal in unique_fractals])
@@ -107,52 +155,42 @@ class Session:
 		self.blink_signal['eye_x_max'] = eye_x_max
 		self.blink_signal['eye_y_max'] = eye_y_max
 
+	def accumulate_stats(self, behavioral_code_dict):
+		"""
+		Summarizes the trials in a single pass (running_stats.SessionStats).
+		More trials (i.e. a live session) can be added with update_stats.
+		"""
+		cs_on_codes = [index for index in behavioral_code_dict.keys() if behavioral_code_dict[index] == 'CS On']
+		self.stats = SessionStats(cs_on_codes[0] if cs_on_codes else None)
+		self.stats.update_trials(self.df)
+
+	def update_stats(self, df):
+		"""Adds new trials of the session to the running session metrics"""
+		self.stats.update_trials(df)
+		self.find_outcome_parameters()
+		self.prop_trials_initiated = round(self.stats.prop_trials_initiated(), 2)
+		self.CS_on_trials = self.stats.cs_on_trials
+		self.prop_correct_CS_on = round(self.stats.prop_correct_CS_on(), 2)
+
 	def find_outcome_parameters(self):
-		df = self.df.copy()
-		df = df[df['correct'] == 1]
-		reward_mag_list = []
-		reward_freq_list = []
-		reward_length_list = []		
-		reward_mag = df['reward_mag'].unique()
-		for reward_outcome in reward_mag:
-			if reward_outcome == 0:
-				continue
-			df_reward = df[df['reward_mag'] == reward_outcome]
-			reward_mag_list.append(np.mean(df_reward['reward_drops']))
-			reward_length_list.append(np.mean(df_reward['reward_length']))
-			reward_freq_list.append(np.mean(df_reward['reward_prob']))
-		airpuff_mag_list = []
-		airpuff_freq_list = []				
-		airpuff_mag = df['airpuff_mag'].unique()
-		for airpuff_outcome in airpuff_mag:
-			if airpuff_outcome == 0:
-				continue
-			df_airpuff = df[df['airpuff_mag'] == airpuff_outcome]
-			airpuff_mag_list.append(np.mean(df_airpuff['airpuff_pulses']))
-			airpuff_freq_list.append(np.mean(df_airpuff['airpuff_prob']))
-		self.reward_outcome_params['reward_drops'] = sorted(reward_mag_list, reverse=True)
-		self.reward_outcome_params['reward_freq'] = sorted(reward_freq_list, reverse=True)
-		self.reward_outcome_params['reward_length'] = sorted(reward_length_list, reverse=True)
-		self.airpuff_outcome_params['airpuff_pulses'] = sorted(airpuff_mag_list, reverse=True)
-		self.airpuff_outcome_params['airpuff_freq'] = sorted(airpuff_freq_list, reverse=True)
+		reward_outcome_params, airpuff_outcome_params = self.stats.outcome_params()
+		self.reward_outcome_params['reward_drops'] = reward_outcome_params['reward_drops']
+		self.reward_outcome_params['reward_freq'] = reward_outcome_params['reward_prob']
+		self.reward_outcome_params['reward_length'] = reward_outcome_params['reward_length']
+		self.airpuff_outcome_params['airpuff_pulses'] = airpuff_outcome_params['airpuff_pulses']
+		self.airpuff_outcome_params['airpuff_freq'] = airpuff_outcome_params['airpuff_prob']
 
 	def behavior_summary(self, behavioral_code_dict):
-		df = self.df
-		OUTCOME_SELECTED = [0,9]
+		stats = self.stats
 		# attempts per min
 		session_time = self.session_time
 		session_time_min = session_time*60
-		total_attempts_min = round(len(df)/session_time_min, 2)
+		total_attempts_min = round(stats.num_trials/session_time_min, 2)
 		self.total_attempts_min = total_attempts_min
-		# total initiated trials
-		df_choice = df.loc[df['error_type'].isin(OUTCOME_SELECTED)]
-		prop_trials_initiated = round(len(df_choice)/len(df), 2)
+		# total initiated trials (error_type in running_stats.OUTCOME_SELECTED)
+		prop_trials_initiated = round(stats.prop_trials_initiated(), 2)
 		self.prop_trials_initiated = prop_trials_initiated
 		# total correct trials after CS presented
-		cs_on_index = [index for index in behavioral_code_dict.keys() if behavioral_code_dict[index] == 'CS On'][0]
-		session_df_CS_presented = df[df['behavioral_code_markers'].apply(lambda x: cs_on_index in x)]
-		self.CS_on_trials = len(session_df_CS_presented)
-		CS_on_correct = session_df_CS_presented['correct'].tolist()
-		perf_CS_on = np.sum(CS_on_correct)/len(CS_on_correct)
-		perf_CS_on_round = round(perf_CS_on, 2)
+		self.CS_on_trials = stats.cs_on_trials
+		perf_CS_on_round = round(stats.prop_correct_CS_on(), 2)
 		self.prop_correct_CS_on = perf_CS_on_round
\ No newline at end of file
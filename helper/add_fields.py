@@ -5,6 +5,19 @@ from textwrap import indent
 from pprint import pprint, pformat
 from collections import defaultdict, OrderedDict
 
+from ragged import RaggedArray
+from feature_engine import FeatureSet
+from profiling import stage, profiled
+
+RASTER_COLUMNS = ['lick_raster', 'blink_raster', 'trial_bins']
+WINDOW_COLUMNS = ['lick_count_window', 'blink_count_window', 'pupil_data_window',
+									'pupil_raster_window', 'pupil_raster_window_avg', 'pupil_binary_zero',
+									'pupil_pre_CS', 'lick_in_window', 'blink_in_window', 'lick_duration',
+									'blink_duration_sig', 'blink_duration_offscreen', 'eye_distance',
+									'eye_offscreen_fraction']
+# columns trial_in_block, fractal_in_block and outcome_back_counter read from previous trials
+SEQUENCE_COLUMNS = ['block', 'stimuli_name', 'correct', 'reward', 'airpuff']
+
 def add_epoch_times(df, behavioral_code_dict):
 	"""
 	Adds columns for each epoch time start to session_df
@@ -17,26 +30,40 @@ def add_epoch_times(df, behavioral_code_dict):
 		df: session DataFrame now including marker time for each behavioral code
 	"""
 
-	behavioral_code_indices = list(behavioral_code_dict.keys())
+	behavioral_code_indices = np.array(list(behavioral_code_dict.keys()), dtype=np.int64)
 	behavioral_code_names = list(behavioral_code_dict.values())
-
-	epoch_dict = defaultdict(list)
-	for t_index in range(len(df)):
-		markers = df['behavioral_code_markers'].iloc[t_index]
-		times = df['behavioral_code_times'].iloc[t_index]
-
-		for k_index, key in enumerate(behavioral_code_indices):
-			epoch_name = behavioral_code_names[k_index]
-			try:
-				epoch_marker = markers.index(key)
-				epoch_dict[epoch_name].append(int(times[epoch_marker]))
-			except:
-				epoch_dict[epoch_name].append(np.nan)
-
-	for k_index, key in enumerate(epoch_dict.keys()):
-		if key != 'Not assigned':
-			df[key] = list(epoch_dict.values())[k_index]
-			df[key] = df[key].astype('Int32')
+	num_trials = len(df)
+	num_codes = len(behavioral_code_indices)
+	if num_codes == 0:
+		return df
+
+	# flatten markers/times into one long table of (trial, code, time)
+	markers = RaggedArray.from_column(df['behavioral_code_markers'], dtype=np.int64)
+	times = RaggedArray.from_column(df['behavioral_code_times'])
+	trial_ids = markers.trial_ids()
+	marker_codes = markers.buffer[markers.offsets[0]:markers.offsets[-1]]
+	marker_times = times.buffer[times.offsets[0]:times.offsets[-1]]
+
+	# keep only the markers that are in behavioral_code_dict
+	code_order = np.argsort(behavioral_code_indices, kind='stable')
+	sorted_codes = behavioral_code_indices[code_order]
+	code_position = np.clip(np.searchsorted(sorted_codes, marker_codes), 0, num_codes-1)
+	known = sorted_codes[code_position] == marker_codes
+	code_ids = code_order[code_position[known]]
+
+	# first occurrence of each code in each trial (np.unique keeps the first index)
+	trial_code_key = trial_ids[known] * num_codes + code_ids
+	trial_code_key, first_index = np.unique(trial_code_key, return_index=True)
+	epoch_times = np.full(num_trials * num_codes, np.nan)
+	epoch_times[trial_code_key] = np.trunc(marker_times[known][first_index])
+	epoch_times = epoch_times.reshape(num_trials, num_codes)
+
+	epoch_columns = {}
+	for k_index, epoch_name in enumerate(behavioral_code_names):
+		if epoch_name != 'Not assigned' and epoch_name not in epoch_columns:
+			epoch_columns[epoch_name] = pd.array(epoch_times[:, k_index], dtype='Int32')
+	for epoch_name, epoch_column in epoch_columns.items():
+		df[epoch_name] = epoch_column
 	return df
 
 def valence_assignment(row):
@@ -65,88 +92,6 @@ def valence_assignment(row):
 			valence = 0.5
 	return valence
 
-def trace_to_raster(trace_data, threshold):
-	"""
-	trace_to_raster converts the lick data to a binary
-	probability of licking
-
-	Args:
-		trace_data: raw lick trace data from MonkeyLogic
-		threshold: manual threshold placed to count a lick (default: 1)
-			
-	Returns:
-		raster_data: rasterized data for each ms window
-	"""
-
-	raster_data = []
-	for l_index, trace_bin in enumerate(trace_data):
-		if trace_bin >= threshold or trace_bin <= (-1*threshold):
-			#raster_dict[l_index].append(1)
-			raster_data.append(1)
-		else:
-			#raster_dict[l_index].append(0)
-			raster_data.append(0)
-	return raster_data
-
-def lick_window(trial):
-	"""
-	Generates an array for each trial of rasterized lick data
-			
-		Args:
-			trial: row in session_df DataFrame
-			
-		Returns:
-			lick_raster: rasterized lick data for each ms window
-	"""
-	
-	LICK_THRESHOLD = 4
-	lick_data = trial['lick'].tolist()
-	lick_raster = trace_to_raster(lick_data, LICK_THRESHOLD)
-	#lick_window_list = lick_dict.values()
-	#lick_window_list_flat = [item for sublist in lick_window_list for item in sublist]
-	#lick_mean = np.mean(lick_window_list_flat)
-	return lick_raster
-
-def blink_window(trial):
-	"""
-	Generates an array for each trial of rasterized blink data
-			
-		Args:
-			trial: row in session_df DataFrame
-			
-		Returns:
-			blink_raster: rasterized blink data for each ms window
-	"""
-
-	# EyeLink (x,y) values for eyes offscreen
-	BLINK_SIGNAL = 10
-
-	eye_x = trial['eye_x'].tolist()
-	eye_y = trial['eye_y'].tolist()
-
-	eye_x_abs = [abs(x) for x in eye_x]
-	eye_y_abs = [abs(y) for y in eye_y]
-
-	eye_zipped = list(map(max, zip(eye_x_abs, eye_y_abs)))
-	blink_raster = trace_to_raster(eye_zipped, BLINK_SIGNAL)
-
-	return blink_raster
-
-def trial_bins(trial):
-	"""
-	Uses the number of samples of eye data as a proxy for
-	the trial bins
-			
-		Args:
-			trial: row in session_df DataFrame
-			
-		Returns:
-			trial_length: number of samples of eye_x data
-	"""
-
-	trial_length = len(trial['eye_x'].tolist())
-	return trial_length
-
 def trial_in_block(df):
 	"""
 	Counts the trial number in a block
@@ -208,158 +153,18 @@ def outcome_back_counter(df):
 	df['airpuff_5_back'] = df['airpuff_4_back'].tolist() + df.airpuff.shift(5)
 	return df
 
-def outcome_count_window(trial, session_obj):
-	"""
-	Generates new columns counting lick, blink, and pupil data for each trial
-			
-		Args:
-			trial: row in session_df DataFrame
-			session_obj: Session object
-			
-		Returns:
-			trial: row in session_df DataFrame with new columns
-				- lick_count_window: rasterized lick data for lick window
-				- blink_count_window: rasterized lick data for blink window
-				- pupil_data_window: raw pupil data for blink window
-				- pupil_raster_window: rasterized pupil data for blink window
-				- pupil_zero_count: binary 1 if pupil is 0 for any timepoint in blink window
-	"""
-	TRACE_WINDOW_LICK = session_obj.window_lick
-	TRACE_WINDOW_BLINK = session_obj.window_blink
-	lick_raster = trial['lick_raster']
-	eye_raster = trial['blink_raster']
-	pupil_data = trial['eye_pupil']
-	trace_off_time = trial['Trace End']
-	try:
-		lick_data_window = lick_raster[trace_off_time-TRACE_WINDOW_LICK:trace_off_time]
-		blink_data_window = eye_raster[trace_off_time-TRACE_WINDOW_BLINK:trace_off_time]
-		pupil_data_window = pupil_data[trace_off_time-TRACE_WINDOW_BLINK:trace_off_time]
-		blink_raster = [1 if x == 0 else 0 for x in pupil_data_window]
-		blink_count = 1 if 1 in blink_raster else 0	
-	except: # error before 'Trace End'
-		lick_data_window = np.nan
-		blink_data_window = np.nan	
-		pupil_data_window = np.nan	
-		blink_raster = np.nan	
-		blink_count = np.nan
-	trial['lick_count_window'] = lick_data_window
-	trial['blink_count_window'] = blink_data_window
-	trial['pupil_data_window'] = pupil_data_window
-	trial['pupil_raster_window'] = blink_raster
-	trial['pupil_raster_window_avg'] = np.mean(blink_raster)
-	trial['pupil_binary_zero'] = blink_count
-	return trial
-
-def pupil_pre_CS(trial):
-	"""
-	Generates an array for each trial of pupil data
-			
-		Args:
-			trial: row in session_df DataFrame
-			
-		Returns:
-			pupil_data_window: pupil data for 200ms before CS On
-	"""
-	pupil_data = trial['eye_pupil']
-	cs_on_time = trial['CS On']
-	try:
-		pupil_data_window = pupil_data[cs_on_time-200:cs_on_time]
-	except: # error before 'CS On'
-		pupil_data_window = np.nan	
-	return pupil_data_window
-
-def lick_in_window(trial):
-	lick_count_window = trial['lick_count_window']
-	if type(lick_count_window) == float: # np.nan
-		return np.nan
-	elif 1 in lick_count_window:
-		return 1
-	else:
-		return 0
-
-def blink_in_window(trial):
-	blink_count_window = trial['blink_count_window']
-	if type(blink_count_window) == float: # np.nan
-		return np.nan
-	elif 1 in blink_count_window:
-		return 1
-	else:
-		return 0
-
-def lick_duration(trial, trace_window):
-
-	lick_vals = trial['lick']
-	trace_off_time = trial['Trace End']
-	try:
-		lick_window = lick_vals[trace_off_time-trace_window:trace_off_time]
-		lick_avg = np.nanmean(lick_window)
-	except:
-		lick_avg = np.nan
-	return lick_avg  
-
-def blink_duration_sig(trial, trace_window, blink_signal):
-
-	eye_x, eye_y = trial['eye_x'], trial['eye_y']
-	trace_off_time = trial['Trace End']
-	try:
-		eye_x_window = eye_x[trace_off_time-trace_window:trace_off_time]
-		eye_y_window = eye_y[trace_off_time-trace_window:trace_off_time]
-		blink_count = [1 if (x,y) in blink_signal else 0 for (x,y) in zip(eye_x_window, eye_y_window)]
-		blink_avg = np.nanmean(blink_count)
-	except:
-		blink_avg = np.nan
-	return blink_avg  
-
-def blink_duration_offscreen(trial, trace_window):
-
-	blink_count_window = trial['blink_count_window']
-	if type(blink_count_window) == float: # np.nan
-		blink_avg = np.nan
-	else:
-		blink_avg = np.nanmean(blink_count_window)
-	return blink_avg
-
-def eye_distance(trial, session_obj):
-	"""
-	Calculates the total distance that the animal's eyes traveled 
-	during the trial
-
-	Args:
-		trial: row in session_df DataFrame
-		session_obj: session object
-
-	Returns:
-		eye_distance: total distance that the animal's eyes traveled
-			during the trial
-	"""
-	trace_window = session_obj.window_blink
-	blink_signal = session_obj.blink_signal
-	trace_off_time = trial['Trace End']
-	try:
-		eye_x_window = list(trial['eye_x'][trace_off_time-trace_window:trace_off_time])
-		eye_y_window = list(trial['eye_y'][trace_off_time-trace_window:trace_off_time])
-		blink_signal_list = []
-		for bin, (x,y) in enumerate(zip(eye_x_window, eye_y_window)):
-			if x in blink_signal.values() and y in blink_signal.values():
-				blink_signal_list.append(bin)
-		# remove offscreen eye data (variable signal each day)
-		for index in sorted(blink_signal_list, reverse=True):
-				del eye_x_window[index]
-				del eye_y_window[index]
-		dx = np.diff(eye_x_window)
-		dy = np.diff(eye_y_window)
-		step_size = np.sqrt(dx**2+dy**2)
-		cumulative_distance = np.sum(step_size)
-	except:
-		cumulative_distance = np.nan # trial error before 'Trace End'
-	return cumulative_distance
-
 def prelim_behavior_analysis(df, session_obj, behavioral_code_dict):
+	# running lick/blink measures (per valence, fractal and block, see running_stats.SessionStats)
+	session_obj.stats.reset_behavior()
+	session_obj.stats.update_behavior(df)
+	return behavior_totals(session_obj)
+
+def behavior_totals(session_obj):
 	# total lick rate
-	lick_dur_all = round(np.mean(df[df['correct']==1]['lick_duration'].tolist())/5, 3)
+	lick_dur_all = round(session_obj.stats.behavior_all['lick_duration'].mean_or_nan()/5, 3)
 	session_obj.lick_duration['all'] = lick_dur_all
 	# total blink rate
-	avg_blink_all = round(np.mean(df[df['correct']==1]['blink_duration_offscreen'].tolist()), 3)
+	avg_blink_all = round(session_obj.stats.behavior_all['blink_duration_offscreen'].mean_or_nan(), 3)
 	session_obj.blink_duration['all'] = avg_blink_all
 	return session_obj
 
@@ -388,46 +193,120 @@ def parse_valence_labels(df, session_obj):
 			session_obj.valence_labels[valence] = '(+)(+)'
 	return session_obj
 
-def add_fields(df, session_obj, behavioral_code_dict):
-	print(' Adding additional fields to session_df DataFrame...')
+@profiled()
+def add_fields(df, session_obj, behavioral_code_dict, columns=None):
+	"""
+	Adds derived fields to session_df
+
+	Args:
+		df: session_df DataFrame
+		session_obj: Session object
+		behavioral_code_dict: dictionary of all MonkeyLogic code mappings
+		columns: derived (feature_engine) columns to add (default: all). The
+			rest can be added later with session_obj.features.require(columns)
 
-	TRACE_WINDOW_LICK = session_obj.window_lick
-	TRACE_WINDOW_BLINK = session_obj.window_blink
-	eye_blink_signal = session_obj.blink_signal
-	BLINK_SIGNAL = [(eye_blink_signal['eye_x_min'], eye_blink_signal['eye_y_min']),
-									(eye_blink_signal['eye_x_max'], eye_blink_signal['eye_y_max'])]
-
-	df = add_epoch_times(df, behavioral_code_dict)
-	df['valence'] = df.apply(valence_assignment, axis=1)
-	df['lick_raster'] = df.apply(lick_window, axis=1)
-	df['blink_raster'] = df.apply(blink_window, axis=1)
-	df['trial_bins'] = df.apply(trial_bins, axis=1)
-	df['trial_in_block'] = trial_in_block(df)
-	df['fractal_count_in_block'] = fractal_in_block(df)
-	df = outcome_back_counter(df)
-	df = df.apply(outcome_count_window,
-								session_obj=session_obj, 
-								axis=1)
-	df['pupil_pre_CS'] = df.apply(pupil_pre_CS, axis=1)
-	df['lick_in_window'] = df.apply(lick_in_window, axis=1)
-	df['blink_in_window'] = df.apply(blink_in_window, axis=1)
-	df['lick_duration'] = df.apply(lick_duration, 
-																	trace_window=TRACE_WINDOW_LICK, 
-																	axis=1)	
-	df['blink_duration_sig'] = df.apply(blink_duration_sig, 
-																	trace_window=TRACE_WINDOW_BLINK,
-																	blink_signal=BLINK_SIGNAL, 
-																	axis=1)
-	df['blink_duration_offscreen'] = df.apply(blink_duration_offscreen, 
-																	trace_window=TRACE_WINDOW_BLINK, 
-																	axis=1)
-	df['eye_distance'] = df.apply(eye_distance, 
-																session_obj=session_obj, 
-																axis=1)
-	print('  {} new fields added.'.format(20))
-
-	session_obj = prelim_behavior_analysis(df, session_obj, behavioral_code_dict)
+	Returns:
+		df: session_df DataFrame with new fields
+		session_obj: Session object (session_obj.features caches the derived fields)
+	"""
+	print(' Adding additional fields to session_df DataFrame...')
+	num_columns = len(df.columns)
+	if columns is None:
+		columns = RASTER_COLUMNS + WINDOW_COLUMNS
+	# always needed for prelim_behavior_analysis
+	columns = set(columns) | {'lick_duration', 'blink_duration_offscreen'}
+
+	num_trials = len(df)
+	with stage('add_epoch_times', num_trials):
+		df = add_epoch_times(df, behavioral_code_dict)
+	with stage('valence_assignment', num_trials):
+		df['valence'] = df.apply(valence_assignment, axis=1)
+	# rasters, trial bins and trace window columns are computed on demand
+	session_obj.features = FeatureSet(df, session_obj)
+	with stage('raster_columns', num_trials):
+		df = session_obj.features.require([column for column in RASTER_COLUMNS if column in columns])
+	with stage('sequence_fields', num_trials):
+		df['trial_in_block'] = trial_in_block(df)
+		df['fractal_count_in_block'] = fractal_in_block(df)
+		df = outcome_back_counter(df)
+	with stage('window_columns', num_trials):
+		df = session_obj.features.require([column for column in WINDOW_COLUMNS if column in columns])
+	print('  {} new fields added.'.format(len(df.columns) - num_columns))
+
+	with stage('prelim_behavior_analysis', num_trials):
+		session_obj = prelim_behavior_analysis(df, session_obj, behavioral_code_dict)
 	session_obj = parse_valence_labels(df, session_obj)
 	print(indent(pformat(df.columns), '  '))
 
 	return df, session_obj
+
+def sequence_fields(batch_df, history):
+	"""
+	Adds trial_in_block, fractal_count_in_block and the outcome back
+	counters to a batch of trials, continuing from the previous trials
+
+	Args:
+		batch_df: session_df rows of the batch
+		history: SEQUENCE_COLUMNS of the previous trials (None for the first batch)
+
+	Returns:
+		batch_df: batch with the sequence fields
+		history: SEQUENCE_COLUMNS of the trials the next batch depends on
+	"""
+	context = batch_df[SEQUENCE_COLUMNS]
+	if history is not None:
+		context = pd.concat([history, context])
+	context = context.reset_index(drop=True)
+	context['trial_in_block'] = trial_in_block(context)
+	context['fractal_count_in_block'] = fractal_in_block(context)
+	context = outcome_back_counter(context)
+	for column in context.columns:
+		if column not in SEQUENCE_COLUMNS:
+			batch_df[column] = context[column].values[-len(batch_df):]
+	# the next batch only needs the current block and the last 5 outcomes
+	block_start = np.flatnonzero(context['trial_in_block'].values == 0)[-1]
+	history = context[SEQUENCE_COLUMNS].iloc[min(block_start, max(len(context)-5, 0)):]
+	return batch_df, history
+
+def iter_add_fields(batches, session_obj, behavioral_code_dict, columns=None):
+	"""
+	Adds derived fields to session_df one batch of trials at a time
+	(i.e. from session_store.iter_session), so that the whole session
+	never has to be in memory
+
+	Args:
+		batches: iterable of session_df batches (in trial order)
+		session_obj: Session object
+		behavioral_code_dict: dictionary of all MonkeyLogic code mappings
+		columns: derived (feature_engine) columns to add (default: all)
+
+	Yields:
+		batch_df: session_df batch with new fields (same fields as add_fields).
+			session_obj is updated (prelim_behavior_analysis, valence labels)
+			after the last batch.
+	"""
+	print(' Adding additional fields to session_df batches...')
+	if columns is None:
+		columns = RASTER_COLUMNS + WINDOW_COLUMNS
+	columns = set(columns) | {'lick_duration', 'blink_duration_offscreen'}
+
+	session_obj.stats.reset_behavior()
+	history = None
+	valences = set()
+	num_trials = 0
+	for batch_df in batches:
+		batch_df = add_epoch_times(batch_df, behavioral_code_dict)
+		batch_df['valence'] = batch_df.apply(valence_assignment, axis=1)
+		# derived fields only depend on the trial itself
+		features = FeatureSet(batch_df, session_obj)
+		batch_df = features.require([column for column in RASTER_COLUMNS if column in columns])
+		batch_df, history = sequence_fields(batch_df, history)
+		batch_df = features.require([column for column in WINDOW_COLUMNS if column in columns])
+		session_obj.stats.update_behavior(batch_df)
+		valences.update(batch_df['valence'].unique())
+		num_trials += len(batch_df)
+		yield batch_df
+	print('  {} trials processed.'.format(num_trials))
+
+	session_obj = behavior_totals(session_obj)
+	session_obj = parse_valence_labels(pd.DataFrame({'valence': sorted(valences)}), session_obj)
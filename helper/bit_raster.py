@@ -0,0 +1,261 @@
+import numpy as np
+
+# number of set bits in every byte value
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+WORD_BITS = 64
+
+class BitRaster:
+	'''
+	Binary (0/1) per-trial rasters (i.e. lick_raster, blink_raster) packed
+	8 samples per byte with np.packbits, with trial i spanning bits
+	offsets[i]:offsets[i+1]. Window queries (any/count/first) use a
+	prefix popcount over 64-bit words, so they never unpack the raster.
+
+	Args:
+		bits (np.ndarray): packed uint8 buffer (bitorder='little')
+		offsets (np.ndarray): int64 bit offsets (length = number of trials + 1)
+	'''
+	def __init__(self, bits, offsets):
+		self.bits = np.asarray(bits, dtype=np.uint8)
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self._word_counts = None
+
+	@classmethod
+	def from_ragged(cls, ragged):
+		'''Packs a 0/1 RaggedArray (see feature_engine.rasterize)'''
+		buffer = ragged.buffer[ragged.offsets[0]:ragged.offsets[-1]]
+		return cls(np.packbits(buffer != 0, bitorder='little'), ragged.offsets - ragged.offsets[0])
+
+	@classmethod
+	def from_arrays(cls, arrays):
+		'''Packs a list of per-trial 0/1 arrays (or RasterRows)'''
+		lengths = [len(array) for array in arrays]
+		offsets = np.zeros(len(arrays)+1, dtype=np.int64)
+		np.cumsum(lengths, out=offsets[1:])
+		buffer = np.concatenate([np.asarray(array, dtype=np.uint8) for array in arrays]) \
+			if len(arrays) else np.zeros(0, dtype=np.uint8)
+		return cls(np.packbits(buffer != 0, bitorder='little'), offsets)
+
+	@classmethod
+	def from_rows(cls, rows):
+		'''
+		Returns (raster, trials, starts, stops) for a list of RasterRows (i.e.
+		a session_df column), sharing the raster when all rows come from the
+		same one, so that rows can be queried together
+		'''
+		rows = list(rows)
+		if len(rows) and all(isinstance(row, RasterRow) for row in rows) and \
+				all(row.raster is rows[0].raster for row in rows):
+			raster = rows[0].raster
+			starts = np.array([row.start for row in rows], dtype=np.int64)
+			stops = np.array([row.stop for row in rows], dtype=np.int64)
+		else:
+			raster = cls.from_arrays(rows)
+			starts, stops = raster.starts, raster.stops
+		trials = np.searchsorted(raster.offsets, starts, side='right') - 1
+		return raster, trials, starts, stops
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, index):
+		return RasterRow(self, self.offsets[index], self.offsets[index+1])
+
+	def __repr__(self):
+		return 'BitRaster(trials={}, samples={}, bytes={})'.format(len(self), self.offsets[-1], self.nbytes)
+
+	@property
+	def lengths(self):
+		return np.diff(self.offsets)
+
+	@property
+	def starts(self):
+		return self.offsets[:-1]
+
+	@property
+	def stops(self):
+		return self.offsets[1:]
+
+	@property
+	def nbytes(self):
+		word_bytes = 0 if self._word_counts is None else self._word_counts.nbytes
+		return self.bits.nbytes + self.offsets.nbytes + word_bytes
+
+	def to_rows(self):
+		'''Object array of one RasterRow per trial (for DataFrame columns)'''
+		return self.window_rows(self.starts, self.stops)
+
+	def window_rows(self, starts, stops, valid=None):
+		'''Object array of RasterRows for absolute bit windows (np.nan where not valid)'''
+		rows = np.empty(len(starts), dtype=object)
+		for t_index in range(len(starts)):
+			if valid is None or valid[t_index]:
+				rows[t_index] = RasterRow(self, starts[t_index], stops[t_index])
+			else:
+				rows[t_index] = np.nan
+		return rows
+
+	def unpack(self, start, stop):
+		'''Unpacks the absolute bit range [start, stop) to a uint8 array'''
+		if stop <= start:
+			return np.zeros(0, dtype=np.uint8)
+		first_byte = start // 8
+		last_byte = (stop + 7) // 8
+		unpacked = np.unpackbits(self.bits[first_byte:last_byte], bitorder='little')
+		return unpacked[start-first_byte*8:stop-first_byte*8]
+
+	def word_counts(self):
+		'''Number of set bits before each 64-bit word (built on first use)'''
+		if self._word_counts is None:
+			num_words = (len(self.bits) + 7) // 8
+			padded = np.zeros(num_words*8, dtype=np.uint8)
+			padded[:len(self.bits)] = self.bits
+			counts = POPCOUNT_TABLE[padded].reshape(num_words, 8).sum(axis=1, dtype=np.int64)
+			self._word_counts = np.zeros(num_words+1, dtype=np.uint32)
+			np.cumsum(counts, out=self._word_counts[1:])
+		return self._word_counts
+
+	def word_bits(self, words):
+		'''Unpacks whole 64-bit words (one row of 64 bits per word)'''
+		byte_index = words[:, None] * 8 + np.arange(8)
+		in_range = byte_index < len(self.bits)
+		word_bytes = np.where(in_range, self.bits[np.minimum(byte_index, max(len(self.bits)-1, 0))], 0)
+		return np.unpackbits(word_bytes.astype(np.uint8), axis=1, bitorder='little')
+
+	def count_before(self, positions):
+		'''Number of set bits before each absolute bit position'''
+		positions = np.asarray(positions, dtype=np.int64)
+		words = positions // WORD_BITS
+		partial = positions % WORD_BITS
+		counts = self.word_counts()[words].astype(np.int64)
+		has_partial = partial > 0
+		if np.any(has_partial):
+			word_bits = self.word_bits(words[has_partial])
+			below = np.arange(WORD_BITS) < partial[has_partial][:, None]
+			counts[has_partial] += np.sum(word_bits * below, axis=1, dtype=np.int64)
+		return counts
+
+	def count_range(self, starts, stops):
+		'''Number of set bits in absolute bit windows [start, stop)'''
+		stops = np.maximum(starts, stops)
+		return self.count_before(stops) - self.count_before(starts)
+
+	def first_range(self, starts, stops):
+		'''Absolute position of the first set bit in [start, stop) (-1 if there is none)'''
+		starts = np.asarray(starts, dtype=np.int64)
+		stops = np.asarray(stops, dtype=np.int64)
+		rank = self.count_before(starts)
+		first = np.full(len(starts), -1, dtype=np.int64)
+		found = self.count_range(starts, stops) > 0
+		if np.any(found):
+			# select: the word holding the (rank+1)th set bit, then the bit inside it
+			word_counts = self.word_counts()
+			words = np.searchsorted(word_counts, rank[found], side='right') - 1
+			cumulative_bits = np.cumsum(self.word_bits(words), axis=1)
+			rank_in_word = rank[found] - word_counts[words].astype(np.int64)
+			bit = np.argmax(cumulative_bits > rank_in_word[:, None], axis=1)
+			first[found] = words * WORD_BITS + bit
+		return first
+
+	def bounds(self, starts, stops, trials=None):
+		'''Absolute bit windows of trial-relative [start, stop) (clipped to the trial)'''
+		trials = np.arange(len(self)) if trials is None else np.asarray(trials, dtype=np.int64)
+		lengths = self.lengths[trials]
+		starts = np.clip(np.asarray(starts, dtype=np.int64), 0, lengths)
+		stops = np.clip(np.asarray(stops, dtype=np.int64), starts, lengths)
+		return self.offsets[trials] + starts, self.offsets[trials] + stops
+
+	def count(self, starts, stops, trials=None):
+		'''Number of 1s in each trial window [start, stop) (one per trial by default)'''
+		return self.count_range(*self.bounds(starts, stops, trials))
+
+	def any(self, starts, stops, trials=None):
+		'''True if there is a 1 in the trial window [start, stop)'''
+		return self.count(starts, stops, trials) > 0
+
+	def first(self, starts, stops, trials=None):
+		'''Index (relative to the trial) of the first 1 in [start, stop), -1 if there is none'''
+		trials = np.arange(len(self)) if trials is None else np.asarray(trials, dtype=np.int64)
+		first = self.first_range(*self.bounds(starts, stops, trials))
+		return np.where(first >= 0, first - self.offsets[trials], -1)
+
+class RasterRow:
+	'''
+	Read-only view of a single trial (or window) of a BitRaster. Behaves
+	like the 0/1 list it replaces: len, slicing, `1 in row`, iteration and
+	np.asarray/np.mean all work, and slices are views, not copies.
+	'''
+	__slots__ = ['raster', 'start', 'stop']
+
+	def __init__(self, raster, start, stop):
+		self.raster = raster
+		self.start = int(start)
+		self.stop = int(stop)
+
+	def __len__(self):
+		return self.stop - self.start
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			start, stop, step = index.indices(len(self))
+			if step == 1:
+				return RasterRow(self.raster, self.start + start, self.start + max(start, stop))
+			return np.asarray(self)[index]
+		if index < 0:
+			index += len(self)
+		if index < 0 or index >= len(self):
+			raise IndexError('raster index out of range')
+		return int(self.raster.unpack(self.start + index, self.start + index + 1)[0])
+
+	def __array__(self, dtype=None):
+		array = self.raster.unpack(self.start, self.stop)
+		return array if dtype is None else array.astype(dtype)
+
+	def __iter__(self):
+		return iter(np.asarray(self).tolist())
+
+	def __contains__(self, value):
+		if value == 1:
+			return self.count() > 0
+		if value == 0:
+			return self.count() < len(self)
+		return False
+
+	def __repr__(self):
+		return 'RasterRow({})'.format(np.asarray(self))
+
+	def tolist(self):
+		return np.asarray(self).tolist()
+
+	def bounds(self, starts, stops):
+		starts = np.clip(np.asarray(starts, dtype=np.int64), 0, len(self))
+		stops = np.clip(np.asarray(stops, dtype=np.int64), starts, len(self))
+		return self.start + starts, self.start + stops
+
+	def count(self, starts=None, stops=None):
+		'''Number of 1s in the row, or in each [start, stop) window of the row'''
+		if starts is None:
+			return int(self.raster.count_range(np.array([self.start]), np.array([self.stop]))[0])
+		return self.raster.count_range(*self.bounds(starts, stops))
+
+	def any(self, starts=None, stops=None):
+		'''True if there is a 1 in the row, or in each [start, stop) window of the row'''
+		if starts is None:
+			return self.count() > 0
+		return self.count(starts, stops) > 0
+
+	def first(self, starts=None, stops=None):
+		'''Index of the first 1 in the row (or in each window), -1 if there is none'''
+		if starts is None:
+			starts, stops = np.array([0]), np.array([len(self)])
+			return int(self.first(starts, stops)[0])
+		first = self.raster.first_range(*self.bounds(starts, stops))
+		return np.where(first >= 0, first - self.start, -1)
+
+def window_any(rows):
+	'''
+	True for each RasterRow (i.e. a lick_count_window column) that
+	contains a 1, answered with one vectorized query
+	'''
+	raster, trials, starts, stops = BitRaster.from_rows(rows)
+	return raster.count_range(starts, stops) > 0
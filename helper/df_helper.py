@@ -7,6 +7,8 @@ from ipywidgets import interact, IntSlider
 from collections import defaultdict
 from IPython.display import display
 
+from profiling import stage
+
 def freeze_headers(df):
   """
   Formats DataFrame for specified HTML style
@@ -161,7 +163,8 @@ def filter_df(dates_selected, remove_uninitiated, blocks_selected, conditions_se
     else:
       pd.set_option('display.max_rows', 10)
   if save_df:
-    with open(save_path+'session_df_working.pkl', 'wb') as handle:
+    with open(save_path+'session_df_working.pkl', 'wb') as handle, \
+        stage('pickle_session_df', rows=len(session_df_conditional)):
       t0 = time.time()
       print('Saving session_df_working to: {}'.format(save_path))
       pickle.dump(session_df_conditional, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,153 @@
+import numpy as np
+
+from ragged import RaggedArray
+
+LICK_THRESHOLD = 4		# manual threshold placed to count a lick
+BLINK_THRESHOLD = 10	# EyeLink (x,y) values for eyes offscreen
+
+# per-trial event columns derived at ingest (see session_parse_helper.session_parser)
+EVENT_COLUMNS = ['lick_events', 'blink_events', 'pupil_zero_events']
+
+def rasterize(trace, threshold):
+	'''
+	Rasterizes a whole ragged trace at once: 1 if the sample is beyond
+	+/- threshold, 0 otherwise
+
+	Returns:
+		raster (RaggedArray): uint8 raster sharing the trace offsets
+	'''
+	buffer = (trace.buffer >= threshold) | (trace.buffer <= (-1*threshold))
+	return RaggedArray(buffer.astype(np.uint8), trace.offsets)
+
+def rasterize_blink(eye_x, eye_y, threshold=BLINK_THRESHOLD):
+	'''Rasterizes max(|eye_x|, |eye_y|) for every sample'''
+	eye_x_abs = np.abs(eye_x.buffer)
+	eye_y_abs = np.abs(eye_y.buffer)
+	# python max(x, y) keeps x unless y > x (including when x is nan)
+	eye_max = np.where(eye_y_abs > eye_x_abs, eye_y_abs, eye_x_abs)
+	return rasterize(RaggedArray(eye_max, eye_x.offsets), threshold)
+
+class EventIntervals:
+	'''
+	On/off events (i.e. licks, blinks) of every trial as [onset, offset)
+	sample intervals relative to the trial start. Events of trial i are
+	onsets[event_offsets[i]:event_offsets[i+1]].
+
+	Window queries take trial-relative [start, stop) windows (one per
+	trial) and only touch the events, not every sample.
+
+	Args:
+		onsets (np.ndarray): int64 first sample of each event
+		offsets (np.ndarray): int64 sample after the last sample of each event
+		event_offsets (np.ndarray): int64 offsets (length = number of trials + 1)
+	'''
+	def __init__(self, onsets, offsets, event_offsets):
+		self.onsets = np.asarray(onsets, dtype=np.int64)
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.event_offsets = np.asarray(event_offsets, dtype=np.int64)
+
+	@classmethod
+	def from_mask(cls, mask):
+		'''Finds the runs of 1s in a 0/1 RaggedArray (i.e. the output of rasterize)'''
+		buffer = mask.buffer[mask.offsets[0]:mask.offsets[-1]] != 0
+		trial_offsets = mask.offsets - mask.offsets[0]
+		# a run starts after a 0 or at a trial start, and ends before a 0 or at a trial end
+		previous = np.zeros(len(buffer), dtype=bool)
+		previous[1:] = buffer[:-1]
+		following = np.zeros(len(buffer), dtype=bool)
+		following[:-1] = buffer[1:]
+		nonempty = trial_offsets[:-1][np.diff(trial_offsets) > 0]
+		previous[nonempty] = False
+		following[trial_offsets[1:][np.diff(trial_offsets) > 0] - 1] = False
+		onsets = np.flatnonzero(buffer & ~previous)
+		offsets = np.flatnonzero(buffer & ~following) + 1
+		trials = np.searchsorted(trial_offsets, onsets, side='right') - 1
+		event_offsets = np.zeros(len(trial_offsets), dtype=np.int64)
+		np.cumsum(np.bincount(trials, minlength=len(trial_offsets)-1), out=event_offsets[1:])
+		return cls(onsets - trial_offsets[trials], offsets - trial_offsets[trials], event_offsets)
+
+	@classmethod
+	def from_column(cls, column):
+		'''Reads a per-trial event column ([onset, offset, onset, offset, ...] per trial)'''
+		events = RaggedArray.from_column(column, dtype=np.int64)
+		buffer = events.buffer[events.offsets[0]:events.offsets[-1]]
+		return cls(buffer[0::2], buffer[1::2], (events.offsets - events.offsets[0]) // 2)
+
+	def to_ragged(self):
+		'''Interleaved [onset, offset, ...] RaggedArray (one row per trial, for session_dict)'''
+		buffer = np.empty(2*len(self.onsets), dtype=np.int64)
+		buffer[0::2] = self.onsets
+		buffer[1::2] = self.offsets
+		return RaggedArray(buffer, 2*self.event_offsets)
+
+	def __len__(self):
+		return len(self.event_offsets) - 1
+
+	def __getitem__(self, index):
+		'''(onsets, offsets) of a single trial'''
+		start, stop = self.event_offsets[index], self.event_offsets[index+1]
+		return self.onsets[start:stop], self.offsets[start:stop]
+
+	def __repr__(self):
+		return 'EventIntervals(trials={}, events={})'.format(len(self), len(self.onsets))
+
+	def trial_ids(self):
+		'''Trial index of every event'''
+		return np.repeat(np.arange(len(self)), np.diff(self.event_offsets))
+
+	def to_mask(self, lengths):
+		'''Rebuilds the 0/1 raster (RaggedArray, uint8) of trials with the specified lengths'''
+		mask = RaggedArray.empty(lengths, dtype=np.uint8)
+		trial_starts = mask.starts[self.trial_ids()]
+		# +1 at every onset, -1 at every offset (an offset can share a position
+		# with the first onset of the next trial, hence bincount)
+		delta = np.bincount(trial_starts + self.onsets, minlength=mask.size+1) - \
+			np.bincount(trial_starts + self.offsets, minlength=mask.size+1)
+		mask.buffer[:] = np.cumsum(delta[:-1])
+		return mask
+
+	def clip(self, starts, stops):
+		'''Each event clipped to its trial window (start, stop), and the overlap length'''
+		trials = self.trial_ids()
+		window_starts = np.asarray(starts, dtype=np.int64)[trials]
+		window_stops = np.asarray(stops, dtype=np.int64)[trials]
+		clipped_onsets = np.maximum(self.onsets, window_starts)
+		clipped_offsets = np.minimum(self.offsets, window_stops)
+		return trials, clipped_onsets, np.maximum(clipped_offsets - clipped_onsets, 0)
+
+	def overlap(self, starts, stops):
+		'''Number of event samples inside each trial window [start, stop)'''
+		trials, _, overlap = self.clip(starts, stops)
+		return np.bincount(trials, weights=overlap, minlength=len(self)).astype(np.int64)
+
+	def any(self, starts, stops):
+		'''True if an event overlaps the trial window [start, stop)'''
+		return self.overlap(starts, stops) > 0
+
+	def first(self, starts, stops):
+		'''First event sample inside each trial window [start, stop), -1 if there is none'''
+		trials, clipped_onsets, overlap = self.clip(starts, stops)
+		inside = np.flatnonzero(overlap > 0)
+		# events are sorted within each trial, so the first one inside the window wins
+		first_trials, first_index = np.unique(trials[inside], return_index=True)
+		first = np.full(len(self), -1, dtype=np.int64)
+		first[first_trials] = clipped_onsets[inside[first_index]]
+		return first
+
+	def onset_count(self, starts, stops):
+		'''Number of events that start inside each trial window [start, stop)'''
+		trials = self.trial_ids()
+		inside = (self.onsets >= np.asarray(starts)[trials]) & (self.onsets < np.asarray(stops)[trials])
+		return np.bincount(trials[inside], minlength=len(self))
+
+def lick_events(lick):
+	'''Lick intervals (lick voltage beyond +/- LICK_THRESHOLD)'''
+	return EventIntervals.from_mask(rasterize(lick, LICK_THRESHOLD))
+
+def blink_events(eye_x, eye_y):
+	'''Blink intervals (eyes offscreen, max(|eye_x|, |eye_y|) beyond BLINK_THRESHOLD)'''
+	return EventIntervals.from_mask(rasterize_blink(eye_x, eye_y))
+
+def pupil_zero_events(eye_pupil):
+	'''Intervals where the pupil signal is 0'''
+	return EventIntervals.from_mask(RaggedArray((eye_pupil.buffer == 0).astype(np.uint8), eye_pupil.offsets))
@@ -0,0 +1,405 @@
+import numpy as np
+import pandas as pd
+
+from ragged import RaggedArray
+from bit_raster import BitRaster
+from events import EventIntervals, lick_events, blink_events, pupil_zero_events
+
+def epoch_times(df, epoch):
+	'''
+	Returns the epoch time (i.e. 'Trace End') of every trial as int64
+	and a mask of the trials where the epoch exists
+	'''
+	if epoch not in df.columns:
+		return np.zeros(len(df), dtype=np.int64), np.zeros(len(df), dtype=bool)
+	times = pd.array(df[epoch].tolist(), dtype='Int64')
+	valid = ~np.asarray(times.isna())
+	return np.asarray(times.fillna(0), dtype=np.int64), valid
+
+def slice_bounds(start, stop, lengths):
+	'''
+	Vectorized python slice semantics: returns the (start, stop) sample
+	indices selected by trial[start:stop] for every trial, including
+	negative indices and clipping to the trial length
+	'''
+	bounds = []
+	for index in [start, stop]:
+		index = np.where(index < 0, index + lengths, index)
+		bounds.append(np.clip(index, 0, lengths))
+	start, stop = bounds
+	return start, np.maximum(start, stop)
+
+class WindowSelection:
+	'''
+	The [start, stop) window of every trial, with python slice semantics,
+	in the coordinates of a RaggedArray buffer (or BitRaster)
+
+	Args:
+		ragged (RaggedArray/BitRaster): signal the windows are taken from
+		start, stop (np.ndarray): window bounds relative to each trial
+		valid (np.ndarray): trials without the epoch (i.e. errored) are set to np.nan
+	'''
+	def __init__(self, ragged, start, stop, valid):
+		self.ragged = ragged
+		self.valid = valid
+		start, stop = slice_bounds(start, stop, ragged.lengths)
+		self.trial_start = start
+		self.trial_stop = stop
+		self.start = ragged.starts + start
+		self.stop = ragged.starts + stop
+		self.length = stop - start
+
+	def views(self, ragged=None):
+		'''Per-trial zero-copy views of the window (np.nan for invalid trials)'''
+		ragged = self.ragged if ragged is None else ragged
+		views = np.empty(len(self.valid), dtype=object)
+		for t_index in range(len(self.valid)):
+			if self.valid[t_index]:
+				views[t_index] = ragged.buffer[self.start[t_index]:self.stop[t_index]]
+			else:
+				views[t_index] = np.nan
+		return views
+
+	def count(self, prefix_sum):
+		'''Number of non-zero samples in each window (from a buffer prefix sum)'''
+		return prefix_sum[self.stop] - prefix_sum[self.start]
+
+	def mean_from_count(self, count):
+		'''count/length per window, np.nan for empty windows and invalid trials'''
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = count / self.length
+		mean[(self.length == 0) | ~self.valid] = np.nan
+		return mean
+
+	def nanmean(self, ragged=None):
+		'''np.nanmean of every window (per trial, so results match the original exactly)'''
+		ragged = self.ragged if ragged is None else ragged
+		means = np.full(len(self.valid), np.nan)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			for t_index in np.flatnonzero(self.valid & (self.length > 0)):
+				means[t_index] = np.nanmean(ragged.buffer[self.start[t_index]:self.stop[t_index]])
+		return means
+
+def prefix_sum(buffer):
+	'''Cumulative count of non-zero samples with a leading 0 (int64)'''
+	cumulative = np.zeros(len(buffer)+1, dtype=np.int64)
+	np.cumsum(buffer != 0, out=cumulative[1:])
+	return cumulative
+
+def binary_from_count(count, valid):
+	'''1 if count > 0 else 0, np.nan for invalid trials'''
+	binary = (count > 0).astype(float)
+	binary[~valid] = np.nan
+	return binary
+
+def blink_signal_mask(eye_x, eye_y, blink_signal):
+	'''
+	Samples where (eye_x, eye_y) equals one of the two offscreen blink
+	signal points
+	'''
+	x_min, y_min = blink_signal['eye_x_min'], blink_signal['eye_y_min']
+	x_max, y_max = blink_signal['eye_x_max'], blink_signal['eye_y_max']
+	mask = ((eye_x.buffer == x_min) & (eye_y.buffer == y_min)) | \
+				 ((eye_x.buffer == x_max) & (eye_y.buffer == y_max))
+	return RaggedArray(mask.astype(np.uint8), eye_x.offsets)
+
+def offscreen_mask(eye_x, eye_y, blink_signal):
+	'''
+	Samples where both eye_x and eye_y are one of the blink signal values
+	(offscreen eye data, variable signal each day), for the whole buffer
+	'''
+	signal_values = np.array(list(blink_signal.values()), dtype=np.float64)
+	mask = np.isin(eye_x.buffer, signal_values) & np.isin(eye_y.buffer, signal_values)
+	return RaggedArray(mask.astype(np.uint8), eye_x.offsets)
+
+def window_ids(window, size):
+	'''Index of the (valid) window each buffer sample is in, -1 outside of every window'''
+	valid = np.flatnonzero(window.valid)
+	# windows of different trials never overlap: +id+1 at every start, -(id+1) at every stop
+	delta = np.bincount(window.start[valid], weights=valid+1, minlength=size+1) - \
+		np.bincount(window.stop[valid], weights=valid+1, minlength=size+1)
+	return np.cumsum(delta[:-1]).astype(np.int64) - 1
+
+def total_eye_distance(eye_x, eye_y, window, offscreen):
+	'''
+	Total distance traveled by the eyes in each window, excluding the
+	offscreen samples (see offscreen_mask)
+	'''
+	sample_window = window_ids(window, len(eye_x.buffer))
+	keep = (sample_window >= 0) & (offscreen.buffer == 0)
+	kept_window = sample_window[keep]
+	step_size = np.hypot(np.diff(eye_x.buffer[keep]), np.diff(eye_y.buffer[keep]))
+	# steps between consecutive kept samples of the same window
+	same_window = kept_window[1:] == kept_window[:-1]
+	cumulative_distance = np.bincount(kept_window[1:][same_window], weights=step_size[same_window],
+																		minlength=len(window.valid)).astype(np.float64)
+	cumulative_distance[~window.valid] = np.nan
+	return cumulative_distance
+
+class Feature:
+	'''
+	A derived session field
+
+	Args:
+		name (str): feature name (the session_df column name for column features)
+		function (callable): function(df, session_obj, *dependencies) -> values
+		depends (tuple): features passed to function (computed first)
+		params (tuple): Session attributes the feature reads (i.e. 'window_lick')
+		column (bool): False for intermediate results that are not session_df columns
+	'''
+	def __init__(self, name, function, depends=(), params=(), column=True):
+		self.name = name
+		self.function = function
+		self.depends = tuple(depends)
+		self.params = tuple(params)
+		self.column = column
+
+# name -> Feature, in the order features are registered
+FEATURES = {}
+
+def feature(name, depends=(), params=(), column=True):
+	'''Decorator that registers a derived field in FEATURES'''
+	def register(function):
+		FEATURES[name] = Feature(name, function, depends, params, column)
+		return function
+	return register
+
+def feature_columns():
+	'''Names of all registered session_df column features'''
+	return [name for name, registered in FEATURES.items() if registered.column]
+
+class FeatureSet:
+	'''
+	Lazily computed derived fields of a single session. Each feature
+	(and its dependencies) is computed the first time it is accessed
+	and cached until a Session parameter it depends on changes.
+
+	Args:
+		df: session_df DataFrame (with epoch time columns from add_epoch_times)
+		session_obj: Session object (setting session_obj.window_lick/window_blink/
+			blink_signal invalidates the features that use them)
+	'''
+	def __init__(self, df, session_obj):
+		self.df = df
+		self.session_obj = session_obj
+		self.cache = {}
+		self.materialized = []
+
+	def __getitem__(self, name):
+		if name not in self.cache:
+			registered = FEATURES[name]
+			dependencies = [self[dependency] for dependency in registered.depends]
+			self.cache[name] = registered.function(self.df, self.session_obj, *dependencies)
+		return self.cache[name]
+
+	def __contains__(self, name):
+		return name in self.cache
+
+	def dependents(self, param):
+		'''All features that (directly or through a dependency) use a Session parameter'''
+		stale = set()
+		for name, registered in FEATURES.items():
+			# features are registered after their dependencies
+			if param in registered.params or stale.intersection(registered.depends):
+				stale.add(name)
+		return stale
+
+	def invalidate(self, param):
+		'''
+		Drops the cached features that use param and recomputes the
+		session_df columns that were already added with require
+
+		Returns:
+			stale_columns (list): recomputed session_df columns
+		'''
+		stale = self.dependents(param)
+		for name in stale:
+			self.cache.pop(name, None)
+		stale_columns = [column for column in self.materialized if column in stale]
+		if stale_columns:
+			print('  {} changed, recomputing: {}'.format(param, ', '.join(stale_columns)))
+			for column in stale_columns:
+				self.df[column] = self[column]
+		return stale_columns
+
+	def require(self, columns):
+		'''Adds columns (computing only what they need) to session_df'''
+		for column in columns:
+			self.df[column] = self[column]
+			if column not in self.materialized:
+				self.materialized.append(column)
+		return self.df
+
+## signals and epoch times
+def signal_feature(signal_column):
+	'''Registers a per-trial signal column as a RaggedArray feature'''
+	def signal(df, session_obj):
+		return RaggedArray.from_column(df[signal_column])
+	feature(signal_column, column=False)(signal)
+
+for signal_column in ['lick', 'eye_x', 'eye_y', 'eye_pupil']:
+	signal_feature(signal_column)
+
+@feature('trace_end_time', column=False)
+def trace_end_time(df, session_obj):
+	return epoch_times(df, 'Trace End')
+
+@feature('cs_on_time', column=False)
+def cs_on_time(df, session_obj):
+	return epoch_times(df, 'CS On')
+
+## lick/blink/pupil events (derived at ingest, or from the traces for older sessions)
+def event_feature(event_column, signal_columns, derive):
+	'''Registers the EventIntervals of a per-trial event column (see events.EVENT_COLUMNS)'''
+	def intervals(df, session_obj, *signals):
+		if event_column in df.columns:
+			return EventIntervals.from_column(df[event_column])
+		return derive(*signals)
+	feature(event_column.replace('_events', '_intervals'), depends=signal_columns, column=False)(intervals)
+
+event_feature('lick_events', ['lick'], lick_events)
+event_feature('blink_events', ['eye_x', 'eye_y'], blink_events)
+event_feature('pupil_zero_events', ['eye_pupil'], pupil_zero_events)
+
+## rasters (rebuilt from the event intervals)
+@feature('lick_raster_bits', depends=['lick', 'lick_intervals'], column=False)
+def lick_raster_bits(df, session_obj, lick, lick_intervals):
+	return BitRaster.from_ragged(lick_intervals.to_mask(lick.lengths))
+
+@feature('blink_raster_bits', depends=['eye_x', 'blink_intervals'], column=False)
+def blink_raster_bits(df, session_obj, eye_x, blink_intervals):
+	return BitRaster.from_ragged(blink_intervals.to_mask(eye_x.lengths))
+
+@feature('pupil_zero_buffer', depends=['eye_pupil', 'pupil_zero_intervals'], column=False)
+def pupil_zero_buffer(df, session_obj, eye_pupil, pupil_zero_intervals):
+	return pupil_zero_intervals.to_mask(eye_pupil.lengths)
+
+@feature('lick_raster', depends=['lick_raster_bits'])
+def lick_raster(df, session_obj, lick_raster_bits):
+	return lick_raster_bits.to_rows()
+
+@feature('blink_raster', depends=['blink_raster_bits'])
+def blink_raster(df, session_obj, blink_raster_bits):
+	return blink_raster_bits.to_rows()
+
+@feature('trial_bins', depends=['eye_x'])
+def trial_bins(df, session_obj, eye_x):
+	# number of samples of eye data as a proxy for the trial bins
+	return eye_x.lengths
+
+## trace windows (-<TRACE_WINDOW>ms from trace interval end)
+def trace_window(ragged, trace_end_time, window):
+	trace_off_time, trace_valid = trace_end_time
+	return WindowSelection(ragged, trace_off_time-window, trace_off_time, trace_valid)
+
+@feature('lick_window', depends=['lick', 'trace_end_time'], params=['window_lick'], column=False)
+def lick_window(df, session_obj, lick, trace_end_time):
+	return trace_window(lick, trace_end_time, session_obj.window_lick)
+
+@feature('blink_window', depends=['eye_x', 'trace_end_time'], params=['window_blink'], column=False)
+def blink_window(df, session_obj, eye_x, trace_end_time):
+	return trace_window(eye_x, trace_end_time, session_obj.window_blink)
+
+@feature('pupil_window', depends=['eye_pupil', 'trace_end_time'], params=['window_blink'], column=False)
+def pupil_window(df, session_obj, eye_pupil, trace_end_time):
+	return trace_window(eye_pupil, trace_end_time, session_obj.window_blink)
+
+# number of event samples in each window (interval overlap)
+@feature('lick_count', depends=['lick_window', 'lick_intervals'], column=False)
+def lick_count(df, session_obj, lick_window, lick_intervals):
+	return lick_intervals.overlap(lick_window.trial_start, lick_window.trial_stop)
+
+@feature('blink_count', depends=['blink_window', 'blink_intervals'], column=False)
+def blink_count(df, session_obj, blink_window, blink_intervals):
+	return blink_intervals.overlap(blink_window.trial_start, blink_window.trial_stop)
+
+@feature('pupil_zero_count', depends=['pupil_window', 'pupil_zero_intervals'], column=False)
+def pupil_zero_count(df, session_obj, pupil_window, pupil_zero_intervals):
+	return pupil_zero_intervals.overlap(pupil_window.trial_start, pupil_window.trial_stop)
+
+@feature('lick_count_window', depends=['lick_window', 'lick_raster_bits'])
+def lick_count_window(df, session_obj, lick_window, lick_raster_bits):
+	return lick_raster_bits.window_rows(lick_window.start, lick_window.stop, lick_window.valid)
+
+@feature('blink_count_window', depends=['blink_window', 'blink_raster_bits'])
+def blink_count_window(df, session_obj, blink_window, blink_raster_bits):
+	return blink_raster_bits.window_rows(blink_window.start, blink_window.stop, blink_window.valid)
+
+@feature('pupil_data_window', depends=['pupil_window'])
+def pupil_data_window(df, session_obj, pupil_window):
+	return pupil_window.views()
+
+@feature('pupil_raster_window', depends=['pupil_window', 'pupil_zero_buffer'])
+def pupil_raster_window(df, session_obj, pupil_window, pupil_zero_buffer):
+	return pupil_window.views(pupil_zero_buffer)
+
+@feature('pupil_raster_window_avg', depends=['pupil_window', 'pupil_zero_count'])
+def pupil_raster_window_avg(df, session_obj, pupil_window, pupil_zero_count):
+	return pupil_window.mean_from_count(pupil_zero_count)
+
+@feature('pupil_binary_zero', depends=['pupil_window', 'pupil_zero_count'])
+def pupil_binary_zero(df, session_obj, pupil_window, pupil_zero_count):
+	# 1 if pupil is 0 for any timepoint in blink window
+	return binary_from_count(pupil_zero_count, pupil_window.valid)
+
+@feature('pupil_pre_CS', depends=['eye_pupil', 'cs_on_time'])
+def pupil_pre_CS(df, session_obj, eye_pupil, cs_on_time):
+	# 200ms before CS On
+	cs_on, cs_on_valid = cs_on_time
+	return WindowSelection(eye_pupil, cs_on-200, cs_on, cs_on_valid).views()
+
+@feature('lick_in_window', depends=['lick_window', 'lick_count'])
+def lick_in_window(df, session_obj, lick_window, lick_count):
+	return binary_from_count(lick_count, lick_window.valid)
+
+@feature('blink_in_window', depends=['blink_window', 'blink_count'])
+def blink_in_window(df, session_obj, blink_window, blink_count):
+	return binary_from_count(blink_count, blink_window.valid)
+
+@feature('lick_duration', depends=['lick_window'])
+def lick_duration(df, session_obj, lick_window):
+	return lick_window.nanmean()
+
+## offscreen eye data (Session.blink_signal)
+@feature('blink_signal_buffer', depends=['eye_x', 'eye_y'], params=['blink_signal'], column=False)
+def blink_signal_buffer(df, session_obj, eye_x, eye_y):
+	return blink_signal_mask(eye_x, eye_y, session_obj.blink_signal)
+
+@feature('offscreen_buffer', depends=['eye_x', 'eye_y'], params=['blink_signal'], column=False)
+def offscreen_buffer(df, session_obj, eye_x, eye_y):
+	return offscreen_mask(eye_x, eye_y, session_obj.blink_signal)
+
+@feature('blink_duration_sig', depends=['blink_window', 'blink_signal_buffer'])
+def blink_duration_sig(df, session_obj, blink_window, blink_signal_buffer):
+	return blink_window.mean_from_count(blink_window.count(prefix_sum(blink_signal_buffer.buffer)))
+
+@feature('blink_duration_offscreen', depends=['blink_window', 'blink_count'])
+def blink_duration_offscreen(df, session_obj, blink_window, blink_count):
+	return blink_window.mean_from_count(blink_count)
+
+@feature('eye_distance', depends=['blink_window', 'eye_x', 'eye_y', 'offscreen_buffer'])
+def eye_distance(df, session_obj, blink_window, eye_x, eye_y, offscreen_buffer):
+	return total_eye_distance(eye_x, eye_y, blink_window, offscreen_buffer)
+
+@feature('eye_offscreen_fraction', depends=['blink_window', 'offscreen_buffer'])
+def eye_offscreen_fraction(df, session_obj, blink_window, offscreen_buffer):
+	# fraction of the blink window with offscreen eye data
+	return blink_window.mean_from_count(blink_window.count(prefix_sum(offscreen_buffer.buffer)))
+
+## first-event latency (ms from CS On to the first lick/blink before Trace End)
+def event_latency(intervals, cs_on_time, trace_end_time, lengths):
+	cs_on, cs_on_valid = cs_on_time
+	trace_off_time, trace_valid = trace_end_time
+	start, stop = slice_bounds(cs_on, trace_off_time, lengths)
+	first = intervals.first(start, stop)
+	latency = (first - start).astype(float)
+	latency[(first < 0) | ~cs_on_valid | ~trace_valid] = np.nan
+	return latency
+
+@feature('lick_latency', depends=['lick_intervals', 'cs_on_time', 'trace_end_time', 'lick'])
+def lick_latency(df, session_obj, lick_intervals, cs_on_time, trace_end_time, lick):
+	return event_latency(lick_intervals, cs_on_time, trace_end_time, lick.lengths)
+
+@feature('blink_latency', depends=['blink_intervals', 'cs_on_time', 'trace_end_time', 'eye_x'])
+def blink_latency(df, session_obj, blink_intervals, cs_on_time, trace_end_time, eye_x):
+	return event_latency(blink_intervals, cs_on_time, trace_end_time, eye_x.lengths)
@@ -0,0 +1,206 @@
+import os
+import ast
+import json
+import time
+import hashlib
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from bit_raster import RasterRow
+
+# bump when the cache key or manifest format changes (job modules and the helper
+# modules they import are already hashed, see module_digest)
+FIGURE_CACHE_VERSION = 1
+CACHE_FOLDER = '.figure_cache'
+MANIFEST_FILE = 'manifest.json'
+# Session attributes that change how figures look
+SESSION_PARAMS = ['monkey', 'task', 'window_lick', 'window_blink', 'colors', 'stim_labels',
+									'valence_colors', 'valence_labels', 'figure_path']
+
+def update_hash(hasher, value):
+	'''Adds a value (array, RasterRow, list, scalar...) to a hashlib hasher'''
+	if isinstance(value, RasterRow):
+		value = np.asarray(value)
+	if isinstance(value, np.ndarray):
+		hasher.update('{}{}'.format(value.dtype, value.shape).encode())
+		hasher.update(np.ascontiguousarray(value).tobytes() if value.dtype != object else repr(value.tolist()).encode())
+	elif isinstance(value, (list, tuple)):
+		hasher.update('[{}'.format(len(value)).encode())
+		for item in value:
+			update_hash(hasher, item)
+	else:
+		hasher.update(repr(value).encode())
+
+def column_digest(column):
+	'''Hash of a session_df column (values and index)'''
+	hasher = hashlib.sha1(str(column.name).encode())
+	if column.dtype != object:
+		hasher.update(pd.util.hash_pandas_object(column, index=True).values.tobytes())
+		return hasher.hexdigest()
+	# per-trial arrays (i.e. lick, lick_raster) and mixed columns
+	hasher.update(pd.util.hash_pandas_object(column.index).values.tobytes())
+	for value in column:
+		update_hash(hasher, value)
+	return hasher.hexdigest()
+
+def module_path(module_name):
+	'''Source file of a module (without importing it), None if it is not found'''
+	try:
+		spec = importlib.util.find_spec(module_name)
+	except (ImportError, ValueError):
+		return None
+	return spec.origin if spec is not None and spec.origin and spec.origin.endswith('.py') else None
+
+def helper_imports(file_path):
+	'''Names of the modules imported by a source file (import x / from x import y)'''
+	with open(file_path, 'rb') as f:
+		tree = ast.parse(f.read(), filename=file_path)
+	names = set()
+	for node in ast.walk(tree):
+		if isinstance(node, ast.Import):
+			names.update(alias.name for alias in node.names)
+		elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+			names.add(node.module)
+	return names
+
+def module_digest(module_name):
+	'''
+	Hash of a helper module's source file and of every helper module
+	it (directly or indirectly) imports, without importing them
+	'''
+	root_path = module_path(module_name)
+	helper_dir = os.path.dirname(root_path)
+	hasher = hashlib.sha1()
+	seen = set()
+	pending = [root_path]
+	while pending:
+		file_path = pending.pop()
+		if file_path in seen:
+			continue
+		seen.add(file_path)
+		# helper modules are top level (dotted names would import their parent package)
+		for name in [name for name in helper_imports(file_path) if '.' not in name]:
+			import_path = module_path(name)
+			# only modules next to the job module (helper/*.py), not installed packages
+			if import_path is not None and os.path.dirname(import_path) == helper_dir:
+				pending.append(import_path)
+	for file_path in sorted(seen):
+		with open(file_path, 'rb') as f:
+			hasher.update(os.path.basename(file_path).encode())
+			hasher.update(hashlib.sha1(f.read()).digest())
+	return hasher.hexdigest()
+
+def artifact_stat(file_path):
+	file_stat = os.stat(file_path)
+	return {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns}
+
+class FigureCache:
+	'''
+	Cache of RenderJob outputs (see render_scheduler). The key of a job
+	hashes its module source (and the helper modules it imports), its arguments (every column of DataFrame
+	arguments, the SESSION_PARAMS of Session arguments, repr of anything
+	else) and kwargs. Figures stay where the job saved them, and
+	manifest.json keeps the artifacts of every key so a job is skipped
+	while they are all still on disk and unmodified.
+
+	Args:
+		cache_path (str): directory of manifest.json (i.e. <FIGURE_PATH>/.figure_cache)
+		max_entries (int): least recently used entries beyond this are evicted
+	'''
+	def __init__(self, cache_path, max_entries=5000):
+		self.cache_path = cache_path
+		self.max_entries = max_entries
+		self.manifest_path = os.path.join(cache_path, MANIFEST_FILE)
+		self.hits = []
+		self.misses = []
+		self.evicted = []
+		self.manifest = {}
+		self.column_digests = {}	# (id(df), column) -> digest, for the current run only
+		self.module_digests = {}
+		if os.path.exists(self.manifest_path):
+			with open(self.manifest_path, 'r') as f:
+				self.manifest = json.load(f)
+
+	def argument_digest(self, value):
+		if isinstance(value, pd.DataFrame):
+			digests = []
+			for column in value.columns:
+				if (id(value), column) not in self.column_digests:
+					self.column_digests[(id(value), column)] = column_digest(value[column])
+				digests.append(self.column_digests[(id(value), column)])
+			return digests
+		if hasattr(value, 'window_lick'):	# Session
+			return [repr(getattr(value, param, None)) for param in SESSION_PARAMS]
+		if hasattr(value, '__dict__'):			# i.e. Path
+			return repr(sorted(vars(value).items()))
+		return repr(value)
+
+	def job_key(self, job, context):
+		'''Cache key of a RenderJob run with context'''
+		if job.module not in self.module_digests:
+			self.module_digests[job.module] = module_digest(job.module)
+		key_parts = [FIGURE_CACHE_VERSION, job.module, job.function, self.module_digests[job.module],
+								 [self.argument_digest(context[arg]) for arg in job.args],
+								 sorted((name, self.argument_digest(context[key])) for name, key in job.context_kwargs.items()),
+								 sorted((name, repr(value)) for name, value in job.kwargs.items())]
+		return hashlib.sha1(json.dumps(key_parts, default=str).encode()).hexdigest()
+
+	def get(self, key, job_name):
+		'''Cached artifact paths of key, or None if the job has to run'''
+		entry = self.manifest.get(key)
+		if entry is None or not all(os.path.exists(path) and artifact_stat(path) == stat
+																for path, stat in entry['artifacts'].items()):
+			self.misses.append(job_name)
+			return None
+		entry['last_used'] = time.time()
+		self.hits.append(job_name)
+		return list(entry['artifacts'])
+
+	def put(self, key, session_key, job_name, artifact_paths):
+		'''Records the artifacts saved by a (successful) job'''
+		self.manifest[key] = {
+			'session': session_key,
+			'job': job_name,
+			'artifacts': {path: artifact_stat(path) for path in artifact_paths if os.path.exists(path)},
+			'created': time.time(),
+			'last_used': time.time(),
+		}
+
+	def evict(self):
+		'''
+		Removes entries with missing or modified artifacts, entries replaced
+		by a newer entry of the same session job and, beyond max_entries, the
+		least recently used entries (only the manifest entries: figures on
+		disk are never deleted)
+		'''
+		stale_keys = []
+		latest = {}
+		for key, entry in sorted(self.manifest.items(), key=lambda item: item[1]['created'], reverse=True):
+			job_id = (entry['session'], entry['job'])
+			if job_id in latest:
+				stale_keys.append(key)
+			elif not all(os.path.exists(path) and artifact_stat(path) == stat
+									 for path, stat in entry['artifacts'].items()):
+				stale_keys.append(key)
+			else:
+				latest[job_id] = key
+		current_keys = sorted(set(self.manifest) - set(stale_keys),
+													key=lambda key: self.manifest[key]['last_used'], reverse=True)
+		stale_keys += current_keys[self.max_entries:]
+		for key in stale_keys:
+			self.manifest.pop(key)
+			self.evicted.append(key)
+
+	def save(self):
+		'''Evicts stale entries and writes the manifest'''
+		self.evict()
+		if os.path.exists(self.cache_path) == False:
+			os.makedirs(self.cache_path)
+		with open(self.manifest_path, 'w') as f:
+			json.dump(self.manifest, f, indent=1)
+
+	def report(self):
+		print('  Figure cache: {} hit(s), {} miss(es), {} evicted'.format(
+			len(self.hits), len(self.misses), len(self.evicted)))
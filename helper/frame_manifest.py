@@ -0,0 +1,230 @@
+import os
+import json
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pandas as pd
+
+# bump whenever the manifest table changes (invalidates cached manifests)
+MANIFEST_VERSION = 1
+MANIFEST_FILE = '.frame_manifest.parquet'
+FINGERPRINT_FILE = '.frame_manifest.json'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+MANIFEST_COLUMNS = ['camera', 'frame_number', 'filename', 'timestamp']
+
+def parse_image_name(name):
+	'''(camera, frame_number) of a FLIR_Multicam image (i.e. Aragorn_1234_cam0.jpg), None otherwise'''
+	if not name.endswith('.jpg'):
+		return None
+	parts = name[:-4].split('_')
+	if len(parts) < 3 or not parts[-1].startswith('cam'):
+		return None
+	try:
+		return int(parts[-1][3:]), int(parts[1])
+	except ValueError:
+		return None
+
+def parse_timestamp_name(name):
+	'''Camera of a frame timestamp file (i.e. Aragorn_t0.txt -> 0), None otherwise'''
+	if not name.endswith('.txt'):
+		return None
+	last = name[:-4].split('_')[-1]
+	if len(last) < 2 or last[0] != 't' or not last[1:].isdigit():
+		return None
+	return int(last[1:])
+
+def read_frame_timestamps(file_path):
+	'''
+	Frame timestamps (int64 nanoseconds) of a timestamp file, one per
+	line (frame number = line number), see generate_videos.timestamp_image_formatter
+	'''
+	with open(file_path, 'r') as f:
+		lines = [line for line in f.read().split('\n') if line.strip()]
+	timestamps = pd.to_datetime([line.split(',')[1].strip() for line in lines], format=TIMESTAMP_FORMAT)
+	return timestamps.values.astype('datetime64[ns]').astype(np.int64)
+
+def folder_fingerprint(folder_path, timestamp_files):
+	'''Changes when images are added/removed (folder mtime) or a timestamp file changes'''
+	folder_stat = os.stat(folder_path)
+	fingerprint = {'version': MANIFEST_VERSION, 'folder_mtime_ns': folder_stat.st_mtime_ns}
+	for camera, file_path in sorted(timestamp_files.items()):
+		file_stat = os.stat(file_path)
+		fingerprint['t{}'.format(camera)] = [os.path.basename(file_path), file_stat.st_size, file_stat.st_mtime_ns]
+	return fingerprint
+
+class FrameManifest:
+	'''
+	Table of the camera images and frame timestamps of an image folder:
+	one row per (camera, frame_number, filename, timestamp), sorted by
+	camera and frame number. Frames with a timestamp but no image have
+	filename '', images without a timestamp have timestamp -1.
+
+	The table is built with a single os.scandir and cached alongside the
+	images (.frame_manifest.parquet), and rebuilt when images are added
+	or removed or a timestamp file changes.
+
+	Args:
+		folder_path (str): image folder
+		table (pd.DataFrame): manifest table (MANIFEST_COLUMNS)
+	'''
+	def __init__(self, folder_path, table):
+		self.folder_path = folder_path
+		self.table = table.reset_index(drop=True)
+		self.cameras = {}	# camera -> (first row, last row + 1)
+		cameras = self.table['camera'].values
+		for camera in np.unique(cameras):
+			self.cameras[int(camera)] = (np.searchsorted(cameras, camera, side='left'),
+																	 np.searchsorted(cameras, camera, side='right'))
+
+	def __repr__(self):
+		return 'FrameManifest({}, cameras={}, rows={})'.format(self.folder_path, sorted(self.cameras), len(self.table))
+
+	@classmethod
+	def load(cls, folder_path, rebuild=False):
+		'''Cached manifest of folder_path (built and cached if missing or out of date)'''
+		manifest_path = os.path.join(folder_path, MANIFEST_FILE)
+		fingerprint_path = os.path.join(folder_path, FINGERPRINT_FILE)
+		if not rebuild and os.path.exists(manifest_path) and os.path.exists(fingerprint_path):
+			with open(fingerprint_path, 'r') as f:
+				fingerprint = json.load(f)
+			timestamp_files = {int(key[1:]): os.path.join(folder_path, value[0])
+												 for key, value in fingerprint.items() if key.startswith('t')}
+			if all(os.path.exists(path) for path in timestamp_files.values()) and \
+					folder_fingerprint(folder_path, timestamp_files) == fingerprint:
+				return cls(folder_path, pd.read_parquet(manifest_path))
+		timestamp_files, image_rows = cls.scan(folder_path)
+		manifest = cls(folder_path, cls.build_table(timestamp_files, image_rows))
+		try:
+			manifest.table.to_parquet(manifest_path, index=False)
+			# written once the manifest files exist (creating them changes the folder mtime)
+			with open(fingerprint_path, 'w') as f:
+				json.dump({}, f)
+			with open(fingerprint_path, 'w') as f:
+				json.dump(folder_fingerprint(folder_path, timestamp_files), f, indent=1)
+		except OSError as e:
+			# read-only image folders (i.e. external drives) are rescanned every time
+			print('  Frame manifest not cached ({})'.format(e))
+		return manifest
+
+	@staticmethod
+	def scan(folder_path):
+		'''Single os.scandir pass: timestamp files (camera -> path) and image rows (camera, frame_number, filename)'''
+		timestamp_files = {}
+		image_rows = []
+		with os.scandir(folder_path) as entries:
+			for entry in entries:
+				image = parse_image_name(entry.name)
+				if image is not None:
+					image_rows.append((image[0], image[1], entry.name))
+					continue
+				camera = parse_timestamp_name(entry.name)
+				if camera is not None:
+					timestamp_files[camera] = entry.path
+		return timestamp_files, image_rows
+
+	@staticmethod
+	def build_table(timestamp_files, image_rows):
+		images = pd.DataFrame(image_rows, columns=['camera', 'frame_number', 'filename'])
+		timestamp_tables = [pd.DataFrame({'camera': [], 'frame_number': [], 'timestamp': []}, dtype=np.int64)]
+		for camera, file_path in timestamp_files.items():
+			timestamps = read_frame_timestamps(file_path)
+			timestamp_tables.append(pd.DataFrame({'camera': camera, 'frame_number': np.arange(len(timestamps)),
+																						'timestamp': timestamps}))
+		timestamps = pd.concat(timestamp_tables, ignore_index=True)
+		images = images.astype({'camera': np.int64, 'frame_number': np.int64})
+		table = images.merge(timestamps, on=['camera', 'frame_number'], how='outer')
+		table['filename'] = table['filename'].fillna('')
+		table['timestamp'] = table['timestamp'].fillna(-1)
+		table = table.astype({'camera': np.int16, 'frame_number': np.int64, 'timestamp': np.int64})
+		return table.sort_values(['camera', 'frame_number', 'filename'], kind='stable')[MANIFEST_COLUMNS]
+
+	def camera(self, camera):
+		'''Rows of a single camera (sorted by frame number)'''
+		start, stop = self.cameras.get(camera, (0, 0))
+		return self.table.iloc[start:stop]
+
+	def images(self, camera):
+		'''Image rows of a camera (frame_number, filename), one per frame number'''
+		camera_table = self.camera(camera)
+		images = camera_table[camera_table['filename'] != '']
+		return images[~images['frame_number'].duplicated(keep='first')]
+
+	def image_count(self, camera):
+		return int(np.sum(self.camera(camera)['filename'].values != ''))
+
+	def timestamps(self, camera):
+		'''Frame timestamps (int64 nanoseconds) in timestamp file order (see generate_videos.FrameIndex)'''
+		camera_table = self.camera(camera)
+		camera_table = camera_table[camera_table['timestamp'] >= 0]
+		return camera_table['timestamp'].values[~camera_table['frame_number'].duplicated(keep='first').values]
+
+	def frames(self, camera, frame_start, frame_end):
+		'''Image filenames of frames frame_start to frame_end (inclusive), in frame order'''
+		images = self.images(camera)
+		frame_numbers = images['frame_number'].values
+		start = np.searchsorted(frame_numbers, frame_start, side='left')
+		stop = np.searchsorted(frame_numbers, frame_end, side='right')
+		return images['filename'].values[start:stop].tolist()
+
+	def duplicate_frames(self, camera):
+		'''Frame numbers with more than one image'''
+		images = self.camera(camera)
+		images = images[images['filename'] != '']
+		return np.unique(images['frame_number'].values[images['frame_number'].duplicated().values])
+
+	def missing_frames(self, camera):
+		'''Frame numbers without an image (timestamped frames and gaps in the image numbering)'''
+		camera_table = self.camera(camera)
+		if len(camera_table) == 0:
+			return np.array([], dtype=np.int64)
+		image_frames = camera_table['frame_number'].values[camera_table['filename'].values != '']
+		all_frames = np.arange(camera_table['frame_number'].min(), camera_table['frame_number'].max() + 1)
+		return np.setdiff1d(all_frames, image_frames)
+
+	def report(self):
+		for camera in sorted(self.cameras):
+			print('    cam{}: {} images, {} timestamps, {} missing, {} duplicate frames'.format(
+				camera, self.image_count(camera), len(self.timestamps(camera)),
+				len(self.missing_frames(camera)), len(self.duplicate_frames(camera))))
+
+def imread_into(file_path, buffer):
+	'''cv2.imread reusing buffer (when shape and type match), plain cv2.imread on OpenCV without imread(filename, dst)'''
+	if buffer is None:
+		return cv2.imread(file_path)
+	try:
+		return cv2.imread(file_path, buffer)
+	except (cv2.error, TypeError):
+		return cv2.imread(file_path)
+
+def read_frames(folder_path, filenames, threads=2, prefetch=8):
+	'''
+	Decodes images in order with a thread pool, at most prefetch frames
+	ahead of the consumer (i.e. cv2.VideoWriter.write), so disk reads and
+	JPEG decoding overlap with encoding. Frames are decoded into a ring of
+	prefetch+1 reused buffers: a yielded frame is only valid until the
+	next one is requested.
+
+	Args:
+		folder_path (str): image folder
+		filenames (list): images to decode (i.e. FrameManifest.frames)
+		threads (int): decoding threads
+		prefetch (int): frames decoded ahead
+
+	Yields:
+		frame (np.ndarray): decoded image (BGR)
+	'''
+	buffers = [None] * (prefetch + 1)
+	def decode(index):
+		buffers[index % len(buffers)] = imread_into(os.path.join(folder_path, filenames[index]),
+																								buffers[index % len(buffers)])
+		return buffers[index % len(buffers)]
+	with ThreadPoolExecutor(max_workers=threads) as executor:
+		in_flight = collections.deque(executor.submit(decode, index) for index in range(min(prefetch, len(filenames))))
+		for index in range(len(filenames)):
+			frame = in_flight.popleft().result()
+			yield frame
+			# the buffer of frame is only reused once it has been consumed
+			if index + prefetch < len(filenames):
+				in_flight.append(executor.submit(decode, index + prefetch))
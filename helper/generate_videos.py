@@ -1,11 +1,77 @@
 import os
 import sys
 import cv2
+import time
 import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
+import pandas as pd
 from tqdm.auto import tqdm
 from datetime import datetime, timedelta
 
+import profiling
+from profiling import stage
+from frame_manifest import FrameManifest, read_frames
+from session_video import SessionVideo, session_video_path
+
+def to_ns(timestamps):
+	"""
+	Converts datetime(s) (or np.datetime64) to int64 nanoseconds
+	"""
+	return np.asarray(timestamps, dtype='datetime64[ns]').astype(np.int64)
+
+def ns_to_datetime(timestamp_ns):
+	"""
+	Converts int64 nanoseconds back to a datetime (microsecond precision, as in the timestamp files)
+	"""
+	return np.datetime64(int(timestamp_ns), 'ns').astype('datetime64[us]').item()
+
+class FrameIndex:
+	"""
+	Sorted int64 nanosecond index of the frame timestamps of one camera
+	(one image timestamp file), so that the closest frame to any number
+	of timestamps is found with a single np.searchsorted
+
+	Args
+		- frame_datetimes (list): frame datetimes (or int64 nanoseconds, i.e.
+			FrameManifest.timestamps), in timestamp file order
+	"""
+	def __init__(self, frame_datetimes):
+		if not isinstance(frame_datetimes, np.ndarray):
+			frame_datetimes = list(frame_datetimes)
+		frame_ns = to_ns(frame_datetimes)
+		# unique sorted timestamps and the first/last line each one appears on
+		self.times, self.first = np.unique(frame_ns, return_index=True)
+		_, last_reversed = np.unique(frame_ns[::-1], return_index=True)
+		self.last = len(frame_ns) - 1 - last_reversed
+
+	def __len__(self):
+		return len(self.times)
+
+	def nearest(self, timestamps):
+		"""
+		Finds the closest frame timestamp to each timestamp
+
+		Args
+			- timestamps: datetime(s) or int64 nanoseconds
+
+		Returns
+			- frame_ns (np.ndarray): closest frame timestamp (int64 nanoseconds)
+			- frame_index (np.ndarray): line of that timestamp in the timestamp file
+				(the last one if it is repeated)
+		"""
+		timestamps = np.asarray(timestamps)
+		timestamps_ns = timestamps if timestamps.dtype == np.int64 else to_ns(timestamps)
+		right = np.clip(np.searchsorted(self.times, timestamps_ns), 0, len(self.times)-1)
+		left = np.clip(right - 1, 0, len(self.times)-1)
+		left_dist = np.abs(timestamps_ns - self.times[left])
+		right_dist = np.abs(self.times[right] - timestamps_ns)
+		# ties go to the timestamp that comes first in the file (as min() over the file did)
+		use_right = (right_dist < left_dist) | ((right_dist == left_dist) & (self.first[right] < self.first[left]))
+		closest = np.where(use_right, right, left)
+		return self.times[closest], self.last[closest]
+
 def closest_timestamp(timestamp, eventcode, list_timestamps):
 		"""
 		closest_timestamp looks through a list of datetime objects
@@ -14,20 +80,57 @@ def closest_timestamp(timestamp, eventcode, list_timestamps):
 		Args
 			- timestamp (datetime): the specified datetime that we want to find the closest datetime to
 			- eventcode (str): for printing purposes (i.e. 'trial start')
-			- list_timestamps (list): list of datetimes that you go through to find the one that is closest to timestamp
+			- list_timestamps (list or FrameIndex): datetimes to search (a FrameIndex avoids re-sorting them)
 
 		Returns
 			- res (datetime): the closest datetime in the list of datetimes
 		"""
-		if list_timestamps:
-				res = min(list_timestamps, key=lambda sub: abs(sub - timestamp))
-		else:
+		if len(list_timestamps) == 0:
 				sys.exit('Missing IMAGE TIMESTAMP FILES')
-	
-		# printing result
-		if eventcode:
-				pass
-		return res
+		frame_index = list_timestamps if isinstance(list_timestamps, FrameIndex) else FrameIndex(list_timestamps)
+		frame_ns, _ = frame_index.nearest([timestamp])
+		return ns_to_datetime(frame_ns[0])
+
+def trial_frame_bounds(camera_frame_indexes, segment_starts, segment_ends):
+	"""
+	Resolves the closest frames to the start and end of every trial segment
+	for every camera in one call. With several image folders (sessions) per
+	camera, each trial uses the folder whose frame is closest to its start.
+
+	Args
+		- camera_frame_indexes (dict): cam_name -> list of FrameIndex (one per image folder)
+		- segment_starts, segment_ends (pd.Series): datetime64 start/end of each trial segment
+			(NaT for trials without video)
+
+	Returns
+		- frame_bounds (dict): cam_name -> DataFrame (same index as segment_starts) with
+			session_index, frame_index_start/end and frame_time_start/end (datetime64[ns])
+	"""
+	valid = (segment_starts.notna() & segment_ends.notna()).values
+	starts_ns = segment_starts.values.astype('datetime64[ns]').astype(np.int64)[valid]
+	ends_ns = segment_ends.values.astype('datetime64[ns]').astype(np.int64)[valid]
+	frame_bounds = {}
+	for cam_name, frame_indexes in camera_frame_indexes.items():
+		if len(frame_indexes) == 0:
+			sys.exit('Missing IMAGE TIMESTAMP FILES')
+		# (session, trial) closest frames
+		nearest_start = [frame_index.nearest(starts_ns) for frame_index in frame_indexes]
+		nearest_end = [frame_index.nearest(ends_ns) for frame_index in frame_indexes]
+		start_dist = np.stack([np.abs(frame_ns - starts_ns) for frame_ns, _ in nearest_start])
+		session_index = np.argmin(start_dist, axis=0)
+		trials = np.arange(len(starts_ns))
+		bounds = pd.DataFrame(index=segment_starts.index)
+		bounds['session_index'] = -1
+		bounds.loc[valid, 'session_index'] = session_index
+		for bound, nearest in [('start', nearest_start), ('end', nearest_end)]:
+			frame_ns = np.stack([frame_ns for frame_ns, _ in nearest])[session_index, trials]
+			frame_index = np.stack([frame_index for _, frame_index in nearest])[session_index, trials]
+			bounds['frame_index_' + bound] = -1
+			bounds.loc[valid, 'frame_index_' + bound] = frame_index
+			bounds['frame_time_' + bound] = pd.NaT
+			bounds.loc[valid, 'frame_time_' + bound] = frame_ns.astype('datetime64[ns]')
+		frame_bounds[cam_name] = bounds
+	return frame_bounds
 
 def timestamp_image_formatter(timestamp_image_file):
 		"""
@@ -70,91 +173,80 @@ def write_log(log_file, trial_index, content):
 		content_str = ','.join(content_list)
 		log_file.write(content_str + '\n')
 
+def trial_segments(df, trial_start_timestamps, trial_end_timestamps, delay_only):
+	"""
+	Start and end datetimes of the video segment of every trial
+
+	Args
+		- df (DataFrame): session_df
+		- trial_start_timestamps, trial_end_timestamps (list): lines of the trial timestamp files
+		- delay_only (bool): if True, segments only cover the delay period (Trace Start to
+			Trace End) of correct trials, and other trials have no segment (NaT)
+
+	Returns
+		- segment_starts, segment_ends (pd.Series): datetime64 segment bounds (df index)
+	"""
+	trial_indices = df['trial_num'].astype(int).values - 1
+	trial_starts = pd.Series([str_to_datetime(trial_start_timestamps[t]) for t in trial_indices],
+													 index=df.index, dtype='datetime64[ns]')
+	trial_ends = pd.Series([str_to_datetime(trial_end_timestamps[t]) for t in trial_indices],
+												 index=df.index, dtype='datetime64[ns]')
+	if not delay_only:
+		return trial_starts, trial_ends
+	correct = df['correct'] == 1
+	# (rounded to microseconds, like timedelta(milliseconds=...))
+	segment_starts = trial_starts + pd.to_timedelta(df['Trace Start'], unit='ms').dt.round('us')
+	segment_ends = trial_starts + pd.to_timedelta(df['Trace End'], unit='ms').dt.round('us')
+	return segment_starts.where(correct), segment_ends.where(correct)
+
 def img_to_vid(trial, 
 							 delay_only, 											# if True, only delay period is included in video
-							 trial_start_timestamps, 					# list of trial start timestamps
-							 trial_end_timestamps, 						# list of trial end timestamps
+							 segment_starts, segment_ends, 		# trial segment datetimes (see trial_segments)
+							 frame_bounds, 										# closest frames of each segment (see trial_frame_bounds)
 							 IMAGES_FOLDER, VIDEO_SAVE_PATH,  # save folders
 							 DATE, MONKEY,      							# experiment parameters
-							 cam_name, images_cam_list, 			# images folders
-							 timestamp_images_datetime, 			# image timestamps
-							 timestamp_image_file_list, 			# image timestamp files
-							 specified_folder_path_list,			# image timestamp lists
-							 log_file):								# log file
+							 cam_name, manifest_list, 				# frame manifest of each image folder
+							 specified_folder_path_list,			# image folder of each frame_bounds session_index
+							 log_file,								# log file
+							 encode=True):						# if False, returns the encoding job instead (see encode_video)
 	"""
 	Creates videos for each trial
 	"""
 
 	trial_index = int(trial['trial_num']) - 1
-	trial_start_specified = trial_start_timestamps[trial_index]
-	trial_start_datetime = str_to_datetime(trial_start_specified)
-	trial_end_specified = trial_end_timestamps[trial_index]
-	trial_end_datetime = str_to_datetime(trial_end_specified)
 
 	# Segments trial for only delay period
 	print('Trial Number: {}'.format(trial_index+1))
 
-	if delay_only:
-		if trial['correct'] == 1:
-			delay_start = trial['Trace Start']
-			delay_end = trial['Trace End']
-			trial_start_segment_datetime = trial_start_datetime + timedelta(milliseconds=delay_start)
-			trial_end_segment_datetime = trial_start_datetime + timedelta(milliseconds=delay_end)
-		else:
-			print('  Subject errored, skipping trial.')
-			video_name = np.nan
-			log_file = write_log(log_file, trial_index, 'error')
-			return video_name 
-	else:
-		trial_start_segment_datetime = trial_start_datetime
-		trial_end_segment_datetime = trial_start_datetime
+	if delay_only and trial['correct'] != 1:
+		print('  Subject errored, skipping trial.')
+		video_name = np.nan
+		log_file = write_log(log_file, trial_index, 'error')
+		return video_name if encode else (video_name, None)
+	trial_start_segment_datetime = segment_starts[trial.name].to_pydatetime()
+	trial_end_segment_datetime = segment_ends[trial.name].to_pydatetime()
 	print('   Start: {}'.format(trial_start_segment_datetime))
 	print('   End:   {}'.format(trial_end_segment_datetime))
 
-	# Frames timestamp data
-	min_dist_timestamp_list_start = []
-	min_dist_timestamp_list_end = []
-
-	# find the frame with the closest timestamp to trial start (or delay start for each trial)
-	min_dist_timestamp_start = closest_timestamp(trial_start_segment_datetime, 'trial start', timestamp_images_datetime)
-	min_dist_timestamp_list_start.append(min_dist_timestamp_start)
-	min_dist_timestamp_end = closest_timestamp(trial_end_segment_datetime, 'trial end', timestamp_images_datetime)
-	min_dist_timestamp_list_end.append(min_dist_timestamp_end)
-
-	# If multiple session files (i.e. 20220902_Aragorn_behave.h5, 20220902_Aragorn_behave (1).h5...)
-	# then select the session that has the closest timestamps to the specified trial
-	min_dist_session = closest_timestamp(trial_start_segment_datetime, '', min_dist_timestamp_list_start)
-	session_index = 0
-	if min_dist_session == min_dist_timestamp_list_start[0]:
-		session_closest_timestamp = specified_folder_path_list[0]
-	else:
-		session_closest_timestamp = specified_folder_path_list[1]
-		session_index = 1
-
-	frame_timestamp_start = min_dist_timestamp_list_start[session_index]
-	frame_timestamp_end = min_dist_timestamp_list_end[session_index]
-	frame_datetimes = timestamp_image_file_list[session_index]
-	images_cam = images_cam_list[session_index]
-
-	# Find the index of the closest video frame timestamp 
-	# to the start and end of the trial (or delay)
-	frame_index_start = 0
-	frame_index_end = 0
-	for f_index, frame_datetime in enumerate(frame_datetimes):
-		if frame_timestamp_start == frame_datetime:
-			frame_index_start = f_index
-		if frame_timestamp_end == frame_datetime:
-			frame_index_end = f_index
+	# Closest video frames to the start and end of the trial (or delay),
+	# in the session (image folder) closest to the trial start
+	bounds = frame_bounds.loc[trial.name]
+	session_index = int(bounds['session_index'])
+	session_closest_timestamp = specified_folder_path_list[session_index]
+	frame_timestamp_start = bounds['frame_time_start'].to_pydatetime()
+	frame_timestamp_end = bounds['frame_time_end'].to_pydatetime()
+	frame_index_start = int(bounds['frame_index_start'])
+	frame_index_end = int(bounds['frame_index_end'])
 	if frame_index_start == 0 or frame_index_end == 0:
 		print('Trial start or Trial end frame index not found')
 		video_name = np.nan
 		write_log(log_file, trial_index, 'error')
-		return video_name
+		return video_name if encode else (video_name, None)
 	if frame_index_start >= frame_index_end:
 		print('Trial start frame index is greater than or equal to Trial end frame index')
 		video_name = np.nan
 		write_log(log_file, trial_index, 'error')
-		return video_name
+		return video_name if encode else (video_name, None)
 
 	timestamp_diff = frame_timestamp_start - trial_start_segment_datetime
 	log_content = [trial_start_segment_datetime, frame_timestamp_start , timestamp_diff]
@@ -164,46 +256,212 @@ def img_to_vid(trial,
 	frame_rate = round(frame_count/length_trial, 3)
 
 	video_name = DATE + '_' + MONKEY + '_trial_' + str(trial_index) + '_' + cam_name + '.mp4'
-	
-	# Parse specified timestamps and recreate video
-	frame = cv2.imread(os.path.join(session_closest_timestamp, images_cam[0]))
-	height, width, layers = frame.shape
-
-	image_order = []
-	for i_index, image in enumerate(images_cam):
-		num_frame = list(image.split('_'))[1] # check file format to make sure (i.e. Gandalf_XXXX_cam0.jpg)
-		image_order.append(int(num_frame))
+	video_save_path = os.path.join(VIDEO_SAVE_PATH, video_name)
+	job = (video_save_path, session_closest_timestamp, int(cam_name[3:]),
+				 frame_index_start, frame_index_end, frame_rate)
+	if not encode:
+		return video_name, job
+	encode_video(job, manifest_list[session_index])
+	return video_name
 
-	zipped_list = zip(image_order, images_cam)
-	sort_image_order = sorted(zipped_list)
-	sorted_image_num = [element for element, _ in sort_image_order]
-	sorted_image_order = [element for _, element in sort_image_order]
+# frame manifest of every image folder and session video of every
+# (image folder, camera) (set once per encoder process, see init_encoder)
+_MANIFESTS = {}
+_SESSION_VIDEOS = {}
 
-	correct_num_frames = np.arange(len(images_cam))
+def init_encoder(manifests, session_videos=None):
+	"""
+	Encoder process initializer: the frame manifests and session videos
+	(shared with the main process when forked) and a single OpenCV thread
+	per process
+	"""
+	cv2.setNumThreads(1)
+	# encoding stages are recorded by the main process (see encode_videos)
+	profiling.detach()
+	_MANIFESTS.update(manifests)
+	_SESSION_VIDEOS.update(session_videos or {})
 
-	selected_images = []
-	# only adds specified images (by frame number) and eliminates duplicates
-	for i_index, image in enumerate(sorted_image_order):
-		filename_num = int(image.split('_')[1])
-		if (filename_num >= frame_index_start) and \
-					(filename_num <= frame_index_end) and \
-					(image not in selected_images):
-				selected_images.append(image)
+def encode_video(job, manifest=None, threads=2, prefetch=8):
+	"""
+	Decodes the images of a trial segment and writes them to an mp4
+	(frames are decoded ahead by a thread pool while the writer encodes,
+	see frame_manifest.read_frames)
+
+	Args
+		- job (tuple): video_save_path, image folder, camera number,
+			first and last frame number, frame rate (see img_to_vid)
+		- manifest (FrameManifest): manifest of the image folder (default: from init_encoder)
+		- threads (int): decoding threads
+		- prefetch (int): frames decoded ahead of the writer
+
+	Returns
+		- video_save_path (str), number of frames written, seconds spent decoding and writing
+	"""
+	video_save_path, folder_path, cam_num, frame_index_start, frame_index_end, frame_rate = job
+	manifest = _MANIFESTS[folder_path] if manifest is None else manifest
+	# Images of the trial frames (by frame number, one per frame)
+	selected_images = manifest.frames(cam_num, frame_index_start, frame_index_end)
+	frame = cv2.imread(os.path.join(folder_path, manifest.images(cam_num)['filename'].iloc[0]))
+	height, width, layers = frame.shape
 
-	video_name = DATE + '_' + MONKEY + '_trial_' + str(trial_index) + '_' + cam_name + '.mp4'
-	video_file_path = os.path.join(session_closest_timestamp,video_name)
-	video_save_path = os.path.join(VIDEO_SAVE_PATH, video_name)
+	start = time.perf_counter()
 	fourcc = cv2.VideoWriter_fourcc('m','p','4','v')
 	video = cv2.VideoWriter(video_save_path, fourcc, frame_rate, (width,height))
-	video_path = session_closest_timestamp
-	for image in tqdm(selected_images, desc='Frame'):
-		video.write(cv2.imread(os.path.join(session_closest_timestamp, image)))
+	for frame in read_frames(folder_path, selected_images, threads, prefetch):
+		video.write(frame)
 
 	cv2.destroyAllWindows()
 	video.release()
-	return video_name
+	return video_save_path, len(selected_images), time.perf_counter() - start
+
+def cut_video(job, session_video=None):
+	"""
+	Cuts the frames of a trial segment from a session video (see session_video)
+
+	Args
+		- job (tuple): encode_video job
+		- session_video (SessionVideo): session video of the image folder and camera
+			(default: from init_encoder)
+
+	Returns
+		- video_save_path (str), number of frames written, seconds spent cutting
+	"""
+	video_save_path, folder_path, cam_num, frame_index_start, frame_index_end, frame_rate = job
+	session_video = _SESSION_VIDEOS[(folder_path, cam_num)] if session_video is None else session_video
+	start = time.perf_counter()
+	frame_count = session_video.cut(frame_index_start, frame_index_end, video_save_path, frame_rate)
+	return video_save_path, frame_count, time.perf_counter() - start
+
+def build_session_video(folder_path, cam_num, video_path, manifest=None):
+	"""
+	Encodes the session video of a camera of an image folder
+
+	Returns
+		- session_video (SessionVideo)
+	"""
+	manifest = _MANIFESTS[folder_path] if manifest is None else manifest
+	return SessionVideo.build(manifest, cam_num, video_path)
+
+def session_videos(keys, manifests, save_folder, workers=None):
+	"""
+	Session videos of every (image folder, camera), encoding the ones that
+	are missing or out of date (one per process)
 
-def generate_videos(df, path_obj, delay_only, num_cameras):
+	Args
+		- keys (list): (image folder, camera number)
+		- manifests (dict): image folder -> FrameManifest
+		- save_folder (str): folder of the session videos and sidecars
+		- workers (int): encoder processes (default: one per core)
+
+	Returns
+		- session_videos (dict): (image folder, camera number) -> SessionVideo
+	"""
+	if os.path.exists(save_folder) == False:
+		os.makedirs(save_folder)
+	videos = {}
+	missing = []
+	for folder_path, cam_num in keys:
+		video_path = session_video_path(save_folder, folder_path, cam_num)
+		videos[(folder_path, cam_num)] = SessionVideo.load(video_path, manifests[folder_path], cam_num)
+		if videos[(folder_path, cam_num)] is None:
+			missing.append((folder_path, cam_num, video_path))
+		else:
+			print('  Session video found - {}'.format(video_path))
+	workers = min(os.cpu_count() if workers is None else workers, len(missing))
+	with stage('session_videos', len(missing)):
+		if workers <= 1:
+			for folder_path, cam_num, video_path in missing:
+				print('  Encoding session video - {}'.format(video_path))
+				videos[(folder_path, cam_num)] = build_session_video(folder_path, cam_num, video_path,
+																														 manifests[folder_path])
+		else:
+			methods = multiprocessing.get_all_start_methods()
+			mp_context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+			print('  Encoding {} session videos ({} workers)...'.format(len(missing), workers))
+			with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+															 initializer=init_encoder, initargs=(manifests,)) as executor:
+				futures = {executor.submit(build_session_video, *video): video for video in missing}
+				for future, (folder_path, cam_num, video_path) in futures.items():
+					videos[(folder_path, cam_num)] = future.result()
+	return videos
+
+def report_video(result):
+	"""
+	Prints the encoding throughput of a video (see encode_video)
+	"""
+	video_save_path, frame_count, seconds = result
+	tqdm.write('  {}: {} frames, {:.1f} frames/sec'.format(
+		os.path.basename(video_save_path), frame_count, frame_count / seconds if seconds > 0 else float('nan')))
+	return {'video': os.path.basename(video_save_path), 'frames': frame_count, 'seconds': seconds,
+					'fps': frame_count / seconds if seconds > 0 else np.nan}
+
+def encode_videos(jobs, manifests, workers=None, session_videos=None):
+	"""
+	Encodes (trial, camera) videos in a process pool, keeping at most
+	two jobs per worker in flight (each job holds its decoded frames)
+
+	Args
+		- jobs (list): encode_video jobs
+		- manifests (dict): image folder -> FrameManifest
+		- workers (int): encoder processes (default: one per core, 1 encodes in this process)
+		- session_videos (dict): (image folder, camera number) -> SessionVideo, to cut
+			the videos from session videos instead of the images (see cut_video)
+
+	Returns
+		- encode_times (DataFrame): frames, seconds and frames/sec of every video (in job order)
+	"""
+	workers = min(os.cpu_count() if workers is None else workers, len(jobs))
+	print('Encoding {} videos ({} workers)...'.format(len(jobs), max(workers, 1)))
+	results = {}
+	with stage('encode_videos', len(jobs)):
+		if workers <= 1:
+			for job_index, job in enumerate(tqdm(jobs, desc='Video')):
+				if session_videos is None:
+					results[job_index] = report_video(encode_video(job, manifests[job[1]]))
+				else:
+					results[job_index] = report_video(cut_video(job, session_videos[(job[1], job[2])]))
+		else:
+			# fork (where available) shares the manifests without pickling them
+			methods = multiprocessing.get_all_start_methods()
+			mp_context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+			with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+															 initializer=init_encoder, initargs=(manifests, session_videos)) as executor, \
+					 tqdm(total=len(jobs), desc='Video') as progress:
+				pending = {}
+				for job_index, job in enumerate(jobs):
+					if len(pending) >= 2*workers:
+						done, _ = wait(pending, return_when=FIRST_COMPLETED)
+						for future in done:
+							results[pending.pop(future)] = report_video(future.result())
+						progress.update(len(done))
+					pending[executor.submit(encode_video if session_videos is None else cut_video, job)] = job_index
+				for future in list(pending):
+					results[pending.pop(future)] = report_video(future.result())
+					progress.update(1)
+	encode_times = pd.DataFrame([results[job_index] for job_index in sorted(results)],
+															columns=['video', 'frames', 'seconds', 'fps'])
+	if len(encode_times) > 0:
+		print('  {} frames in {:.2f}s ({:.1f} frames/sec per video)'.format(
+			encode_times['frames'].sum(), encode_times['seconds'].sum(), encode_times['fps'].mean()))
+	return encode_times
+
+def generate_videos(df, path_obj, delay_only, num_cameras, workers=None, from_session_video=False):
+	"""
+	Creates a video of every trial (or delay period) for every camera
+
+	Args
+		- df (DataFrame): session_df
+		- path_obj (Path): path object (images, trial timestamps and videos are in VIDEO_PATH)
+		- delay_only (bool): if True, only the delay period of correct trials is included
+		- num_cameras (int): number of cameras
+		- workers (int): video encoding processes (default: one per core)
+		- from_session_video (bool): if True, every image of each camera is encoded once into
+			a session video (<VIDEO_SAVE_PATH>/session_videos, reused by later calls) and trial
+			videos are cut from it instead of decoding the images of every trial
+
+	Returns
+		- df (DataFrame): session_df with the video name of every trial (cam0, cam1...)
+	"""
 
 	TRIAL_TIMESTAMP_FILE = path_obj.VIDEO_PATH
 	IMAGES_FOLDER = path_obj.VIDEO_PATH
@@ -247,57 +505,85 @@ def generate_videos(df, path_obj, delay_only, num_cameras):
 	if image_folder == []:
 		sys.exit('Images folder not found')
 
+	# one scan per image folder (cached alongside the images, see FrameManifest)
+	folder_manifests = []
+	for specified_folder in image_folder:
+		specified_folder_path = os.path.join(IMAGES_FOLDER, specified_folder)
+		manifest = FrameManifest.load(specified_folder_path)
+		print('  Frame manifest - {}'.format(specified_folder_path))
+		manifest.report()
+		folder_manifests.append((specified_folder_path, manifest))
+
+	camera_folders = {}
+	camera_manifests = {}
+	camera_frame_indexes = {}
 	for cam_num in range(num_cameras):
 		cam_name = 'cam{}'.format(cam_num)
 		specified_folder_path_list = []
-		images_cam_list = []
+		manifest_list = []
+		frame_indexes = []
 		print('Finding images from image_folder for {}...'.format(cam_name))
-		for specified_folder in image_folder:
-			specified_folder_path = os.path.join(IMAGES_FOLDER, specified_folder)
+		for specified_folder_path, manifest in folder_manifests:
+			# folders without a timestamp file are skipped
+			timestamps = manifest.timestamps(cam_num)
+			if len(timestamps) == 0:
+				continue
+			print('  Image timestamps found - {}'.format(specified_folder_path))
+			frame_indexes.append(FrameIndex(timestamps))
 			specified_folder_path_list.append(specified_folder_path)
-			images_cam = [img for img in os.listdir(specified_folder_path) if img.endswith('{}.jpg'.format(cam_name))]
-			images_cam_list.append(images_cam)
+			manifest_list.append(manifest)
 			print('  Images folder found - {}'.format(specified_folder_path_list))
+		camera_folders[cam_name] = specified_folder_path_list
+		camera_manifests[cam_name] = manifest_list
+		camera_frame_indexes[cam_name] = frame_indexes
 
-		# Image timestamps
-		timestamp_image_file_list = []
-		print('Finding timestamps from image_folder for {}...'.format(cam_name))
-		for specified_folder_path in specified_folder_path_list:
-			image_timestamp_filename = MONKEY + '_t{}.txt'.format(cam_name[-1])
-			image_timestamp_file = os.path.join(specified_folder_path, image_timestamp_filename)
-			try:
-				timestamp_image_file = open(image_timestamp_file, 'r')
-				timestamp_images_datetime = timestamp_image_formatter(timestamp_image_file)
-				timestamp_image_file_list.append(timestamp_images_datetime)
-				print('  Image timestamps found - {}'.format(image_timestamp_file))
-			except:
-				pass
+	# closest frames to the start/end of every trial, for every camera
+	segment_starts, segment_ends = trial_segments(df, trial_start_timestamps, trial_end_timestamps, delay_only)
+	frame_bounds = trial_frame_bounds(camera_frame_indexes, segment_starts, segment_ends)
 
+	# logs are written in trial order while the videos are only planned
+	# (encoded afterwards, in parallel, for every camera at once)
+	jobs = {}
+	for cam_num in range(num_cameras):
+		cam_name = 'cam{}'.format(cam_num)
 		# Log file
 		log_file = open (os.path.join(VIDEO_SAVE_PATH, 'log_{}.txt'.format(cam_name)), 'w')
 		log_file.write('# Logs for video files' + '\n')
 		log_file.write('## trial_index, trial_start, frame_start, start_diff' + '\n')
 
 		tqdm.pandas(desc='Trial Number') # tqdm pandas progress bar
-		print('Starting video generation...')
-		df[cam_name] = df.progress_apply(img_to_vid,
+		print('Finding {} frames...'.format(cam_name))
+		videos = df.progress_apply(img_to_vid,
 						delay_only=delay_only,
-						trial_start_timestamps=trial_start_timestamps,
-						trial_end_timestamps=trial_end_timestamps,
+						segment_starts=segment_starts,
+						segment_ends=segment_ends,
+						frame_bounds=frame_bounds[cam_name],
 						IMAGES_FOLDER=IMAGES_FOLDER, 
 						VIDEO_SAVE_PATH=VIDEO_SAVE_PATH,
 						DATE=DATE,
 						MONKEY=MONKEY,
 						cam_name=cam_name,
-						images_cam_list=images_cam_list,
-						timestamp_images_datetime=timestamp_images_datetime,
-						timestamp_image_file_list=timestamp_image_file_list,
-						specified_folder_path_list=specified_folder_path_list,
+						manifest_list=camera_manifests[cam_name],
+						specified_folder_path_list=camera_folders[cam_name],
 						log_file=log_file, 
+						encode=False,
 						axis=1)
-		print('{} videos complete.'.format(cam_name))
+		df[cam_name] = [video_name for video_name, _ in videos]
+		jobs[cam_name] = [job for _, job in videos]
 		log_file.close()
 
+	# (trial, camera) jobs in trial order
+	trial_jobs = [job for trial_cam_jobs in zip(*jobs.values()) for job in trial_cam_jobs if job is not None]
+	manifests = dict(folder_manifests)
+	if from_session_video:
+		print('Finding session videos...')
+		keys = sorted(set((job[1], job[2]) for job in trial_jobs))
+		videos = session_videos(keys, manifests, os.path.join(VIDEO_SAVE_PATH, 'session_videos'), workers)
+		encode_videos(trial_jobs, manifests, workers, videos)
+	else:
+		encode_videos(trial_jobs, manifests, workers)
+	print('Videos complete.')
+
 	# dump pickle file
 	with open (os.path.join(VIDEO_SAVE_PATH, 'session_df.pkl'), 'wb') as f:
 		pickle.dump(df, f)
@@ -2,14 +2,19 @@ import os
 import sys
 import h5py
 import time
-import pickle
+import uuid
 import pandas as pd
 import ipywidgets as widgets
 from datetime import date, timedelta
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from IPython.display import display
 
-from session_parse_helper import session_parser
+from session_parse_helper import session_parser, iter_session_parser, code_mappings, BATCH_SIZE
+from ragged import signals_to_columns
+from session_store import save_sessions, store_name, load_session, SessionStoreWriter
+from ingest_cache import IngestCache, CACHE_FOLDER
+from profiling import stage, profiled, record, detach
 
 def h5_pull(current_dir):
   """Look for all .h5 extension files in directory"""
@@ -23,6 +28,23 @@ def h5_load(file_name):
   f = h5py.File(file_name, 'r')
   return f
 
+def h5_load_config(file_name):
+  """Copies the MLConfig and TrialRecord groups of an .h5 file into memory and closes the file
+
+  Returns:
+    ml_config:
+      in-memory .h5 group containing MonkeyLogic configuration parameters
+    trial_record:
+      in-memory .h5 group containing MonkeyLogic trial_record
+  """
+  # (core driver without a backing store: never written to disk)
+  memory_file = h5py.File('{}.{}'.format(os.path.basename(file_name), uuid.uuid4().hex), 'w',
+                          driver='core', backing_store=False)
+  with h5py.File(file_name, 'r') as f:
+    f.copy(f['ML']['MLConfig'], memory_file, 'MLConfig')
+    f.copy(f['ML']['TrialRecord'], memory_file, 'TrialRecord')
+  return memory_file['MLConfig'], memory_file['TrialRecord']
+
 def h5_parse(f):
   """Parses out groups and subgroups from .h5 tree
 
@@ -90,30 +112,6 @@ def trial_record_viewer(trial_record):
   w.observe(on_change)
   display(w)
 
-def pickler(save_df, save_path, session_df, monkey_input, experiment_name,
-            error_dict, behavioral_code_dict):
-  """Pickles each session (by date)"""
-  if save_df:
-    session_dict = {}
-    print('Saving .pickle files to: {}'.format(save_path))
-    all_dates = session_df['date'].unique()
-    for date in all_dates:
-      date_df = session_df[session_df['date']==date]
-      file_name = '_'.join([date,monkey_input,experiment_name,'behave.pkl'])
-      if os.path.exists(save_path) == False:
-        os.mkdir(save_path)
-      file_path_save = os.path.join(save_path, file_name)
-      with open(file_path_save, 'wb') as handle:
-        t0 = time.time()
-        print('  Pickling {}'.format(file_name))
-        session_dict['data_frame'] = date_df
-        session_dict['error_dict'] = error_dict
-        session_dict['behavioral_code_dict'] = behavioral_code_dict
-        pickle.dump(session_dict, handle, protocol=4) # google colab only supports protocol 4
-        t1 = time.time()
-        total_t = round(t1-t0, 4)
-        print('    Total time to pickle: {} sec'.format(total_t))
-
 def date_selector(start_date, end_date):
   """Selects dates from colab forms input"""
   all_selected_dates = [] # array containing all dates
@@ -144,8 +142,110 @@ def file_selector(file_dir, all_selected_dates, monkey_input):
           dates_array.append(date_formatted)
     return files_selected, dates_array
 
-def h5_to_df(current_path, target_path, h5_filenames, start_date, end_date, monkey_input, save_df):
-  """Converts specified (by date) .h5 files to DataFrame and pickles 
+@profiled()
+def h5_parse_file(file_path, date_input, monkey_input):
+  """Parses a single .h5 file into columnar session data
+
+  Opens, parses and closes the file so that it can be run inside
+  a worker process (h5py objects cannot be sent between processes).
+
+  Args:
+    file_path:
+      full path to the .h5 file
+    date_input:
+      date (YYMMDD) of the session
+    monkey_input:
+      name of monkey
+
+  Returns:
+    session_dict:
+      dictionary containing all specified session data (column -> values)
+    error_dict:
+      dictionary containing error mapping
+    behavioral_code_dict:
+      dictionary containing behavioral code mapping
+    experiment_name:
+      MonkeyLogic experiment name
+    parse_time:
+      time (in seconds) to parse the file
+  """
+  t0 = time.time()
+  f = h5_load(file_path)
+  try:
+    ml_config, trial_record, trial_list = h5_parse(f)
+    with stage('session_parser', rows=len(trial_list)):
+      session_dict, error_dict, behavioral_code_dict = \
+        session_parser(f, trial_list, trial_record, date_input, monkey_input)
+    experiment_name = ml_config['ExperimentName'][...].tolist().decode()
+  finally:
+    f.close()
+  parse_time = round(time.time()-t0, 4)
+  return dict(session_dict), error_dict, behavioral_code_dict, experiment_name, parse_time
+
+def h5_stream_files(file_paths, file_dates, monkey_input, target_path, batch_size=BATCH_SIZE):
+  """Parses .h5 files straight into the session store, <batch_size> trials at a time
+
+  Only one batch of trials is held in memory, so peak memory depends on
+  batch_size instead of the session length. Files with the same date are
+  appended to the same processed session (as in save_sessions).
+
+  Args:
+    file_paths:
+      full paths to the .h5 files
+    file_dates:
+      date (YYMMDD) of each session
+    monkey_input:
+      name of monkey
+    target_path:
+      session store directory
+    batch_size:
+      number of trials parsed and written at a time
+
+  Returns:
+    store_paths:
+      processed session directories (in file order)
+    error_dict:
+      dictionary containing error mapping
+    behavioral_code_dict:
+      dictionary containing behavioral code mapping
+    experiment_name:
+      MonkeyLogic experiment name
+  """
+  writers = {}
+  try:
+    for file_path, date_input in zip(file_paths, file_dates):
+      t0 = time.time()
+      print('  {}'.format(file_path))
+      f = h5_load(file_path)
+      try:
+        with stage('h5_stream_file') as trace:
+          ml_config, trial_record, trial_list = h5_parse(f)
+          trace['rows'] = len(trial_list)
+          experiment_name = ml_config['ExperimentName'][...].tolist().decode()
+          error_dict, behavioral_code_dict = code_mappings(trial_record)
+          store_path = os.path.join(target_path, store_name(date_input, monkey_input, experiment_name))
+          if store_path not in writers:
+            writers[store_path] = SessionStoreWriter(store_path, error_dict, behavioral_code_dict)
+          writer = writers[store_path]
+          # mappings are taken from the last file (as in h5_to_df)
+          writer.error_dict, writer.behavioral_code_dict = error_dict, behavioral_code_dict
+          for session_dict in iter_session_parser(f, trial_list, trial_record, date_input, monkey_input, batch_size):
+            writer.append(pd.DataFrame.from_dict(signals_to_columns(session_dict)))
+      finally:
+        f.close()
+      print('    Parsed and saved in {} sec'.format(round(time.time()-t0, 4)))
+    for writer in writers.values():
+      writer.close()
+  except:
+    for writer in writers.values():
+      writer.abort()
+    raise
+  return list(writers.keys()), error_dict, behavioral_code_dict, experiment_name
+
+@profiled()
+def h5_to_df(current_path, target_path, h5_filenames, start_date, end_date, monkey_input, save_df,
+             num_workers=1, use_cache=True, batch_size=None):
+  """Converts specified (by date) .h5 files to DataFrame and saves them to the session store
 
   Args:
     current_path: 
@@ -159,13 +259,25 @@ def h5_to_df(current_path, target_path, h5_filenames, start_date, end_date, monk
     monkey_input: 
       name of monkey (specified in monkey_behavior.ipynb)
     save_df: 
-      boolean specifying whether or not to pickle resulting DataFrames (specified in monkey_behavior.ipynb)
+      boolean specifying whether or not to save resulting DataFrames to the session store (specified in monkey_behavior.ipynb)
+    num_workers:
+      number of processes used to parse the .h5 files (default: 1, parses serially
+      in the current process; None uses all available cores)
+    use_cache:
+      boolean specifying whether or not to reuse previously parsed files that have not
+      changed (cached in <target_path>/.ingest_cache, keyed on path, size, mtime and
+      session_parse_helper.PARSER_VERSION)
+    batch_size:
+      number of trials parsed at a time (default: None, parses whole files). When set,
+      files are streamed to the session store (see h5_stream_files) and session_df
+      is loaded back from it memory-mapped, so no file is ever fully held in memory
 
   Returns:
     ml_config:
-      .h5 group containing MonkeyLogic configuration parameters
+      .h5 group containing MonkeyLogic configuration parameters (in-memory copy
+      from the last file, see h5_load_config)
     trial_record:
-      .h5 group containing MonkeyLogic trial_record
+      .h5 group containing MonkeyLogic trial_record (in-memory copy from the last file)
     session_df:
       DataFrame containing all sessions captured
     error_dict:
@@ -173,13 +285,15 @@ def h5_to_df(current_path, target_path, h5_filenames, start_date, end_date, monk
   """
   all_selected_dates = date_selector(start_date, end_date)
   h5_files_selected, dates_array = file_selector(h5_filenames, all_selected_dates, monkey_input)
-  python_converted_files = []
+  file_paths = []
+  file_dates = []
   if h5_files_selected:
     print('Loading selected file(s):')
-    for f in h5_files_selected:
+    for f_index, f in enumerate(h5_files_selected):
       file_name = os.path.join(current_path, f)
       if os.path.exists(file_name):
-        python_converted_files.append(h5_load(file_name))
+        file_paths.append(file_name)
+        file_dates.append(dates_array[f_index])
         print('  {} - Completed'.format(f))
       else:
         print('  {} - Missing'.format(f))
@@ -190,21 +304,63 @@ def h5_to_df(current_path, target_path, h5_filenames, start_date, end_date, monk
       raise RuntimeError('No file found - check directory')
 
   print('Converting .h5 to python:')
-  if python_converted_files:
-    for f_index, f in enumerate(python_converted_files):
-      print('  {}'.format(f))
-      ml_config, trial_record, trial_list = h5_parse(f)
-      session_dict, error_dict, behavioral_code_dict = \
-        session_parser(f, trial_list, trial_record, dates_array[f_index], monkey_input)
-      if f_index == 0:
-        session_df = pd.DataFrame.from_dict(session_dict) # convert dictionary to pd.DataFrame
+  if file_paths and batch_size is not None:
+    print('  Streaming {} trials at a time to: {}'.format(batch_size, target_path))
+    store_paths, error_dict, behavioral_code_dict, experiment_name = \
+      h5_stream_files(file_paths, file_dates, monkey_input, target_path, batch_size)
+    session_df = pd.concat([load_session(store_path)[0] for store_path in store_paths], ignore_index=True)
+
+    ml_config, trial_record = h5_load_config(file_paths[-1])
+  elif file_paths:
+    # parsed_files: (session_df, error_dict, behavioral_code_dict, experiment_name, parse_time)
+    parsed_files = [None] * len(file_paths)
+    cache = IngestCache(os.path.join(target_path, CACHE_FOLDER)) if use_cache else None
+    parse_indices = []
+    for f_index, file_path in enumerate(file_paths):
+      cached_file = cache.get(file_path) if cache else None
+      if cached_file is None:
+        parse_indices.append(f_index)
       else:
-        session_df_new = pd.DataFrame.from_dict(session_dict)
-        session_df = session_df.append(session_df_new, ignore_index=True)
-    experiment_name = ml_config['ExperimentName'][...].tolist().decode()
+        parsed_files[f_index] = cached_file + (0,)
+        print('  {} - unchanged, loaded from cache'.format(os.path.basename(file_path)))
+    def add_parsed_file(f_index, parsed_file):
+      session_dict, error_dict, behavioral_code_dict, experiment_name, parse_time = parsed_file
+      # (analog signals are kept as per-trial views into each file's RaggedArray buffers)
+      session_df = pd.DataFrame.from_dict(signals_to_columns(session_dict))
+      parsed_files[f_index] = (session_df, error_dict, behavioral_code_dict, experiment_name, parse_time)
+      if cache:
+        cache.put(file_paths[f_index], session_df, error_dict, behavioral_code_dict, experiment_name)
+    if num_workers == 1 or len(parse_indices) <= 1:
+      for f_index in parse_indices:
+        print('  {}'.format(file_paths[f_index]))
+        add_parsed_file(f_index, h5_parse_file(file_paths[f_index], file_dates[f_index], monkey_input))
+        print('    Parsed in {} sec'.format(parsed_files[f_index][-1]))
+    else:
+      print('  Parsing {} files in parallel...'.format(len(parse_indices)))
+      # (stages parsed in the workers are recorded from their parse_time)
+      with ProcessPoolExecutor(max_workers=num_workers, initializer=detach) as executor:
+        futures = {executor.submit(h5_parse_file, file_paths[f_index], file_dates[f_index], monkey_input): f_index
+                   for f_index in parse_indices}
+        for future in as_completed(futures):
+          f_index = futures[future]
+          add_parsed_file(f_index, future.result())
+          record('h5_parse_file', parsed_files[f_index][-1], rows=len(parsed_files[f_index][0]))
+          print('  {} - parsed in {} sec'.format(os.path.basename(file_paths[f_index]),
+                                                 parsed_files[f_index][-1]))
+    if cache:
+      cache.save()
+      cache.report()
+    # single concatenation (in file order) instead of repeated appends
+    session_df = pd.concat([parsed_file[0] for parsed_file in parsed_files], ignore_index=True)
+    # mappings and experiment name are taken from the last file (as before)
+    _, error_dict, behavioral_code_dict, experiment_name, _ = parsed_files[-1]
+    total_parse_time = round(sum(parsed_file[-1] for parsed_file in parsed_files), 4)
+    print('  Total parse time: {} sec ({} files parsed)'.format(total_parse_time, len(parse_indices)))
+
+    ml_config, trial_record = h5_load_config(file_paths[-1])
 
-    pickler(save_df, target_path, session_df, monkey_input, experiment_name,
-            error_dict, behavioral_code_dict) # pickles individual session
+    save_sessions(save_df, target_path, session_df, monkey_input, experiment_name,
+                  error_dict, behavioral_code_dict) # saves individual session
   else:
       raise RuntimeError('No .h5 files found for selected dates')
 
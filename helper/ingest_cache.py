@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import session_store
+from session_parse_helper import PARSER_VERSION
+
+CACHE_FOLDER = '.ingest_cache'
+MANIFEST_FILE = 'manifest.json'
+
+def file_fingerprint(file_path):
+	'''
+	Cache key for a .h5 file: hash of its path, size, modification
+	time and the session_parser version that produced the cached data
+	'''
+	file_stat = os.stat(file_path)
+	fingerprint = '|'.join([os.path.abspath(file_path), str(file_stat.st_size),
+													str(file_stat.st_mtime_ns), str(PARSER_VERSION)])
+	return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+class IngestCache:
+	'''
+	Content-addressed cache of parsed .h5 files. Each entry is one
+	parsed file saved in the session store format under
+	<cache_path>/<key>/, and manifest.json keeps track of the source
+	file and when the entry was last used.
+
+	Args:
+		cache_path (str): cache directory (i.e. <TARGET_PATH>/.ingest_cache)
+		max_entries (int): least recently used entries beyond this are evicted
+	'''
+	def __init__(self, cache_path, max_entries=500):
+		self.cache_path = cache_path
+		self.max_entries = max_entries
+		self.manifest_path = os.path.join(cache_path, MANIFEST_FILE)
+		self.hits = []
+		self.misses = []
+		self.evicted = []
+		self.manifest = {}
+		if os.path.exists(self.manifest_path):
+			with open(self.manifest_path, 'r') as f:
+				self.manifest = json.load(f)
+
+	def entry_path(self, key):
+		return os.path.join(self.cache_path, key)
+
+	def get(self, file_path):
+		'''
+		Returns the cached (session_df, error_dict, behavioral_code_dict,
+		experiment_name) for file_path, or None if the file is new or
+		has changed since it was cached
+		'''
+		key = file_fingerprint(file_path)
+		entry = self.manifest.get(key)
+		if entry is None or not session_store.is_session_store(self.entry_path(key)):
+			self.misses.append(file_path)
+			return None
+		session_df, error_dict, behavioral_code_dict = session_store.load_session(self.entry_path(key))
+		entry['last_used'] = time.time()
+		self.hits.append(file_path)
+		return session_df, error_dict, behavioral_code_dict, entry['experiment_name']
+
+	def put(self, file_path, session_df, error_dict, behavioral_code_dict, experiment_name):
+		'''Saves a freshly parsed file to the cache'''
+		key = file_fingerprint(file_path)
+		session_store.save_session(session_df, self.entry_path(key), error_dict, behavioral_code_dict)
+		self.manifest[key] = {
+			'file_path': os.path.abspath(file_path),
+			'parser_version': PARSER_VERSION,
+			'experiment_name': experiment_name,
+			'created': time.time(),
+			'last_used': time.time(),
+		}
+
+	def evict(self):
+		'''
+		Removes entries whose source file has been modified, moved or
+		deleted, entries written by an older parser version and, beyond
+		max_entries, the least recently used entries
+		'''
+		stale_keys = []
+		for key, entry in self.manifest.items():
+			file_path = entry['file_path']
+			if entry['parser_version'] != PARSER_VERSION or not os.path.exists(file_path) or \
+					file_fingerprint(file_path) != key:
+				stale_keys.append(key)
+		current_keys = sorted(set(self.manifest) - set(stale_keys),
+													key=lambda key: self.manifest[key]['last_used'], reverse=True)
+		stale_keys += current_keys[self.max_entries:]
+		for key in stale_keys:
+			self.manifest.pop(key)
+			shutil.rmtree(self.entry_path(key), ignore_errors=True)
+			self.evicted.append(key)
+
+	def save(self):
+		'''Evicts stale entries and writes the manifest'''
+		self.evict()
+		if os.path.exists(self.cache_path) == False:
+			os.makedirs(self.cache_path)
+		with open(self.manifest_path, 'w') as f:
+			json.dump(self.manifest, f, indent=1)
+
+	def report(self):
+		print('  Ingest cache: {} hit(s), {} miss(es), {} evicted'.format(
+			len(self.hits), len(self.misses), len(self.evicted)))
+		for file_path in self.misses:
+			print('    parsed: {}'.format(os.path.basename(file_path)))
@@ -0,0 +1,163 @@
+import time
+import h5py
+import pandas as pd
+from itertools import chain
+
+from session_parse_helper import session_info, code_mappings, read_user_fields, trial_parser
+from ragged import signals_to_columns
+from add_fields import iter_add_fields
+from Session import Session
+
+POLL_INTERVAL = 0.25		# seconds between checks for new trials
+MIN_SESSION_TRIALS = 5	# Session.find_offscreen_values uses the first 5 trials
+
+def trial_names(ml_group):
+	'''TrialN groups of the ML group, in trial order'''
+	trial_list = [name for name in ml_group.keys() if name.startswith('Trial') and name[5:].isdigit()]
+	return sorted(trial_list, key=lambda name: int(name[5:]))
+
+def trial_group_datasets(ml_group, trial_list):
+	'''
+	Dataset ids of each trial (see session_parse_helper.cache_trial_datasets),
+	visiting only the listed trial groups instead of the whole ML group
+	'''
+	trial_datasets = []
+	for trial in trial_list:
+		trial_id = ml_group[trial].id
+		datasets = {}
+		def visit_dataset(name, info):
+			if info.type == h5py.h5o.TYPE_DATASET:
+				datasets[name.decode()] = h5py.h5d.open(trial_id, name)
+		h5py.h5o.visit(trial_id, visit_dataset, info=True)
+		trial_datasets.append(datasets)
+	return trial_datasets
+
+class SessionTail:
+	'''
+	Follows a MonkeyLogic .h5 file that is still being recorded and parses
+	only the trials added since the last poll.
+
+	MonkeyLogic adds a new TrialN group for every trial, which SWMR does not
+	allow (SWMR readers only see appends to existing datasets), so the file
+	is reopened (without file locking) on every poll instead. A poll that
+	catches the writer mid-trial (missing datasets, User variables not yet
+	updated, unreadable file) is simply retried on the next poll.
+
+	Args:
+		file_path (str): .h5 file being recorded
+		date_input (str): date (YYMMDD) of the session
+		monkey_input (str): name of monkey
+	'''
+	def __init__(self, file_path, date_input, monkey_input):
+		self.file_path = file_path
+		self.date_input = date_input
+		self.monkey_input = monkey_input
+		self.num_trials = 0
+		self.error_dict = None
+		self.behavioral_code_dict = None
+		self.parse_time = 0
+
+	def poll(self):
+		'''
+		Parses the trials written since the last poll
+
+		Returns:
+			batch_df (DataFrame): session_df rows of the new trials (indexed by
+				trial in the session), or None if there are no (complete) new trials
+		'''
+		try:
+			f = h5py.File(self.file_path, 'r', locking=False)
+		except OSError:
+			return None # file is being written
+		try:
+			t0 = time.time()
+			trial_list = trial_names(f['ML'])
+			trial_record = f['ML']['TrialRecord']
+			# User variables are updated at the end of each trial
+			user_values = read_user_fields(trial_record, None)
+			num_complete = min([len(trial_list)] + [len(values) for values in user_values.values()])
+			if num_complete <= self.num_trials:
+				return None
+			if self.behavioral_code_dict is None:
+				self.error_dict, self.behavioral_code_dict = code_mappings(trial_record)
+			trial_datasets = trial_group_datasets(f['ML'], trial_list[self.num_trials:num_complete])
+			session_dict = session_info(f, self.date_input, self.monkey_input)
+			session_dict = trial_parser(trial_datasets, user_values, session_dict, self.num_trials)
+		except (KeyError, OSError, RuntimeError, ValueError):
+			return None # trial group is being written
+		finally:
+			f.close()
+		batch_df = pd.DataFrame.from_dict(signals_to_columns(session_dict))
+		batch_df.index = pd.RangeIndex(self.num_trials, num_complete)
+		self.num_trials = num_complete
+		self.parse_time = time.time() - t0
+		return batch_df
+
+	def batches(self, idle_timeout=None, poll_interval=POLL_INTERVAL):
+		'''
+		Yields each batch of new trials as soon as it is written, until no
+		trial has been added for idle_timeout seconds (default: forever)
+		'''
+		last_trial_time = time.time()
+		while idle_timeout is None or time.time() - last_trial_time < idle_timeout:
+			batch_df = self.poll()
+			if batch_df is None:
+				time.sleep(poll_interval)
+				continue
+			last_trial_time = time.time()
+			yield batch_df
+
+class LiveSession:
+	'''
+	Near-real-time lick/blink/valence summaries of a session while it is
+	being recorded: new trials are parsed by SessionTail, run through
+	add_fields.iter_add_fields and added to the running session metrics
+	(session_obj.stats, see running_stats.SessionStats).
+
+	Args:
+		file_path (str): .h5 file being recorded
+		date_input (str): date (YYMMDD) of the session
+		monkey_input (str): name of monkey
+		task (str): task name (for the Session object)
+		columns (list): derived columns to add (default: all, see add_fields)
+	'''
+	def __init__(self, file_path, date_input, monkey_input, task='', columns=None):
+		self.tail = SessionTail(file_path, date_input, monkey_input)
+		self.monkey_input = monkey_input
+		self.task = task
+		self.columns = columns
+		self.session_obj = None
+
+	def summary(self):
+		'''Running per-valence lick/blink summary (correct trials)'''
+		return self.session_obj.stats.behavior['valence'].to_df().round(3)
+
+	def run(self, idle_timeout=None, poll_interval=POLL_INTERVAL, verbose=True):
+		'''
+		Follows the session until no trial has been added for idle_timeout
+		seconds (default: until interrupted)
+
+		Yields:
+			batch_df (DataFrame): session_df rows (with derived fields) of each new batch
+		'''
+		batches = self.tail.batches(idle_timeout, poll_interval)
+		# the Session object needs the first few trials
+		first_batches = []
+		for batch_df in batches:
+			first_batches.append(batch_df)
+			if sum(len(first_df) for first_df in first_batches) >= MIN_SESSION_TRIALS:
+				break
+		if not first_batches:
+			return
+		first_df = pd.concat(first_batches)
+		self.session_obj = Session(first_df, self.monkey_input, self.task, self.tail.behavioral_code_dict)
+		for batch_df in iter_add_fields(chain([first_df], batches), self.session_obj,
+																		self.tail.behavioral_code_dict, self.columns):
+			# the first trials are already in session_obj.stats
+			if batch_df.index[0] >= len(first_df):
+				self.session_obj.update_stats(batch_df)
+			if verbose:
+				print('  Trials {}-{} (parsed in {} sec)'.format(
+					batch_df.index[0]+1, batch_df.index[-1]+1, round(self.tail.parse_time, 3)))
+				print(self.summary().to_string())
+			yield batch_df
@@ -8,6 +8,7 @@ from sklearn.neighbors import KernelDensity
 from itertools import combinations, permutations
 # Custom modules
 from two_sample_test import generate_data_dict
+from plot_helper import welch_test
 
 def ks_test(df, session_obj):
 	"""
@@ -29,6 +30,16 @@ def ks_test(df, session_obj):
 	measure_labels = ['Lick', 'Blink']
 	for m_index, m_label in enumerate(measure_labels):
 		prob_combinations = list(combinations(measure_data[m_index].values(), 2))
+		# Welch t-test of every valence pair at once
+		data_list = [np.asarray(data, dtype=float) for data in measure_data[m_index].values()]
+		pairs = list(combinations(range(len(data_list)), 2))
+		index_a = [pair[0] for pair in pairs]
+		index_b = [pair[1] for pair in pairs]
+		data_mean = np.array([np.mean(data) for data in data_list])
+		data_var = np.array([np.var(data, ddof=1) for data in data_list])
+		data_len = np.array([len(data) for data in data_list])
+		t_stat, t_p_val = welch_test(data_mean[index_a], data_var[index_a], data_len[index_a],
+																 data_mean[index_b], data_var[index_b], data_len[index_b])
 		print(m_label)
 		for f_index, valence in enumerate(valence_combinations):
 			prob = prob_combinations[f_index]
@@ -36,7 +47,10 @@ def ks_test(df, session_obj):
 			valence_1, valence_2 = LABELS[valence[0]], LABELS[valence[1]]
 			ks_string = round(ks_stat, 2)
 			p_val_string = '%.2E' % Decimal(p_val)
-			print('  {} vs {}: ks_stat: {}, p_val: {}'.format(valence_1, valence_2, ks_string, p_val_string))
+			t_string = round(t_stat[f_index], 2)
+			t_p_val_string = '%.2E' % Decimal(t_p_val[f_index])
+			print('  {} vs {}: ks_stat: {}, p_val: {} | t_stat: {}, p_val: {}'.format(
+				valence_1, valence_2, ks_string, p_val_string, t_string, t_p_val_string))
 
 def measure_hist(df, session_obj):
 	"""
@@ -4,42 +4,37 @@ import numpy as np
 import pandas as pd
 from pprint import pprint
 import matplotlib.pyplot as plt
-from collections import defaultdict
 # custom functions
 from plot_helper import moving_avg
+from session_summary import summarize_sessions, summary_mean
 
-def add_outcome_data(trial, measure_dict, measure):
-	valence = trial['valence']
-	condition = trial['condition']
-	outcome_data = np.nanmean(trial[measure])
-	fractal_count = trial['fractal_count_in_block']
-	measure_dict[condition][fractal_count].append(outcome_data)
-	# print(valence, condition, fractal_count, outcome_data)
-	return measure_dict
+# per-trial measures plotted (np.nanmean of each trial, see session_summary.trial_nanmean)
+OUTCOME_MEASURES = ['lick_count_window', 'blink_duration_offscreen']
 
-def outcome_over_time(df, session_obj):
+def outcome_over_time(df, session_obj, summary=None):
 	"""
 	Plots the average number of blinks and licks over a session
+
+	Args:
+		df: session_df DataFrame (one or more sessions)
+		session_obj: Session object
+		summary: summary table of df (see session_summary.summarize_sessions or
+			SummaryCache), computed from df if None
 	"""
 	FIGURE_SAVE_PATH = session_obj.figure_path
 	avg_window = 10 # N trial rolling avg
+	if summary is None:
+		summary = summarize_sessions(df, measures=OUTCOME_MEASURES)
 	f, axarr = plt.subplots(2, 1, sharey=True, figsize=(10, 7))
-	for v_index, valence in enumerate(sorted(df['valence'].unique(), reverse=True)):
-		df_valence = df[df['valence'] == valence]
-		lick_dict = defaultdict(lambda: defaultdict(list))
-		blink_dict = defaultdict(lambda: defaultdict(list))	
-		# Add each date to lick/blink dicts
-		for date in sorted(df['date'].unique()):
-			df_date = df_valence[df_valence['date'] == date]
-			for index, trial in df_date.iterrows():
-				lick_dict = add_outcome_data(trial, lick_dict, 'lick_count_window')
-				blink_dict = add_outcome_data(trial, blink_dict, 'blink_duration_offscreen')
-		measure_dicts = [lick_dict, blink_dict]
-		for m_index, measure_dict in enumerate(measure_dicts):
-			measure_array_1 = moving_avg(list(map(lambda x: np.nanmean(x), measure_dict[1].values())),
-																avg_window)
-			measure_array_2 = moving_avg(list(map(lambda x: np.nanmean(x), measure_dict[2].values())),
-																avg_window)
+	for v_index, valence in enumerate(sorted(summary['valence'].unique(), reverse=True)):
+		summary_valence = summary[summary['valence'] == valence]
+		for m_index, measure in enumerate(OUTCOME_MEASURES):
+			# average over all dates of each fractal presentation number in each condition
+			measure_mean = summary_mean(summary_valence, ['condition', 'fractal_count_in_block'], measure)
+			condition_means = [measure_mean[measure_mean.index.get_level_values('condition') == condition].values
+												 for condition in [1, 2]]
+			measure_array_1 = moving_avg(condition_means[0], avg_window)
+			measure_array_2 = moving_avg(condition_means[1], avg_window)
 			measure_array = list(measure_array_1) + list(measure_array_2)
 			color=session_obj.valence_colors[valence]
 			x_range = np.arange(0, len(measure_array))+avg_window
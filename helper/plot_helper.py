@@ -1,9 +1,10 @@
 import numpy as np
 import pandas as pd
-from scipy import signal
+from scipy import signal, stats
 import matplotlib.pyplot as plt
 import plotly.graph_objects as go
 from collections import defaultdict
+from itertools import combinations
 from scipy.interpolate import make_interp_spline, BSpline
 
 def moving_avg(data, N):
@@ -20,11 +21,90 @@ def moving_var(data, N):
 	moving_avg calculates the moving variance
 	given window N
 	'''
-	mv_vec = []
-	data_vec = np.insert(data, 0, 0)
-	for i in range(len(data_vec[N:])):
-		mv_vec.append(np.std(data_vec[i:i+N]))
-	return np.array(mv_vec)
+	data_vec = np.insert(np.asarray(data, dtype=float), 0, 0)
+	_, var_vec = rolling_stats(data_vec, N)
+	return np.sqrt(var_vec[:len(data_vec)-N])
+
+def rolling_stats(data, N, ddof=0):
+	'''
+	rolling_stats calculates the moving mean and variance
+	of every window of N samples along the last axis from
+	cumulative sums of x and x^2 (windows containing a
+	np.nan sample are np.nan)
+	'''
+	data = np.asarray(data, dtype=float)
+	if data.shape[-1] < N:
+		empty = np.zeros(data.shape[:-1] + (0,))
+		return empty, empty.copy()
+	nan_mask = np.isnan(data)
+	# shifting by the mean keeps x^2 sums small (less cancellation)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		count = np.sum(~nan_mask, axis=-1, keepdims=True)
+		shift = np.where(count > 0, np.sum(np.where(nan_mask, 0, data), axis=-1, keepdims=True) / count, 0)
+	centered = np.where(nan_mask, 0, data - shift)
+	zeros = np.zeros(data.shape[:-1] + (1,))
+	cumsum_vec = np.concatenate([zeros, np.cumsum(centered, axis=-1)], axis=-1)
+	cumsum_sq_vec = np.concatenate([zeros, np.cumsum(centered**2, axis=-1)], axis=-1)
+	cumsum_nan_vec = np.concatenate([zeros, np.cumsum(nan_mask, axis=-1)], axis=-1)
+	window_sum = cumsum_vec[..., N:] - cumsum_vec[..., :-N]
+	window_sum_sq = cumsum_sq_vec[..., N:] - cumsum_sq_vec[..., :-N]
+	window_nan = cumsum_nan_vec[..., N:] - cumsum_nan_vec[..., :-N]
+	mean_vec = shift + window_sum / N
+	with np.errstate(invalid='ignore'):
+		var_vec = (window_sum_sq - window_sum**2 / N) / (N - ddof)
+		# constant windows: anything below the cancellation noise is 0
+		constant = var_vec <= 8 * N * np.finfo(float).eps * window_sum_sq / (N - ddof)
+	var_vec[constant] = 0
+	# the mean of a constant window is its first sample (exact, so equal means compare equal)
+	mean_vec = np.where(constant, data[..., :mean_vec.shape[-1]], mean_vec)
+	mean_vec[window_nan > 0] = np.nan
+	var_vec[window_nan > 0] = np.nan
+	return mean_vec, var_vec
+
+def welch_test(mean_a, var_a, n_a, mean_b, var_b, n_b):
+	'''
+	welch_test calculates the Welch (unequal variance) t-test
+	from sample means and variances (ddof=1), element-wise
+	(same as scipy.stats.ttest_ind(a, b, equal_var=False))
+	'''
+	se_a = np.asarray(var_a, dtype=float) / n_a
+	se_b = np.asarray(var_b, dtype=float) / n_b
+	mean_diff = np.asarray(mean_a, dtype=float) - np.asarray(mean_b, dtype=float)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		t = mean_diff / np.sqrt(se_a + se_b)
+		dof = (se_a + se_b)**2 / (se_a**2 / (n_a - 1) + se_b**2 / (n_b - 1))
+		p = 2 * stats.t.sf(np.abs(t), dof)
+	# both windows constant: p=0 if the means differ, np.nan if they are equal (as scipy)
+	constant = (se_a + se_b) == 0
+	p = np.where(constant & (mean_diff != 0), 0.0, p)[()]
+	return t, p
+
+def moving_welch(data_list, N):
+	'''
+	moving_welch calculates the Welch t-test of every window of
+	N trials for every pair of data arrays at once
+
+	Args:
+		data_list: list of 1D arrays (i.e. one per valence)
+		N: window width
+
+	Returns:
+		pairs: list of (i, j) index pairs (itertools.combinations order)
+		t: (pairs x windows) t statistic (np.nan past the shorter array)
+		p: (pairs x windows) two-sided p values
+		mean_vec: (arrays x windows) moving means
+	'''
+	lengths = [len(data) for data in data_list]
+	data_matrix = np.full((len(data_list), max(lengths + [N])), np.nan)
+	for d_index, data in enumerate(data_list):
+		data_matrix[d_index, :lengths[d_index]] = data
+	mean_vec, var_vec = rolling_stats(data_matrix, N, ddof=1)
+	pairs = list(combinations(range(len(data_list)), 2))
+	index_a = np.array([pair[0] for pair in pairs], dtype=int)
+	index_b = np.array([pair[1] for pair in pairs], dtype=int)
+	t, p = welch_test(mean_vec[index_a], var_vec[index_a], N,
+										mean_vec[index_b], var_vec[index_b], N)
+	return pairs, t, p, mean_vec
 
 def smooth_plot(x, y):
   '''
@@ -3,37 +3,65 @@ import sys
 import pandas as pd
 from pprint import pprint
 import h5_helper
+import session_store
 
-def preprocess_data(h5_filenames, path_obj, start_date, end_date, monkey_input, reprocess_data, save_df):
+def preprocess_data(h5_filenames, path_obj, start_date, end_date, monkey_input, reprocess_data, save_df,
+                    num_workers=1, columns=None, use_cache=True):
+  """
+  Parses the selected .h5 files (reprocess_data=True) or loads the
+  already processed sessions from path_obj.TARGET_PATH
+
+  Args:
+    num_workers: number of processes used to parse the .h5 files
+    use_cache: only parse .h5 files that are new or have changed since they were last parsed
+    columns: only load these session_df columns from processed sessions
+      (default: all columns, ignored when reprocessing)
+  """
   current_path = path_obj.CURRENT_PATH
   target_path = path_obj.TARGET_PATH
   # preprocess data
   if reprocess_data:
     ml_config, trial_record, session_df, error_dict, behavioral_code_dict = \
-      h5_helper.h5_to_df(current_path, target_path, h5_filenames, start_date, end_date, monkey_input, save_df)
+      h5_helper.h5_to_df(current_path, target_path, h5_filenames, start_date, end_date, monkey_input, save_df,
+                         num_workers=num_workers, use_cache=use_cache)
     return ml_config, trial_record, session_df, error_dict, behavioral_code_dict
-  # pickle preprocessed data
+  # load preprocessed data
   else:
     print('\nFiles uploaded from processed folder\n')
     all_selected_dates = h5_helper.date_selector(start_date, end_date)
     target_dir = os.listdir(target_path)
-    pkl_files_selected, dates_array = h5_helper.file_selector(target_dir, all_selected_dates, monkey_input)
-    print('Pickled Files:')
-    pprint(pkl_files_selected)
-    for f_index, f in enumerate(pkl_files_selected):
-      target_pickle = os.path.join(target_path, f)
-      if os.path.exists(target_pickle):
-        session_dict = pd.read_pickle(target_pickle)
-        if f_index == 0:
-          session_df = session_dict['data_frame']
-          error_dict = session_dict['error_dict']
-          behavioral_code_dict = session_dict['behavioral_code_dict']
-        else:
-          session_df_new = session_dict['data_frame']
-          session_df = session_df.append(session_df_new, ignore_index=True)
-          error_dict = session_dict['error_dict']
-          behavioral_code_dict = session_dict['behavioral_code_dict']    
+    files_selected, dates_array = h5_helper.file_selector(target_dir, all_selected_dates, monkey_input)
+    # columnar session store (one directory per date and experiment), falling
+    # back to legacy pickles (<store name>.pkl) that have not been reprocessed
+    processed_files = {}
+    for f, date in zip(files_selected, dates_array):
+      if session_store.is_session_store(os.path.join(target_path, f)):
+        processed_files[(date, f)] = f
+      elif f.endswith('.pkl'):
+        processed_files.setdefault((date, f[:-len('.pkl')]), f)
+    date_order = {date: d_index for d_index, date in enumerate(all_selected_dates)}
+    selected_files = [processed_files[key] for key in sorted(processed_files, key=lambda key: (date_order[key[0]], key[1]))]
+    print('Processed Files:')
+    pprint(selected_files)
+    if not selected_files:
+      print('\nProcessed files missing. Reprocess or check data.')
+      sys.exit()
+    session_df_list = []
+    for f in selected_files:
+      target_file = os.path.join(target_path, f)
+      if session_store.is_session_store(target_file):
+        session_df_new, error_dict, behavioral_code_dict = \
+          session_store.load_session(target_file, columns=columns)
       else:
-        print('\nPickled files missing. Reprocess or check data.')
-        sys.exit()
-    return None, None, session_df, error_dict, behavioral_code_dict
\ No newline at end of file
+        session_df_new, error_dict, behavioral_code_dict = load_pickle(target_file, columns)
+      session_df_list.append(session_df_new)
+    session_df = pd.concat(session_df_list, ignore_index=True)
+    return None, None, session_df, error_dict, behavioral_code_dict
+
+def load_pickle(target_pickle, columns=None):
+  """Loads a legacy (pre-session store) pickled session"""
+  session_dict = pd.read_pickle(target_pickle)
+  session_df = session_dict['data_frame']
+  if columns is not None:
+    session_df = session_df[[column for column in session_df.columns if column in columns]]
+  return session_df, session_dict['error_dict'], session_dict['behavioral_code_dict']
\ No newline at end of file
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import functools
+import contextlib
+
+import pandas as pd
+
+try:
+	import resource
+except ImportError:	# Windows
+	resource = None
+
+TRACE_COLUMNS = ['stage', 'parent', 'depth', 'start', 'seconds', 'rows', 'rss_mb', 'peak_rss_mb']
+
+# active Profiler (stage/record do nothing while it is None)
+_PROFILER = None
+
+def rss_mb():
+	'''Current resident set size (MB), np.nan where /proc is not available'''
+	try:
+		with open('/proc/self/statm', 'r') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+	except (OSError, ValueError, AttributeError):
+		return float('nan')
+
+def peak_rss_mb():
+	'''Peak resident set size of the process so far (MB)'''
+	if resource is None:
+		return float('nan')
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on Linux, bytes on macOS
+	return peak / 1e6 if sys.platform == 'darwin' else peak * 1024 / 1e6
+
+class Profiler:
+	'''
+	Collects a trace of pipeline stages (see stage, profiled and record):
+	wall time, rows processed, and current/peak RSS at the end of each
+	stage. Stages are nested, so a stage's parent is the stage it ran in.
+
+	Usage:
+		with Profiler('trace_230123', profile='cprofile') as profiler:
+			session_obj = Session(df, monkey_input, task, behavioral_code_dict)
+			...
+		# trace_230123.json, trace_230123.csv (and trace_230123.prof)
+
+	Args:
+		trace_path (str): path of the trace without extension (None to keep it in memory)
+		profile (str): also profile the run with 'cprofile' (<trace_path>.prof,
+			pstats format) or 'pyinstrument' (<trace_path>.html), None for neither
+	'''
+	def __init__(self, trace_path=None, profile=None):
+		self.trace_path = trace_path
+		self.profile = profile
+		self.records = []
+		self.stack = []
+		self.profiler = None
+		self.previous = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+		if self.trace_path is not None:
+			self.save(self.trace_path)
+		return False
+
+	def start(self):
+		'''Makes this the active Profiler'''
+		global _PROFILER
+		self.previous = _PROFILER
+		_PROFILER = self
+		if self.profile == 'cprofile':
+			import cProfile
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+		elif self.profile == 'pyinstrument':
+			import pyinstrument
+			self.profiler = pyinstrument.Profiler()
+			self.profiler.start()
+		elif self.profile is not None:
+			raise ValueError('profile must be None, \'cprofile\' or \'pyinstrument\'')
+		self.t0 = time.perf_counter()
+		return self
+
+	def stop(self):
+		global _PROFILER
+		if self.profile == 'cprofile':
+			self.profiler.disable()
+		elif self.profile == 'pyinstrument':
+			self.profiler.stop()
+		_PROFILER = self.previous
+		return self
+
+	def add(self, name, start, seconds, rows=None, rss=None, peak_rss=None):
+		'''Adds a stage record (RSS of this process unless specified)'''
+		record = {'stage': name,
+							'parent': self.stack[-1] if self.stack else '',
+							'depth': len(self.stack),
+							'start': round(start - self.t0, 6),
+							'seconds': round(seconds, 6),
+							'rows': rows,
+							'rss_mb': rss_mb() if rss is None else rss,
+							'peak_rss_mb': peak_rss_mb() if peak_rss is None else peak_rss}
+		self.records.append(record)
+		return record
+
+	def to_df(self):
+		return pd.DataFrame(self.records, columns=TRACE_COLUMNS)
+
+	def summary(self):
+		'''Total time, calls and rows of each stage'''
+		trace_df = self.to_df()
+		return trace_df.groupby('stage', sort=False).agg(
+			calls=('seconds', 'size'), seconds=('seconds', 'sum'), rows=('rows', 'sum'),
+			peak_rss_mb=('peak_rss_mb', 'max')).sort_values('seconds', ascending=False)
+
+	def save(self, trace_path):
+		'''Writes <trace_path>.json and <trace_path>.csv (and the profiler output)'''
+		trace_dir = os.path.dirname(trace_path)
+		if trace_dir and os.path.exists(trace_dir) == False:
+			os.makedirs(trace_dir)
+		with open(trace_path + '.json', 'w') as f:
+			json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+								 'argv': sys.argv,
+								 'stages': json.loads(self.to_df().to_json(orient='records'))}, f, indent=1)
+		self.to_df().to_csv(trace_path + '.csv', index=False)
+		if self.profile == 'cprofile':
+			self.profiler.dump_stats(trace_path + '.prof')
+		elif self.profile == 'pyinstrument':
+			with open(trace_path + '.html', 'w') as f:
+				f.write(self.profiler.output_html())
+		print('  Trace saved to: {}.json'.format(trace_path))
+
+def detach():
+	'''Drops the active Profiler (i.e. in forked worker processes, whose stages would be lost)'''
+	global _PROFILER
+	if _PROFILER is not None and _PROFILER.profile == 'cprofile':
+		_PROFILER.profiler.disable()
+	_PROFILER = None
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+	'''
+	Times a pipeline stage (nothing is recorded without an active Profiler).
+	Yields the stage record, so rows can be set once they are known:
+
+		with stage('session_parser') as trace:
+			...
+			trace['rows'] = len(trial_list)
+	'''
+	profiler = _PROFILER
+	trace = {'rows': rows}
+	if profiler is None:
+		yield trace
+		return
+	profiler.stack.append(name)
+	start = time.perf_counter()
+	try:
+		yield trace
+	finally:
+		seconds = time.perf_counter() - start
+		profiler.stack.pop()
+		profiler.add(name, start, seconds, trace['rows'])
+
+def profiled(name=None):
+	'''
+	Decorator version of stage (rows: length of the first DataFrame argument)
+	'''
+	def decorator(function):
+		stage_name = name or function.__name__
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			if _PROFILER is None:
+				return function(*args, **kwargs)
+			rows = next((len(arg) for arg in args if isinstance(arg, pd.DataFrame)), None)
+			with stage(stage_name, rows):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def record(name, seconds, rows=None, rss=float('nan'), peak_rss=float('nan')):
+	'''
+	Adds a stage timed elsewhere (i.e. in a worker process, along with
+	the worker's RSS) under the current stage
+	'''
+	if _PROFILER is not None:
+		_PROFILER.add(name, time.perf_counter() - seconds, seconds, rows, rss, peak_rss)
@@ -0,0 +1,164 @@
+import numpy as np
+
+# per-trial analog signals parsed from the MonkeyLogic .h5 files
+SIGNAL_COLUMNS = ['eye_x', 'eye_y', 'eye_pupil', 'joystick_x', 'joystick_y', 'lick', 'photodiode']
+
+class RaggedArray:
+	'''
+	Per-trial signals of different lengths stored as one contiguous
+	buffer plus an int64 offsets array, so that trial i spans
+	buffer[offsets[i]:offsets[i+1]]
+
+	Args:
+		buffer (np.ndarray): concatenated signal for all trials
+		offsets (np.ndarray): int64 offsets (length = number of trials + 1)
+	'''
+	def __init__(self, buffer, offsets):
+		self.buffer = np.asarray(buffer)
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		if self.offsets.ndim != 1 or len(self.offsets) == 0:
+			raise ValueError('offsets must be 1-D with length (number of trials + 1)')
+		if self.offsets[-1] > len(self.buffer):
+			raise ValueError('offsets exceed buffer length ({} > {})'.format(self.offsets[-1], len(self.buffer)))
+
+	@classmethod
+	def empty(cls, lengths, dtype=np.float64):
+		'''Allocates an uninitialized RaggedArray with the specified trial lengths'''
+		offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+		np.cumsum(lengths, out=offsets[1:])
+		return cls(np.empty(offsets[-1], dtype=dtype), offsets)
+
+	@classmethod
+	def from_arrays(cls, arrays, dtype=np.float64):
+		'''Builds a RaggedArray (single copy) from a list of 1-D arrays'''
+		lengths = [len(array) for array in arrays]
+		ragged = cls.empty(lengths, dtype=dtype)
+		for t_index, array in enumerate(arrays):
+			ragged[t_index][:] = array
+		return ragged
+
+	@classmethod
+	def from_column(cls, column, dtype=np.float64):
+		'''
+		Builds a RaggedArray from an object column (pd.Series or list) of
+		per-trial arrays. If every trial is a view into the same buffer
+		and the trials are laid out back-to-back (i.e. columns created by
+		to_object_array), the buffer is shared instead of copied.
+		'''
+		arrays = list(column)
+		if len(arrays) == 0:
+			return cls(np.empty(0, dtype=dtype), np.zeros(1, dtype=np.int64))
+		base = arrays[0].base if isinstance(arrays[0], np.ndarray) else None
+		if isinstance(base, np.ndarray) and base.dtype == dtype and base.ndim == 1:
+			itemsize = base.itemsize
+			base_address = base.ctypes.data
+			offsets = np.empty(len(arrays)+1, dtype=np.int64)
+			offsets[0] = (arrays[0].ctypes.data - base_address) // itemsize
+			for t_index, array in enumerate(arrays):
+				if not isinstance(array, np.ndarray) or array.base is not base or \
+						(array.ctypes.data - base_address) // itemsize != offsets[t_index] or \
+						(array.ndim != 1) or (len(array) > 1 and array.strides[0] != itemsize):
+					break
+				offsets[t_index+1] = offsets[t_index] + len(array)
+			else:
+				return cls(base[offsets[0]:offsets[-1]], offsets - offsets[0])
+		return cls.from_arrays(arrays, dtype=dtype)
+
+	@classmethod
+	def concatenate(cls, ragged_list):
+		'''Concatenates RaggedArrays (i.e. multiple sessions) into one'''
+		buffers = [ragged.buffer[ragged.offsets[0]:ragged.offsets[-1]] for ragged in ragged_list]
+		lengths = [np.diff(ragged.offsets) for ragged in ragged_list]
+		offsets = np.zeros(sum(map(len, lengths))+1, dtype=np.int64)
+		if len(offsets) > 1:
+			np.cumsum(np.concatenate(lengths), out=offsets[1:])
+		return cls(np.concatenate(buffers), offsets)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, index):
+		'''Integer index returns a zero-copy view, anything else calls take'''
+		if isinstance(index, (int, np.integer)):
+			if index < 0:
+				index += len(self)
+			return self.buffer[self.offsets[index]:self.offsets[index+1]]
+		return self.take(np.arange(len(self))[index])
+
+	def __iter__(self):
+		for t_index in range(len(self)):
+			yield self[t_index]
+
+	def __repr__(self):
+		return 'RaggedArray(trials={}, samples={}, dtype={})'.format(len(self), self.size, self.dtype)
+
+	@property
+	def lengths(self):
+		return np.diff(self.offsets)
+
+	@property
+	def starts(self):
+		return self.offsets[:-1]
+
+	@property
+	def stops(self):
+		return self.offsets[1:]
+
+	@property
+	def size(self):
+		return int(self.offsets[-1] - self.offsets[0])
+
+	@property
+	def dtype(self):
+		return self.buffer.dtype
+
+	@property
+	def nbytes(self):
+		return self.buffer.nbytes + self.offsets.nbytes
+
+	def trial_ids(self):
+		'''Trial index of every sample in the buffer (for vectorized reductions)'''
+		return np.repeat(np.arange(len(self)), self.lengths)
+
+	def take(self, indices):
+		'''Returns a new (compact) RaggedArray with only the specified trials'''
+		indices = np.asarray(indices, dtype=np.int64)
+		lengths = self.lengths[indices]
+		ragged = RaggedArray.empty(lengths, dtype=self.dtype)
+		if len(indices):
+			# gather every selected sample in one fancy-index
+			sample_index = np.repeat(self.starts[indices] - ragged.starts, lengths) + np.arange(ragged.size)
+			ragged.buffer[:] = self.buffer[sample_index]
+		return ragged
+
+	def to_object_array(self):
+		'''Object array of zero-copy per-trial views (for DataFrame columns)'''
+		object_array = np.empty(len(self), dtype=object)
+		for t_index in range(len(self)):
+			object_array[t_index] = self[t_index]
+		return object_array
+
+def signals_to_columns(session_dict):
+	'''
+	Replaces each RaggedArray in session_dict with an object array of
+	per-trial views into its buffer (no copy), so that it can be
+	converted with pd.DataFrame.from_dict
+	'''
+	for key, value in list(session_dict.items()):
+		if isinstance(value, RaggedArray):
+			session_dict[key] = value.to_object_array()
+	return session_dict
+
+def columns_to_signals(df, columns=SIGNAL_COLUMNS):
+	'''
+	Collects the per-trial signal columns of df into RaggedArrays
+	(shares the existing buffers whenever the rows are still contiguous)
+
+	Returns:
+		signals (dict): column name -> RaggedArray
+	'''
+	signals = {}
+	for column in columns:
+		if column in df.columns:
+			signals[column] = RaggedArray.from_column(df[column])
+	return signals
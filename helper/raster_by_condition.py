@@ -12,6 +12,9 @@ warnings.filterwarnings("ignore")
 
 # Custom Functions
 from plot_helper import smooth_plot, round_up_to_odd, moving_avg, set_plot_params
+from bit_raster import window_any
+from feature_engine import epoch_times
+from trace_matrix import aligned_trace_matrix, mean_sem
 
 def epoch_time(df):
 	# taking the minimum length of epochs to find cutoff values
@@ -34,14 +37,6 @@ def raster_by_condition(session_df, session_obj):
 	WINDOW_THRESHOLD_LICK = session_obj.window_lick
 	WINDOW_THRESHOLD_BLINK = session_obj.window_blink
 
-	lick_dict = defaultdict(list)
-	blink_dict = defaultdict(list)
-	pupil_dict = defaultdict(list)
-
-	lick_epoch_dict = defaultdict(lambda:defaultdict(list))
-	blink_epoch_dict = defaultdict(lambda:defaultdict(list))
-	pupil_epoch_dict = defaultdict(lambda:defaultdict(list))
-
 	lick_data_probability = defaultdict(list)
 	blink_data_probability = defaultdict(list)
 
@@ -70,38 +65,33 @@ def raster_by_condition(session_df, session_obj):
 		df = session_df_threshold[session_df_threshold['valence'] == valence]
 
 		# valence-specific session lick/blink data
-		lick_data_raster = df['lick_raster'].tolist()
-		blink_data_raster = df['blink_raster'].tolist()
 		pupil_data = df['eye_pupil'].tolist()
 
 		# single bin lick data (-<WINDOW_THRESHOLD>ms from trace interval end)
+		## any lick/blink in the specified time window (window queries on the packed rasters)
+		lick_window_any = window_any(df['lick_count_window'])
+		blink_window_any = window_any(df['blink_count_window'])
 
-		for t_index, trial in enumerate(lick_data_raster):
+		for t_index in range(len(df)):
 
-			cs_on_time = df['CS On'].iloc[t_index]
-			trace_on_time = df['Trace Start'].iloc[t_index]
 			trace_off_time = df['Trace End'].iloc[t_index]
 
 			# Lick/Blink Probability
 			## counts if there was any lick in the specified time window
-			lick_data_window = df['lick_count_window'].iloc[t_index]
-			if 1 in lick_data_window:
+			if lick_window_any[t_index]:
 				lick_data_probability[df_index].append(1)
 			else:
 				lick_data_probability[df_index].append(0)
 
 			## counts if there was any blink in the specified time window
-			blink_data_window = df['blink_count_window'].iloc[t_index]
-			if 1 in blink_data_window:
+			if blink_window_any[t_index]:
 				blink_data_probability[df_index].append(1)
-				pupil_data_trial = range(10000) # for min trial pupil length
 			else:
 				blink_data_probability[df_index].append(0)
 				# only add pupil data if there was no blink
 				pupil_data_window = pupil_data[t_index][trace_off_time-WINDOW_THRESHOLD_LICK:trace_off_time]
 				pupil_data_window_mean = np.mean(pupil_data_window)
 				pupil_data_binary[df_index].append(pupil_data_window_mean)
-				pupil_data_trial = pupil_data[t_index][cs_on_time-PRE_CS:]
 
 			# Lick/Blink Duration
 			lick_raw = df['lick'].iloc[t_index]
@@ -112,44 +102,26 @@ def raster_by_condition(session_df, session_obj):
 			blink_raw = df['blink_duration_offscreen'].iloc[t_index]
 			blink_data_duration[df_index].append(blink_raw)
 
-			lick_data_trial = lick_data_raster[t_index][cs_on_time-PRE_CS:]
-			blink_data_trial = blink_data_raster[t_index][cs_on_time-PRE_CS:]
-
-			lick_data_cs = lick_data_raster[t_index][cs_on_time:trace_on_time]
-			lick_data_trace = lick_data_raster[t_index][trace_on_time:trace_off_time]
-			lick_data_outcome = lick_data_raster[t_index][trace_off_time:]
-
-			blink_data_cs = blink_data_raster[t_index][cs_on_time:trace_on_time]
-			blink_data_trace = blink_data_raster[t_index][trace_on_time:trace_off_time]
-			blink_data_outcome = blink_data_raster[t_index][trace_off_time:]
-
-			time = np.arange(len(lick_data_trial))
-
-			# lick_data_trial and blink_data_trial are sometimes off by 1 frame
-			# 	must investigate further
-			shorter_trial_data = min(len(lick_data_trial), len(blink_data_trial), len(pupil_data_trial))
-			for bin_num in range(shorter_trial_data):
-				lick_dict[bin_num].append(lick_data_trial[bin_num])
-				blink_dict[bin_num].append(blink_data_trial[bin_num])
-				if 1 not in blink_data_window:
-					pupil_dict[bin_num].append(pupil_data_trial[bin_num])
-
-			for bin_num in range(cs_time_min):
-				lick_epoch_dict['CS'][bin_num].append(lick_data_cs[bin_num])
-				blink_epoch_dict['CS'][bin_num].append(blink_data_cs[bin_num])
-			for bin_num in range(trace_time_min-cs_time_min):
-				lick_epoch_dict['Trace'][bin_num].append(lick_data_trace[bin_num])
-				blink_epoch_dict['Trace'][bin_num].append(blink_data_trace[bin_num])
-			for bin_num in range(outcome_time_min-cs_time_min):
-				lick_epoch_dict['Outcome'][bin_num].append(lick_data_outcome[bin_num])
-				blink_epoch_dict['Outcome'][bin_num].append(blink_data_outcome[bin_num])
+		# (trials x time) matrices from <PRE_CS>ms before CS On
+		cs_on_time, _ = epoch_times(df, 'CS On')
+		## lick and blink data are sometimes off by 1 frame, so every trial is cut
+		## to its shortest signal (pupil data is only used when there was no blink)
+		trial_start = cs_on_time - PRE_CS
+		shorter_trial_data = np.minimum(df['lick_raster'].apply(len).values - trial_start,
+																		df['blink_raster'].apply(len).values - trial_start)
+		pupil_trial_data = np.where(blink_window_any, shorter_trial_data,
+																df['eye_pupil'].apply(len).values - trial_start)
+		shorter_trial_data = np.minimum(shorter_trial_data, pupil_trial_data)
+		lick_matrix = aligned_trace_matrix(df['lick_raster'], cs_on_time, PRE_CS, lengths=shorter_trial_data)
+		blink_matrix = aligned_trace_matrix(df['blink_raster'], cs_on_time, PRE_CS, lengths=shorter_trial_data)
+		pupil_matrix = aligned_trace_matrix(df['eye_pupil'], cs_on_time, PRE_CS, lengths=shorter_trial_data)
+		pupil_matrix[blink_window_any] = np.nan
 
 		# Now analyze all trials together
-
-		bins = list(lick_dict.keys())
-		lick_data_mean = list(map(np.mean, lick_dict.values()))
-		blink_data_mean = list(map(np.mean, blink_dict.values()))
-		pupil_data_mean = list(map(np.mean, pupil_dict.values()))
+		bins = list(range(lick_matrix.shape[1]))
+		lick_data_mean, lick_data_sem = mean_sem(lick_matrix)
+		blink_data_mean, blink_data_sem = mean_sem(blink_matrix)
+		pupil_data_mean, pupil_data_sem = mean_sem(pupil_matrix)
 
 		labels = list(session_obj.valence_labels.values())[:4]
 		label = session_obj.valence_labels[valence]
@@ -158,11 +130,17 @@ def raster_by_condition(session_df, session_obj):
 		WINDOW_SIZE = PRE_CS
 		x = np.array(bins[PRE_CS:]) # only capturing post-CS bins
 		y1 = moving_avg(lick_data_mean, WINDOW_SIZE)
+		y1_sem = moving_avg(lick_data_sem, WINDOW_SIZE)
 		axarr[0][0].plot(x, y1[:-1], 
 										color=COLORS[valence], label=label, linewidth=4)
+		axarr[0][0].fill_between(x, y1[:-1]-y1_sem[:-1], y1[:-1]+y1_sem[:-1],
+														 color=COLORS[valence], alpha=0.2) # sem
 		y2 = moving_avg(blink_data_mean, WINDOW_SIZE)
+		y2_sem = moving_avg(blink_data_sem, WINDOW_SIZE)
 		axarr[1][0].plot(x, y2[:-1], 
 										color=COLORS[valence], label=label, linewidth=4)
+		axarr[1][0].fill_between(x, y2[:-1]-y2_sem[:-1], y2[:-1]+y2_sem[:-1],
+														 color=COLORS[valence], alpha=0.2) # sem
 		# y3 = moving_avg(pupil_data_mean, WINDOW_SIZE)
 		# axarr[2][0].plot(range(len(y3)), y3, 
 		# 								color=COLORS[valence], label=label, linewidth=4)
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import traceback
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import profiling
+from profiling import stage
+
+# context of every session (set once per worker process, see init_worker)
+_CONTEXTS = {}
+
+class RenderJob:
+	'''
+	A single plotting/analysis call <module>.<function>(*args, **kwargs),
+	where args are names of entries of the session context (i.e. 'df',
+	'session_obj'). Data preparation (i.e. slicing blocks) is done once in
+	the main process and stored in the context, which is sent to each
+	worker once instead of with every job.
+
+	Args:
+		name (str): job name (i.e. 'trial_raster', 'raster_by_condition_1')
+		module (str): helper module of function
+		function (str): function name
+		args (list): context keys passed as positional arguments
+		kwargs (dict): keyword arguments (passed as is)
+		context_kwargs (dict): keyword arguments taken from the context (name -> context key)
+		serial (bool): run in the main process after the parallel jobs
+			(i.e. write_to_excel, which writes to a file shared across sessions)
+		cache (bool): skip the job when its figures are cached (see figure_cache),
+			False for jobs with other outputs (i.e. markdown, excel)
+	'''
+	def __init__(self, name, module, function, args, kwargs=None, context_kwargs=None, serial=False, cache=True):
+		self.name = name
+		self.module = module
+		self.function = function
+		self.args = list(args)
+		self.kwargs = kwargs or {}
+		self.context_kwargs = context_kwargs or {}
+		self.serial = serial
+		self.cache = cache
+
+	def __repr__(self):
+		return 'RenderJob({}: {}.{})'.format(self.name, self.module, self.function)
+
+def init_worker(contexts, helper_paths):
+	'''Worker initializer: headless Agg backend and the session contexts'''
+	for path in helper_paths:
+		if path not in sys.path:
+			sys.path.append(path)
+	import matplotlib
+	matplotlib.use('Agg', force=True)
+	# stages run in the workers are recorded by the main process (see RenderScheduler.run)
+	profiling.detach()
+	_CONTEXTS.update(contexts)
+
+def run_job(session_key, job_index, job, context=None):
+	'''
+	Runs a single job and times it along with every figure it saves
+
+	Returns:
+		records (list): one dict per saved figure (and one for the whole job)
+	'''
+	import matplotlib
+	import matplotlib.pyplot as plt
+	from matplotlib.figure import Figure
+	context = _CONTEXTS[session_key] if context is None else context
+	records = []
+	savefig = Figure.savefig
+	last_save = [time.perf_counter()]
+	def timed_savefig(fig, fname, *args, **kwargs):
+		savefig(fig, fname, *args, **kwargs)
+		now = time.perf_counter()
+		path = os.path.abspath(os.fspath(fname))
+		# savefig adds the default extension to paths without one
+		if os.path.splitext(path)[1] == '' and kwargs.get('format') is None:
+			path += '.' + matplotlib.rcParams['savefig.format']
+		records.append(job_record(session_key, job_index, job, path, now - last_save[0]))
+		last_save[0] = now
+	start = time.perf_counter()
+	error = ''
+	Figure.savefig = timed_savefig
+	try:
+		function = getattr(importlib.import_module(job.module), job.function)
+		kwargs = dict(job.kwargs, **{name: context[key] for name, key in job.context_kwargs.items()})
+		with stage(job.name, job_rows(job, context)):
+			function(*[context[arg] for arg in job.args], **kwargs)
+	except Exception:
+		error = traceback.format_exc()
+	finally:
+		Figure.savefig = savefig
+		plt.close('all')
+	records.append(job_record(session_key, job_index, job, '', time.perf_counter() - start, error))
+	# memory of the process the job ran in (see profiling.record)
+	records[-1]['rss_mb'] = profiling.rss_mb()
+	records[-1]['peak_rss_mb'] = profiling.peak_rss_mb()
+	return records
+
+def job_rows(job, context):
+	'''Number of rows of the first DataFrame argument of a job (None if there is none)'''
+	return next((len(context[arg]) for arg in job.args if isinstance(context[arg], pd.DataFrame)), None)
+
+def job_record(session_key, job_index, job, path, seconds, error='', cached=False):
+	'''Timing record of a job (path='') or of a figure saved by the job'''
+	return {'session': session_key, 'job_index': job_index, 'job': job.name,
+					'figure': os.path.basename(path), 'path': path, 'seconds': seconds,
+					'cached': cached, 'error': error}
+
+class RenderScheduler:
+	'''
+	Runs the figure jobs of one or more sessions in a process pool
+	(headless, Agg backend) and records the wall time of every job
+	and every saved figure. Serial jobs run afterwards in the main
+	process, in the order they were added. With a FigureCache, jobs
+	whose inputs and figures have not changed are skipped.
+
+	Args:
+		workers (int): number of worker processes
+			(default: os.cpu_count(), 1 runs every job in the main process)
+		cache (FigureCache): figure cache (None to always render)
+	'''
+	def __init__(self, workers=None, cache=None):
+		self.workers = os.cpu_count() if workers is None else workers
+		self.cache = cache
+		self.contexts = {}
+		self.jobs = []
+
+	def add(self, session_key, context, jobs):
+		'''Adds the jobs of a session and the context their args refer to'''
+		self.contexts[session_key] = context
+		for job in jobs:
+			self.jobs.append((session_key, len(self.jobs), job))
+
+	def run(self):
+		'''
+		Runs every job
+
+		Returns:
+			render_times (pd.DataFrame): one row per job (figure='') and per
+				saved figure with its wall time in seconds (and traceback if
+				the job failed), cached=True for skipped jobs
+		'''
+		records = []
+		job_keys = {}
+		jobs = []
+		with stage('figure_cache_lookup', len(self.jobs)):
+			for session_key, job_index, job in self.jobs:
+				if self.cache is not None and job.cache:
+					key = self.cache.job_key(job, self.contexts[session_key])
+					artifact_paths = self.cache.get(key, job.name)
+					if artifact_paths is not None:
+						records += [job_record(session_key, job_index, job, path, 0.0, cached=True)
+												for path in artifact_paths]
+						records.append(job_record(session_key, job_index, job, '', 0.0, cached=True))
+						continue
+					job_keys[job_index] = key
+				jobs.append((session_key, job_index, job))
+		parallel_jobs = [job for job in jobs if not job[2].serial]
+		serial_jobs = [job for job in jobs if job[2].serial]
+		workers = min(self.workers, len(parallel_jobs))
+		print(' Rendering {} figure jobs ({} workers)...'.format(len(jobs), max(workers, 1)))
+		if workers > 1:
+			# fork (where available) shares the contexts without pickling them
+			methods = multiprocessing.get_all_start_methods()
+			mp_context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+			with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+															 initializer=init_worker,
+															 initargs=(self.contexts, list(sys.path))) as executor:
+				futures = [executor.submit(run_job, *job) for job in parallel_jobs]
+				for future in as_completed(futures):
+					job_records = self.report(future.result())
+					session_key, _, job = self.jobs[job_records[-1]['job_index']]
+					profiling.record(job.name, job_records[-1]['seconds'], job_rows(job, self.contexts[session_key]),
+													 job_records[-1]['rss_mb'], job_records[-1]['peak_rss_mb'])
+					records += job_records
+		else:
+			serial_jobs = parallel_jobs + serial_jobs
+		for session_key, job_index, job in serial_jobs:
+			records += self.report(run_job(session_key, job_index, job, self.contexts[session_key]))
+		if self.cache is not None:
+			self.save_cache(records, job_keys)
+		render_times = pd.DataFrame(records, columns=['session', 'job_index', 'job', 'figure', 'path',
+																									'seconds', 'cached', 'error'])
+		render_times = render_times.sort_values('job_index', kind='stable').reset_index(drop=True)
+		job_times = render_times[render_times['figure'] == '']
+		print('  {} jobs, {} figures ({:.2f}s total render time)'.format(
+			len(job_times), len(render_times) - len(job_times), job_times['seconds'].sum()))
+		return render_times
+
+	def save_cache(self, records, job_keys):
+		'''Adds the figures of every successful job to the cache'''
+		artifacts = {}
+		for record in records:
+			if record['job_index'] in job_keys:
+				artifacts.setdefault(record['job_index'], []).append(record)
+		for job_index, job_records in artifacts.items():
+			last_record = job_records[-1]
+			if last_record['error'] == '':
+				self.cache.put(job_keys[job_index], last_record['session'], last_record['job'],
+											 [record['path'] for record in job_records[:-1]])
+		self.cache.save()
+		self.cache.report()
+
+	def report(self, records):
+		'''Prints failed jobs (the other jobs keep running)'''
+		job_record = records[-1]
+		if job_record['error']:
+			print('  {} ({}) failed:\n{}'.format(job_record['job'], job_record['session'], job_record['error']))
+		return records
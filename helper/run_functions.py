@@ -1,4 +1,63 @@
-def run_functions(df, session_obj, path_obj, behavioral_code_dict, error_dict, FIGURE_SAVE_PATH):
+import os
+
+from render_scheduler import RenderJob, RenderScheduler
+from figure_cache import FigureCache, CACHE_FOLDER
+from session_summary import SummaryCache, SUMMARY_CACHE_FOLDER
+from profiling import profiled
+
+def render_jobs(df, session_obj, path_obj, behavioral_code_dict):
+	"""
+	Prepares the data of every analysis function and its figure jobs
+
+	Args:
+		df (dataframe): dataframe of session data
+		session_obj (Session): session object
+		path_obj (Path): path object
+		behavioral_code_dict (dict): dictionary of behavioral codes
+
+	Returns:
+		context (dict): job arguments (shared by all jobs of the session)
+		jobs (list): RenderJob list (in the original run_functions order)
+	"""
+	context = {'df': df, 'session_obj': session_obj, 'path_obj': path_obj,
+						 'behavioral_code_dict': behavioral_code_dict}
+	# per-date summary table of the longitudinal plots (cached across runs and sessions)
+	summary_cache = SummaryCache(os.path.join(path_obj.TARGET_PATH, SUMMARY_CACHE_FOLDER))
+	context['summary'] = summary_cache.summarize(df, session_obj)
+	jobs = [
+		RenderJob('lick_blink_linear', 'lick_blink_relationship', 'lick_blink_linear', ['df', 'session_obj']),
+		RenderJob('session_performance', 'session_performance', 'session_performance',
+							['df', 'behavioral_code_dict'], {'latency': True}, {'session_obj': 'session_obj'}),
+		RenderJob('session_timing', 'session_timing', 'plot_session_timing', ['df', 'session_obj']),
+		RenderJob('outcome_plots', 'outcome_plots', 'outcome_plots', ['df', 'session_obj']),
+		RenderJob('session_lick', 'session_lick', 'session_lick', ['df', 'session_obj']),
+		RenderJob('trial_raster', 'trial_raster', 'trial_raster', ['df', 'session_obj']),
+	]
+	for block in sorted(df['block'].unique()):
+		block_key = 'df_block_{}'.format(block)
+		context[block_key] = df[df['block'] == block]
+		jobs.append(RenderJob('raster_by_condition_{}'.format(block), 'raster_by_condition',
+													'raster_by_condition', [block_key, 'session_obj']))
+		jobs.append(RenderJob('t_test_moving_avg_{}'.format(block), 'two_sample_test',
+													't_test_moving_avg', [block_key, 'session_obj'], {'condition': block}))
+	jobs += [
+		RenderJob('grant_plots', 'grant_plots', 'grant_plots', ['df', 'session_obj']),
+		RenderJob('measure_hist', 'measure_hist', 'measure_hist', ['df', 'session_obj']),
+		RenderJob('eyetracking_analysis', 'eyetracking_analysis', 'eyetracking_analysis',
+							['df', 'session_obj'], {'TRIAL_THRESHOLD': 10}),
+		RenderJob('outcome_over_time', 'outcome_over_time', 'outcome_over_time', ['df', 'session_obj'],
+							context_kwargs={'summary': 'summary'}),
+		RenderJob('markdown_summary', 'markdown_print', 'markdown_summary',
+							['df', 'behavioral_code_dict', 'session_obj'], cache=False),
+		# excel file is shared by every session
+		RenderJob('write_to_excel', 'write_to_excel', 'write_to_excel', ['df', 'session_obj', 'path_obj'],
+							serial=True, cache=False),
+	]
+	return context, jobs
+
+@profiled()
+def run_functions(df, session_obj, path_obj, behavioral_code_dict, error_dict, FIGURE_SAVE_PATH, workers=None,
+									use_cache=True):
 	"""
 	Runs all analyses functions
 
@@ -9,57 +68,54 @@ def run_functions(df, session_obj, path_obj, behavioral_code_dict, error_dict, F
 		behavioral_code_dict (dict): dictionary of behavioral codes
 		error_dict (dict): dictionary of error codes
 		FIGURE_SAVE_PATH (str): path to save figures
+		workers (int): figure rendering processes (default: one per core,
+			1 renders every figure in this process, i.e. inline in notebooks)
+		use_cache (bool): skip figures whose data and plot parameters have not
+			changed (cached in <FIGURE_SAVE_PATH>/.figure_cache)
 
 	Returns:
 		session_obj (Session): updated session object
+			(session_obj.render_times: wall time of every job and figure)
 	"""
 
-	session_obj.save_paths(path_obj.TARGET_PATH, 
-												 path_obj.TRACKER_PATH, 
+	session_obj.save_paths(path_obj.TARGET_PATH,
+												 path_obj.TRACKER_PATH,
 												 path_obj.VIDEO_PATH,
 												 FIGURE_SAVE_PATH)
 
-	from lick_blink_relationship import lick_blink_linear
-	lick_blink_linear(df, session_obj)
-
-	from session_performance import session_performance
-	session_performance(df, behavioral_code_dict, True, session_obj)
-
-	from session_timing import plot_session_timing
-	plot_session_timing(df, session_obj)
+	context, jobs = render_jobs(df, session_obj, path_obj, behavioral_code_dict)
+	cache = FigureCache(os.path.join(FIGURE_SAVE_PATH, CACHE_FOLDER)) if use_cache else None
+	scheduler = RenderScheduler(workers, cache)
+	scheduler.add(FIGURE_SAVE_PATH, context, jobs)
+	session_obj.render_times = scheduler.run()
 
-	from outcome_plots import outcome_plots
-	outcome_plots(df, session_obj)
+	return session_obj
 
-	from session_lick import session_lick
-	session_lick(df, session_obj)
-
-	from trial_raster import trial_raster
-	trial_raster(df, session_obj)
-
-	from raster_by_condition import raster_by_condition
-	from two_sample_test import t_test_moving_avg
-	for block in sorted(df['block'].unique()):
-		session_df_condition = df[df['block'] == block]
-		raster_by_condition(session_df_condition, session_obj)
-		t_test_moving_avg(session_df_condition, session_obj, block)
-	
-	from grant_plots import grant_plots
-	grant_plots(df, session_obj)
-
-	from measure_hist import measure_hist
-	measure_hist(df, session_obj)
-
-	from eyetracking_analysis import eyetracking_analysis
-	eyetracking_analysis(df, session_obj, TRIAL_THRESHOLD=10)
-
-	from outcome_over_time import outcome_over_time
-	outcome_over_time(df, session_obj)
-
-	from markdown_print import markdown_summary
-	markdown_summary(df, behavioral_code_dict, session_obj)
+@profiled()
+def run_functions_batch(sessions, path_obj, behavioral_code_dict, error_dict, workers=None, use_cache=True):
+	"""
+	Runs all analyses functions of several sessions (i.e. nightly batch over
+	all sessions and monkeys) in a single process pool
 
-	from write_to_excel import write_to_excel
-	write_to_excel(df, session_obj, path_obj)
+	Args:
+		sessions (list): (df, session_obj, FIGURE_SAVE_PATH) of each session
+		path_obj (Path): path object
+		behavioral_code_dict (dict): dictionary of behavioral codes
+		error_dict (dict): dictionary of error codes
+		workers (int): figure rendering processes (default: one per core)
+		use_cache (bool): skip figures whose data and plot parameters have not
+			changed (cached in <path_obj.FIGURE_PATH>/.figure_cache)
 
-	return session_obj
\ No newline at end of file
+	Returns:
+		render_times (dataframe): wall time of every job and figure (session = FIGURE_SAVE_PATH)
+	"""
+	cache = FigureCache(os.path.join(path_obj.FIGURE_PATH, CACHE_FOLDER)) if use_cache else None
+	scheduler = RenderScheduler(workers, cache)
+	for df, session_obj, FIGURE_SAVE_PATH in sessions:
+		session_obj.save_paths(path_obj.TARGET_PATH,
+													 path_obj.TRACKER_PATH,
+													 path_obj.VIDEO_PATH,
+													 FIGURE_SAVE_PATH)
+		context, jobs = render_jobs(df, session_obj, path_obj, behavioral_code_dict)
+		scheduler.add(FIGURE_SAVE_PATH, context, jobs)
+	return scheduler.run()
@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+
+OUTCOME_SELECTED = [0, 9]	# error types of initiated trials
+BEHAVIOR_MEASURES = ['lick_in_window', 'blink_in_window', 'lick_duration', 'blink_duration_offscreen']
+GROUP_COLUMNS = ['valence', 'stimuli_name', 'block']
+REWARD_MEASURES = ['reward_drops', 'reward_prob', 'reward_length']
+AIRPUFF_MEASURES = ['airpuff_pulses', 'airpuff_prob']
+
+class RunningStats:
+	'''
+	Count, mean and variance of a stream of values, updated one value
+	(Welford) or one batch (Chan et al.) at a time, and mergeable with
+	other RunningStats so sessions can be combined without their trials.
+	np.nan values are skipped.
+	'''
+	__slots__ = ['count', 'mean', 'm2']
+
+	def __init__(self, count=0, mean=0.0, m2=0.0):
+		self.count = count
+		self.mean = mean
+		self.m2 = m2		# sum of squared differences from the mean
+
+	def __repr__(self):
+		return 'RunningStats(count={}, mean={}, std={})'.format(self.count, self.mean, self.std())
+
+	def update(self, value):
+		'''Adds a single value'''
+		if np.isnan(value):
+			return self
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (value - self.mean)
+		return self
+
+	def update_batch(self, values):
+		'''Adds an array of values'''
+		values = np.asarray(values, dtype=float)
+		values = values[~np.isnan(values)]
+		if len(values) == 0:
+			return self
+		batch_mean = np.mean(values)
+		return self.merge(RunningStats(len(values), batch_mean, np.sum((values - batch_mean)**2)))
+
+	def merge(self, other):
+		'''Adds the values summarized by another RunningStats'''
+		if other.count == 0:
+			return self
+		if self.count == 0:
+			self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+			return self
+		count = self.count + other.count
+		delta = other.mean - self.mean
+		self.mean += delta * other.count / count
+		self.m2 += other.m2 + delta**2 * self.count * other.count / count
+		self.count = count
+		return self
+
+	def copy(self):
+		return RunningStats(self.count, self.mean, self.m2)
+
+	def mean_or_nan(self):
+		return self.mean if self.count else np.nan
+
+	def variance(self, ddof=1):
+		if self.count - ddof <= 0:
+			return np.nan
+		return self.m2 / (self.count - ddof)
+
+	def std(self, ddof=1):
+		return np.sqrt(self.variance(ddof))
+
+	def sem(self):
+		return self.std() / np.sqrt(self.count) if self.count else np.nan
+
+class GroupedStats:
+	'''
+	RunningStats of several measures (columns) for every value of a
+	grouping column (i.e. one set per valence)
+
+	Args:
+		column (str): grouping column (i.e. 'valence', 'stimuli_name', 'block')
+		measures (list): columns summarized in each group
+	'''
+	def __init__(self, column, measures):
+		self.column = column
+		self.measures = list(measures)
+		self.groups = {}
+
+	def group(self, key):
+		'''measure -> RunningStats of a single group (created on first use)'''
+		if key not in self.groups:
+			self.groups[key] = {measure: RunningStats() for measure in self.measures}
+		return self.groups[key]
+
+	def update(self, df):
+		'''Adds the rows of df (measures missing from df are skipped)'''
+		if self.column not in df.columns:
+			return self
+		measures = [measure for measure in self.measures if measure in df.columns]
+		for key, group_df in df.groupby(self.column, sort=False):
+			group_stats = self.group(key)
+			for measure in measures:
+				group_stats[measure].update_batch(group_df[measure])
+		return self
+
+	def merge(self, other):
+		for key, other_stats in other.groups.items():
+			group_stats = self.group(key)
+			for measure, stats in other_stats.items():
+				group_stats[measure].merge(stats)
+		return self
+
+	def to_df(self, sem=False):
+		'''Mean (and sem) of every measure, one row per group'''
+		summary = {}
+		for key in sorted(self.groups, reverse=True):
+			summary[key] = {}
+			for measure, stats in self.groups[key].items():
+				summary[key][measure] = stats.mean_or_nan()
+				if sem:
+					summary[key][measure+'_sem'] = stats.sem()
+		return pd.DataFrame.from_dict(summary, orient='index')
+
+class SessionStats:
+	'''
+	Running session metrics (Session.behavior_summary, outcome parameters
+	and lick/blink measures per valence, fractal and block), updated one
+	batch of trials at a time and mergeable across sessions
+
+	Args:
+		cs_on_code (int): behavioral code of 'CS On' (None to skip CS On counts)
+	'''
+	def __init__(self, cs_on_code=None):
+		self.cs_on_code = cs_on_code
+		self.num_trials = 0
+		self.num_initiated = 0
+		self.cs_on_trials = 0
+		self.cs_on_correct = 0
+		# trial outcomes (correct trials)
+		self.reward = GroupedStats('reward_mag', REWARD_MEASURES)
+		self.airpuff = GroupedStats('airpuff_mag', AIRPUFF_MEASURES)
+		self.reset_behavior()
+
+	@classmethod
+	def merged(cls, stats_list):
+		'''Combined SessionStats of several sessions'''
+		stats_list = list(stats_list)
+		merged_stats = cls(stats_list[0].cs_on_code if stats_list else None)
+		for stats in stats_list:
+			merged_stats.merge(stats)
+		return merged_stats
+
+	def update_trials(self, df):
+		'''Adds trial counts and outcome parameters of the session_df rows in df'''
+		self.num_trials += len(df)
+		self.num_initiated += int(df['error_type'].isin(OUTCOME_SELECTED).sum())
+		if self.cs_on_code is not None:
+			cs_on = np.array([self.cs_on_code in markers for markers in df['behavioral_code_markers']], dtype=bool)
+			self.cs_on_trials += int(np.sum(cs_on))
+			self.cs_on_correct += int(np.sum(np.asarray(df['correct'])[cs_on]))
+		correct_df = df[df['correct'] == 1]
+		self.reward.update(correct_df)
+		self.airpuff.update(correct_df)
+		return self
+
+	def reset_behavior(self):
+		'''Clears the lick/blink measures (i.e. before add_fields recomputes them)'''
+		# lick/blink measures (correct trials, see add_fields)
+		self.behavior_all = {measure: RunningStats() for measure in BEHAVIOR_MEASURES}
+		self.behavior = {column: GroupedStats(column, BEHAVIOR_MEASURES) for column in GROUP_COLUMNS}
+
+	def update_behavior(self, df):
+		'''Adds the lick/blink measures (add_fields columns) of the session_df rows in df'''
+		correct_df = df[df['correct'] == 1]
+		for measure, stats in self.behavior_all.items():
+			if measure in correct_df.columns:
+				stats.update_batch(correct_df[measure])
+		for grouped_stats in self.behavior.values():
+			grouped_stats.update(correct_df)
+		return self
+
+	def merge(self, other):
+		self.num_trials += other.num_trials
+		self.num_initiated += other.num_initiated
+		self.cs_on_trials += other.cs_on_trials
+		self.cs_on_correct += other.cs_on_correct
+		self.reward.merge(other.reward)
+		self.airpuff.merge(other.airpuff)
+		for measure, stats in other.behavior_all.items():
+			self.behavior_all[measure].merge(stats)
+		for column, grouped_stats in other.behavior.items():
+			self.behavior[column].merge(grouped_stats)
+		return self
+
+	def prop_trials_initiated(self):
+		return self.num_initiated / self.num_trials if self.num_trials else np.nan
+
+	def prop_correct_CS_on(self):
+		return self.cs_on_correct / self.cs_on_trials if self.cs_on_trials else np.nan
+
+	def outcome_params(self):
+		'''Outcome parameters of each non-zero reward/airpuff magnitude (see Session.find_outcome_parameters)'''
+		reward_outcome_params = {}
+		for measure in REWARD_MEASURES:
+			values = [stats[measure].mean_or_nan() for mag, stats in self.reward.groups.items() if mag != 0]
+			reward_outcome_params[measure] = sorted(values, reverse=True)
+		airpuff_outcome_params = {}
+		for measure in AIRPUFF_MEASURES:
+			values = [stats[measure].mean_or_nan() for mag, stats in self.airpuff.groups.items() if mag != 0]
+			airpuff_outcome_params[measure] = sorted(values, reverse=True)
+		return reward_outcome_params, airpuff_outcome_params
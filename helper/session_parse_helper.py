@@ -1,9 +1,16 @@
 import re
+import h5py
 import numpy as np
 from tqdm.auto import tqdm
 from collections import defaultdict
 from datetime import datetime, timedelta
 from time_processing import calculate_end_time
+from ragged import RaggedArray
+from events import lick_events, blink_events, pupil_zero_events
+
+# bump whenever the session_dict produced by session_parser changes
+# (invalidates the ingest cache entries written by older versions)
+PARSER_VERSION = 2
 
 def stimulus_parser(stimulus, stimuli_dict, session_dict):
 	'''Parses out parameters for each stimulus set for each trial config
@@ -43,8 +50,8 @@ def stimulus_parser(stimulus, stimuli_dict, session_dict):
 		pass
 	return(stimuli_dict, session_dict)
 
-def session_parser(session, trial_list, trial_record, date_input, monkey_input):
-	'''Parses out session data
+def cache_trial_datasets(session, trial_list):
+	'''Walks the ML group once and caches the dataset ids of each trial
 
   Parameters
   ----------
@@ -55,9 +62,109 @@ def session_parser(session, trial_list, trial_record, date_input, monkey_input):
 
   Returns
   -------
-	session_dict: Dict 
-		dictionary containing all specified session data
+	trial_datasets : list
+		one dictionary per trial mapping the dataset path relative to
+		the trial group (i.e. 'AnalogData/Eye') to its low-level DatasetID
+	'''
+	ml_id = session['ML'].id
+	trial_set = set(trial_list)
+	dataset_dict = defaultdict(dict)
+	def visit_dataset(name, info):
+		if info.type != h5py.h5o.TYPE_DATASET:
+			return
+		trial, _, field = name.decode().partition('/')
+		if trial in trial_set:
+			dataset_dict[trial][field] = h5py.h5d.open(ml_id, name)
+	# low-level visit only lists the object names (no Python objects per group)
+	h5py.h5o.visit(ml_id, visit_dataset, info=True)
+	return [dataset_dict[trial] for trial in trial_list]
+
+def read_dataset(dataset_id):
+	'''Reads a whole dataset in a single low-level read'''
+	x = np.empty(dataset_id.shape, dtype=dataset_id.dtype)
+	dataset_id.read(h5py.h5s.ALL, h5py.h5s.ALL, x)
+	return x
+
+def read_scalar_field(trial_datasets, field, dtype):
+	'''Reads the first element of <field> for every trial into one array'''
+	field_array = np.empty(len(trial_datasets), dtype=dtype)
+	for t_index, datasets in enumerate(trial_datasets):
+		field_array[t_index] = read_dataset(datasets[field]).flat[0]
+	return field_array
+
+def analog_row_size(dataset):
+	'''Values per row of an analog dataset (records of doubles are unpacked into their fields)'''
+	values_per_element = dataset.dtype.itemsize // 8 if dataset.dtype.kind == 'V' else 1
+	return int(np.prod(dataset.shape[1:]))*values_per_element
+
+def analog_values(x):
+	'''Analog dataset as float64 (one row per signal), cast only when it is not already float64'''
+	if x.dtype.kind == 'V':
+		return x.view(np.float64).reshape(x.shape+(-1,))
+	if x.dtype != np.float64:
+		return x.astype(np.float64, copy=False)
+	return x
+
+def read_analog_field(trial_datasets, field, rows=(0,)):
 	'''
+	Reads the analog <field> once per trial and copies each of <rows>
+	(i.e. x and y for the eye data) straight into a RaggedArray whose
+	buffer is allocated up front from the dataset shapes. Returns None
+	if the field is missing (or empty) for any trial.
+	'''
+	try:
+		shapes = [datasets[field].shape for datasets in trial_datasets]
+		lengths = [analog_row_size(datasets[field]) for datasets in trial_datasets]
+	except KeyError:
+		return None
+	if any(len(shape) == 0 or shape[0] < len(rows) for shape in shapes):
+		return None
+	row_arrays = [RaggedArray.empty(lengths) for _ in rows]
+	for t_index, datasets in enumerate(trial_datasets):
+		x = analog_values(read_dataset(datasets[field]))
+		for r_index, row in enumerate(rows):
+			row_arrays[r_index][t_index][:] = x[row].ravel()
+	return row_arrays
+
+def read_user_field(container, field, num_trials, dtype):
+	'''
+	Reads a TrialRecord.User variable in a single read. Returns None
+	if the variable is missing or shorter than the session (num_trials=None
+	reads every value, i.e. for a session that is still being recorded).
+	'''
+	try:
+		values = np.ravel(container[field][()])
+	except KeyError:
+		return None
+	if num_trials is not None and len(values) < num_trials:
+		return None
+	return values[:num_trials].astype(dtype)
+
+# user-generated variables (TrialRecord.User): container -> (session_dict key, field, dtype)
+USER_FIELDS = {
+	'reward': [('reward', 'reward', np.int64), ('reward_prob', 'reward_prob', float),
+						 # new fields in reward_container
+						 ('reward_mag', 'reward_mag', float), ('reward_drops', 'drops', float),
+						 ('reward_length', 'length', float)],
+	'airpuff': [('airpuff', 'airpuff', np.int64), ('airpuff_prob', 'airpuff_prob', float),
+							# new fields in airpuff_container
+							('airpuff_mag', 'airpuff_mag', float), ('airpuff_pulses', 'num_pulses', float),
+							('airpuff_side_L', 'L_side', float), ('airpuff_side_R', 'R_side', float)],
+}
+
+ANALOG_FIELDS = [
+	(('eye_x', 'eye_y'), 'AnalogData/Eye'),						# eye data
+	(('eye_pupil',), 'AnalogData/EyeExtra'),					# pupil data
+	(('joystick_x', 'joystick_y'), 'AnalogData/Joystick'),	# joystick data
+	(('lick',), 'AnalogData/General/Gen1'),						# lick data
+	(('photodiode',), 'AnalogData/PhotoDiode'),				# photodiode data
+]
+
+# default number of trials per batch for iter_session_parser
+BATCH_SIZE = 100
+
+def session_info(session, date_input, monkey_input):
+	'''Session-wide fields (date, session number, subject) of session_dict'''
 	session_dict = defaultdict(list)
 
 	# date (and handling for multiple sessions)
@@ -71,8 +178,18 @@ def session_parser(session, trial_list, trial_record, date_input, monkey_input):
 
 	# monkey
 	session_dict['subject'] = monkey_input
-	
-	# error code mapping
+	return session_dict
+
+def code_mappings(trial_record):
+	'''Parses the error code and behavioral code mappings
+
+  Returns
+  -------
+	error_dict : Dict
+		dictionary containing error mapping
+	behavioral_code_dict : Dict
+		dictionary containing behavioral code mapping
+	'''
 	error_dict = defaultdict(str)
 	try:
 		for error_code in list(trial_record['TaskInfo']['TrialErrorCodes'].keys()):
@@ -100,150 +217,112 @@ def session_parser(session, trial_list, trial_record, date_input, monkey_input):
 	except:
 		behavioral_code_dict = defaultdict(str)
 		pass
+	return error_dict, behavioral_code_dict
 
-	try:
-		stim_container = trial_record['User']['stim_list'] # ML user-generated variables
-		stim_list = stim_container.keys()
-		reward_container = trial_record['User']['reward'] # ML user-generated variables
-		airpuff_container = trial_record['User']['airpuff'] # ML user-generated variables
-	except:
-		pass
-
-	# trial_list is ordered already (Trial1...TrialN) but we should put in some checks
-	# to make sure that it holds in all cases
-	for t_index, trial in enumerate(trial_list):
-
-		# all trial data
-		trial_data = session['ML'][trial]
-
-		# trial number
-		trial_num = list(trial_data['Trial'][0]) # starts at Trial 1...Trial N
-		session_dict['trial_num'].append(int(trial_num[0]))
-
-		# block
-		block = int(trial_data['Block'][()][0][0])
-		session_dict['block'].append(block)
-
-		# condition
-		condition = int(trial_data['Condition'][()][0][0])
-		session_dict['condition'].append(condition)
-
-		trial_result = int(trial_data['TrialError'][()][0][0])
-		# correct trial
-		if trial_result == 0:
-			session_dict['correct'].append(1)
-			session_dict['error'].append(0)
-		# error trial
-		else:
-			session_dict['correct'].append(0)
-			session_dict['error'].append(1)
-
-		# error code mapping
-		#   - error_dict[0]     = 'correct'
-		#   - error_dict[{1-9}] = '<error_type>'
-		session_dict['error_type'].append(int(trial_result))
-
-		# behavioral codes
-		behavioral_code_markers = np.array(trial_data['BehavioralCodes']['CodeNumbers'][0])
-		behavioral_code_times = np.array(trial_data['BehavioralCodes']['CodeTimes'][0])
-		session_dict['behavioral_code_markers'].append(list(map(int,behavioral_code_markers)))
-		session_dict['behavioral_code_times'].append(behavioral_code_times)
-
-		# stimuli info
-		stimuli_attribute = trial_data['TaskObject']['Attribute']
-		stimuli_dict = defaultdict(list)
-		# all hard coded by MonkeyLogic and therefore here as well
-		try:  # list of stimuli in stimuli_attribute
-			test_for_list = stimuli_attribute['1'] 
-			for stimulus in stimuli_attribute:
-				stimuli_dict, session_dict = stimulus_parser(stimuli_attribute[stimulus], stimuli_dict, session_dict)
-		except: # one stimuli in stimuli_attribute
-			stimuli_dict, session_dict = stimulus_parser(stimuli_attribute, stimuli_dict, session_dict)
-		if 'stim_list' in locals(): # experiment contains user-generated variable TrialRecord.User.stim_container
-			for stimulus in stim_list:
-				# exclude fix (no degree value)
-				if stimulus == 'fix':
-					continue
-		if 'reward_container' in locals():
-			reward = int(reward_container['reward'][t_index])
-			session_dict['reward'].append(reward)
-			reward_prob = float(reward_container['reward_prob'][t_index])
-			session_dict['reward_prob'].append(reward_prob)
-			try: # new fields in reward_container
-				reward_mag = float(reward_container['reward_mag'][t_index])
-				session_dict['reward_mag'].append(reward_mag)
-				reward_drops = float(reward_container['drops'][t_index])
-				session_dict['reward_drops'].append(reward_drops)		
-				reward_length = float(reward_container['length'][t_index])
-				session_dict['reward_length'].append(reward_length)	
-			except:
-				pass
-		if 'airpuff_container' in locals():
-			airpuff = int(airpuff_container['airpuff'][t_index])
-			session_dict['airpuff'].append(airpuff)
-			airpuff_prob = float(airpuff_container['airpuff_prob'][t_index])
-			session_dict['airpuff_prob'].append(airpuff_prob)
-			try: # new fields in airpuff_container
-				airpuff_mag = float(airpuff_container['airpuff_mag'][t_index])
-				session_dict['airpuff_mag'].append(airpuff_mag)
-				num_pulses = float(airpuff_container['num_pulses'][t_index])
-				session_dict['airpuff_pulses'].append(num_pulses)
-				airpuff_L_side = float(airpuff_container['L_side'][t_index])
-				session_dict['airpuff_side_L'].append(airpuff_L_side)
-				airpuff_R_side = float(airpuff_container['R_side'][t_index])
-				session_dict['airpuff_side_R'].append(airpuff_R_side)
-			except:
-				pass
-		# eye data
-		x = np.array(trial_data['AnalogData']['Eye'])
-		eye_data = x.view(np.float64).reshape(x.shape+(-1,))
-		session_dict['eye_x'].append(eye_data[0].flatten())
-		session_dict['eye_y'].append(eye_data[1].flatten())
-		# session_dict['eye_x'].append(eye_data[0])
-		# session_dict['eye_y'].append(eye_data[1])
-
-		# pupil data
-		x = np.array(trial_data['AnalogData']['EyeExtra'])
+def read_user_fields(trial_record, num_trials):
+	'''Reads every TrialRecord.User variable of the session (one read per variable)'''
+	user_values = {}
+	for container_name, fields in USER_FIELDS.items():
 		try:
-			session_dict['eye_pupil'].append(x[0])
-		except:
-			pass # no pupil data
+			container = trial_record['User'][container_name] # ML user-generated variables
+		except KeyError:
+			continue
+		for key, field, dtype in fields:
+			values = read_user_field(container, field, num_trials, dtype)
+			if values is not None:
+				user_values[key] = values
+	return user_values
 
-		# joystick data
-		x = np.array(trial_data['AnalogData']['Joystick'])
-		try:
-			joystick_data = x.view(np.float64).reshape(x.shape+(-1,))
-			session_dict['joystick_x'].append(joystick_data[0])
-			session_dict['joystick_y'].append(joystick_data[1])
-		except:
-			pass # no joystick data
+def trial_parser(trial_datasets, user_values, session_dict, trial_offset=0):
+	'''Parses out the data of a list of trials
+
+  Parameters
+  ----------
+	trial_datasets : list
+		cached datasets of each trial (see cache_trial_datasets)
+	user_values : Dict
+		TrialRecord.User variables of the whole session (see read_user_fields)
+	session_dict : Dict
+		session-wide fields (see session_info), the trial fields are added to it
+	trial_offset : int
+		index of the first trial in the session (for user_values)
 
-		# lick data
-		x = np.array(trial_data['AnalogData']['General']['Gen1'])
-		session_dict['lick'].append(x[0])
+  Returns
+  -------
+	session_dict: Dict 
+		dictionary containing all specified data of the trials
+	'''
+	num_trials = len(trial_datasets)
+
+	# trial number, block, condition
+	session_dict['trial_num'] = read_scalar_field(trial_datasets, 'Trial', np.int64) # starts at Trial 1...Trial N
+	session_dict['block'] = read_scalar_field(trial_datasets, 'Block', np.int64)
+	session_dict['condition'] = read_scalar_field(trial_datasets, 'Condition', np.int64)
 
-		# reward data
-		# x = np.array(trial_data['VariableChanges'])
+	# error code mapping
+	#   - error_dict[0]     = 'correct'
+	#   - error_dict[{1-9}] = '<error_type>'
+	trial_result = read_scalar_field(trial_datasets, 'TrialError', np.int64)
+	session_dict['correct'] = (trial_result == 0).astype(np.int64)
+	session_dict['error'] = (trial_result != 0).astype(np.int64)
+	session_dict['error_type'] = trial_result
 
-		# photodiode data
-		x = np.array(trial_data['AnalogData']['PhotoDiode'])
-		session_dict['photodiode'].append(x[0])
+	# behavioral codes
+	behavioral_code_markers = np.empty(num_trials, dtype=object)
+	behavioral_code_times = np.empty(num_trials, dtype=object)
+	for t_index, datasets in enumerate(trial_datasets):
+		behavioral_code_markers[t_index] = list(map(int, read_dataset(datasets['BehavioralCodes/CodeNumbers'])[0]))
+		behavioral_code_times[t_index] = read_dataset(datasets['BehavioralCodes/CodeTimes'])[0]
+	session_dict['behavioral_code_markers'] = behavioral_code_markers
+	session_dict['behavioral_code_times'] = behavioral_code_times
 
-		# trial start time (relative to session start)
-		trial_start_time = float(trial_data['AbsoluteTrialStartTime'][()][0][0])
-		session_dict['trial_start'].append(trial_start_time)
-		
-		# trial start time (absolute)
-		length_trial = len(x[0])
+	# stimuli info (all hard coded by MonkeyLogic and therefore here as well)
+	stimuli_dict = defaultdict(list)
+	stimuli_prefix = 'TaskObject/Attribute/'
+	for datasets in trial_datasets:
+		stimuli_attribute = defaultdict(dict)
+		for field, dataset in datasets.items():
+			if field.startswith(stimuli_prefix):
+				stimulus, _, stimulus_field = field[len(stimuli_prefix):].partition('/')
+				if stimulus_field: # list of stimuli in stimuli_attribute
+					stimuli_attribute[stimulus][stimulus_field] = h5py.Dataset(dataset)
+		for stimulus in stimuli_attribute.values():
+			stimuli_dict, session_dict = stimulus_parser(stimulus, stimuli_dict, session_dict)
 
-		start_datetime, end_datetime = calculate_end_time(trial_data['TrialDateTime'][()], length_trial)
+	# user-generated variables (TrialRecord.User)
+	for key, values in user_values.items():
+		session_dict[key] = values[trial_offset:trial_offset+num_trials]
 
-		session_dict['trial_datetime_start'].append(start_datetime)
-		session_dict['trial_datetime_end'].append(end_datetime)
+	for keys, field in ANALOG_FIELDS:
+		row_arrays = read_analog_field(trial_datasets, field, rows=tuple(range(len(keys))))
+		if row_arrays is None:
+			continue # no <field> data
+		for key, row_array in zip(keys, row_arrays):
+			session_dict[key] = row_array
 
+	# lick/blink/pupil on-off events (thresholded once, see events.py)
+	if 'lick' in session_dict:
+		session_dict['lick_events'] = lick_events(session_dict['lick']).to_ragged()
+	if 'eye_x' in session_dict:
+		session_dict['blink_events'] = blink_events(session_dict['eye_x'], session_dict['eye_y']).to_ragged()
+	if 'eye_pupil' in session_dict:
+		session_dict['pupil_zero_events'] = pupil_zero_events(session_dict['eye_pupil']).to_ragged()
+
+	# trial start time (relative to session start)
+	session_dict['trial_start'] = read_scalar_field(trial_datasets, 'AbsoluteTrialStartTime', np.float64)
+
+	# trial start time (absolute)
+	trial_datetime_start = np.empty(num_trials, dtype=object)
+	trial_datetime_end = np.empty(num_trials, dtype=object)
+	trial_lengths = session_dict['photodiode'].lengths
+	for t_index, datasets in enumerate(trial_datasets):
+		length_trial = int(trial_lengths[t_index])
+		trial_datetime_start[t_index], trial_datetime_end[t_index] = \
+			calculate_end_time(read_dataset(datasets['TrialDateTime']), length_trial)
+	session_dict['trial_datetime_start'] = list(trial_datetime_start)
+	session_dict['trial_datetime_end'] = list(trial_datetime_end)
 
 	# pop all non-equal keys
-	num_trials = len(session_dict['trial_num'])
 	for key in list(session_dict.keys()):
 		# excluded from checks
 		if key in ['date', 'subject']:
@@ -255,7 +334,69 @@ def session_parser(session, trial_list, trial_record, date_input, monkey_input):
 		except:
 			pass
 
+	return session_dict
+
+def session_parser(session, trial_list, trial_record, date_input, monkey_input):
+	'''Parses out session data
+
+  Parameters
+  ----------
+	session : .h5 file
+		specified session for parsing
+	trial_list : list
+		list of trials within session
+
+  Returns
+  -------
+	session_dict: Dict 
+		dictionary containing all specified session data
+	'''
+	session_dict = session_info(session, date_input, monkey_input)
+	error_dict, behavioral_code_dict = code_mappings(trial_record)
+
+	# trial_list is ordered already (Trial1...TrialN) but we should put in some checks
+	# to make sure that it holds in all cases
+	trial_datasets = cache_trial_datasets(session, trial_list)
+	user_values = read_user_fields(trial_record, len(trial_datasets))
+	session_dict = trial_parser(trial_datasets, user_values, session_dict)
+
 	print('    Correct trials: {}'.format(np.sum(session_dict['correct'])))
 	print('    Errored trials: {}'.format(np.sum(session_dict['error'])))
 
-	return session_dict, error_dict, behavioral_code_dict
\ No newline at end of file
+	return session_dict, error_dict, behavioral_code_dict
+
+def iter_session_parser(session, trial_list, trial_record, date_input, monkey_input, batch_size=BATCH_SIZE):
+	'''Parses out session data <batch_size> trials at a time
+
+  Same fields as session_parser, but only one batch of trials is
+  held in memory at a time (see session_store.SessionStoreWriter).
+  The error/behavioral code mappings come from code_mappings.
+
+  Parameters
+  ----------
+	session : .h5 file
+		specified session for parsing
+	trial_list : list
+		list of trials within session
+	batch_size : int
+		number of trials per batch
+
+  Yields
+  -------
+	session_dict: Dict 
+		dictionary containing the data of the next <batch_size> trials
+	'''
+	trial_datasets = cache_trial_datasets(session, trial_list)
+	user_values = read_user_fields(trial_record, len(trial_datasets))
+	num_correct = 0
+	num_error = 0
+	for trial_offset in range(0, len(trial_datasets), batch_size):
+		session_dict = session_info(session, date_input, monkey_input)
+		session_dict = trial_parser(trial_datasets[trial_offset:trial_offset+batch_size],
+																user_values, session_dict, trial_offset)
+		num_correct += np.sum(session_dict['correct'])
+		num_error += np.sum(session_dict['error'])
+		yield session_dict
+
+	print('    Correct trials: {}'.format(num_correct))
+	print('    Errored trials: {}'.format(num_error))
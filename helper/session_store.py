@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+
+from ragged import RaggedArray, SIGNAL_COLUMNS
+from events import EVENT_COLUMNS
+
+# Processed session format (one directory per date):
+#   <date>_<monkey>_<experiment>_behave/
+#     trials.parquet           - scalar trial columns (one row per trial)
+#     <column>.values.npy      - concatenated per-trial data for each ragged column
+#     <column>.offsets.npy     - int64 offsets (trial i = values[offsets[i]:offsets[i+1]])
+#     metadata.json            - error/behavioral code mappings, column order
+STORE_VERSION = 1
+STORE_SUFFIX = 'behave'
+TRIALS_FILE = 'trials.parquet'
+METADATA_FILE = 'metadata.json'
+RAGGED_COLUMNS = SIGNAL_COLUMNS + EVENT_COLUMNS + ['behavioral_code_markers', 'behavioral_code_times']
+INTEGER_COLUMNS = EVENT_COLUMNS + ['behavioral_code_markers']
+NPY_HEADER_SIZE = 128 # fixed .npy header size of streamed ragged columns (see write_npy_header)
+
+def store_name(date, monkey_input, experiment_name):
+	'''Directory name of a processed session (matches h5_helper.file_selector)'''
+	return '_'.join([date, monkey_input, experiment_name, STORE_SUFFIX])
+
+def is_session_store(path):
+	'''Checks whether path is a processed session directory'''
+	return os.path.isdir(path) and os.path.exists(os.path.join(path, METADATA_FILE))
+
+def save_session(date_df, store_path, error_dict, behavioral_code_dict):
+	'''
+	Writes a single session DataFrame to the columnar session store
+
+	Args:
+		date_df (DataFrame): session_df rows for a single date
+		store_path (str): directory to write the session to
+		error_dict (dict): dictionary containing error mapping
+		behavioral_code_dict (dict): dictionary containing behavioral code mapping
+	'''
+	if os.path.exists(store_path) == False:
+		os.makedirs(store_path)
+	ragged_columns = [column for column in RAGGED_COLUMNS if column in date_df.columns]
+	for column in ragged_columns:
+		dtype = np.int64 if column in INTEGER_COLUMNS else np.float64
+		ragged = RaggedArray.from_column(date_df[column], dtype=dtype)
+		np.save(os.path.join(store_path, column+'.values.npy'), ragged.buffer[ragged.offsets[0]:ragged.offsets[-1]])
+		np.save(os.path.join(store_path, column+'.offsets.npy'), ragged.offsets - ragged.offsets[0])
+	trials_df = date_df.drop(columns=ragged_columns).reset_index(drop=True)
+	trials_df.to_parquet(os.path.join(store_path, TRIALS_FILE), index=False)
+	metadata = store_metadata(len(date_df), list(date_df.columns), ragged_columns,
+														error_dict, behavioral_code_dict)
+	with open(os.path.join(store_path, METADATA_FILE), 'w') as f:
+		json.dump(metadata, f, indent=1)
+
+def save_sessions(save_df, save_path, session_df, monkey_input, experiment_name,
+									error_dict, behavioral_code_dict):
+	'''Saves each session (by date) to the columnar session store'''
+	if save_df:
+		print('Saving processed sessions to: {}'.format(save_path))
+		for date in session_df['date'].unique():
+			t0 = time.time()
+			file_name = store_name(date, monkey_input, experiment_name)
+			print('  Saving {}'.format(file_name))
+			date_df = session_df[session_df['date']==date]
+			save_session(date_df, os.path.join(save_path, file_name), error_dict, behavioral_code_dict)
+			t1 = time.time()
+			total_t = round(t1-t0, 4)
+			print('    Total time to save: {} sec'.format(total_t))
+
+def store_metadata(num_trials, column_order, ragged_columns, error_dict, behavioral_code_dict):
+	'''metadata.json contents of a processed session'''
+	return {
+		'store_version': STORE_VERSION,
+		'num_trials': num_trials,
+		'column_order': column_order,
+		'ragged_columns': ragged_columns,
+		# json keys are strings, behavioral codes are stored as [code, name] pairs
+		'error_dict': dict(error_dict),
+		'behavioral_code_dict': [[int(code), name] for code, name in behavioral_code_dict.items()],
+	}
+
+class SessionStoreWriter:
+	'''
+	Writes a session to the columnar session store one batch of trials
+	at a time (see session_parse_helper.iter_session_parser), so only
+	the current batch is held in memory. Ragged values are appended to
+	their .values.npy files, trial rows are appended to trials.parquet
+	as row groups, and metadata.json is written last by close (until
+	then the directory is not a session store, see is_session_store).
+
+	Args:
+		store_path (str): directory to write the session to
+		error_dict (dict): dictionary containing error mapping
+		behavioral_code_dict (dict): dictionary containing behavioral code mapping
+	'''
+	def __init__(self, store_path, error_dict, behavioral_code_dict):
+		self.store_path = store_path
+		self.error_dict = error_dict
+		self.behavioral_code_dict = behavioral_code_dict
+		self.num_trials = 0
+		self.column_order = None
+		self.ragged_columns = None
+		self.values_files = {}
+		self.offsets = {}
+		self.trials_writer = None
+		if os.path.exists(store_path) == False:
+			os.makedirs(store_path)
+		# stale metadata from a previous write would mark a partial store as complete
+		if os.path.exists(os.path.join(store_path, METADATA_FILE)):
+			os.remove(os.path.join(store_path, METADATA_FILE))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+	def open_columns(self, batch_df):
+		'''Fixes the column order and opens the ragged column files (first batch)'''
+		self.column_order = list(batch_df.columns)
+		self.ragged_columns = [column for column in RAGGED_COLUMNS if column in batch_df.columns]
+		for column in self.ragged_columns:
+			dtype = np.dtype(np.int64 if column in INTEGER_COLUMNS else np.float64)
+			values_file = open(os.path.join(self.store_path, column+'.values.npy'), 'wb')
+			write_npy_header(values_file, dtype, 0)
+			self.values_files[column] = (values_file, dtype)
+			self.offsets[column] = [np.zeros(1, dtype=np.int64)]
+
+	def append(self, batch_df):
+		'''Appends a batch of trials (session_df rows, same columns as the first batch)'''
+		if self.column_order is None:
+			self.open_columns(batch_df)
+		missing = [column for column in self.column_order if column not in batch_df.columns]
+		if any(column in self.ragged_columns for column in missing):
+			raise ValueError('{} missing from trials {}-{} of {}'.format(
+				missing, self.num_trials, self.num_trials+len(batch_df), self.store_path))
+		if missing:
+			print('  {} missing from trials {}-{}, set to None'.format(
+				', '.join(missing), self.num_trials, self.num_trials+len(batch_df)))
+			batch_df = batch_df.assign(**{column: None for column in missing})
+		for column in self.ragged_columns:
+			values_file, dtype = self.values_files[column]
+			ragged = RaggedArray.from_column(batch_df[column], dtype=dtype)
+			values_file.write(np.ascontiguousarray(ragged.buffer[ragged.offsets[0]:ragged.offsets[-1]]).tobytes())
+			self.offsets[column].append(self.offsets[column][-1][-1] + ragged.offsets[1:] - ragged.offsets[0])
+		scalar_columns = [column for column in self.column_order if column not in self.ragged_columns]
+		self.write_trials(batch_df[scalar_columns].reset_index(drop=True))
+		self.num_trials += len(batch_df)
+
+	def write_trials(self, trials_df):
+		import pyarrow as pa
+		import pyarrow.parquet as pq
+		if self.trials_writer is None:
+			table = pa.Table.from_pandas(trials_df, preserve_index=False)
+			self.trials_writer = pq.ParquetWriter(os.path.join(self.store_path, TRIALS_FILE), table.schema)
+		else:
+			table = pa.Table.from_pandas(trials_df, schema=self.trials_writer.schema, preserve_index=False)
+		self.trials_writer.write_table(table)
+
+	def close(self):
+		'''Finishes the ragged column files and writes metadata.json'''
+		if self.column_order is None:
+			raise ValueError('no trials written to {}'.format(self.store_path))
+		for column, (values_file, dtype) in self.values_files.items():
+			offsets = np.concatenate(self.offsets[column])
+			values_file.seek(0)
+			write_npy_header(values_file, dtype, int(offsets[-1]))
+			values_file.close()
+			np.save(os.path.join(self.store_path, column+'.offsets.npy'), offsets)
+		self.trials_writer.close()
+		metadata = store_metadata(self.num_trials, self.column_order, self.ragged_columns,
+															self.error_dict, self.behavioral_code_dict)
+		with open(os.path.join(self.store_path, METADATA_FILE), 'w') as f:
+			json.dump(metadata, f, indent=1)
+
+	def abort(self):
+		'''Closes the open files without writing metadata.json (the session stays incomplete)'''
+		for values_file, _ in self.values_files.values():
+			values_file.close()
+		if self.trials_writer is not None:
+			self.trials_writer.close()
+
+def write_npy_header(f, dtype, length):
+	'''
+	Writes the .npy header of a 1D array of <length> values. The header is
+	padded to a fixed size, so it can be rewritten once the length is known.
+	'''
+	header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (length,)}
+	header_str = repr(header).encode('latin1')
+	header_len = NPY_HEADER_SIZE - len(np.lib.format.MAGIC_PREFIX) - 4
+	f.write(np.lib.format.magic(1, 0))
+	f.write(np.array(header_len, dtype='<u2').tobytes())
+	f.write(header_str.ljust(header_len-1) + b'\n')
+
+def load_metadata(store_path):
+	'''Reads the metadata of a processed session'''
+	with open(os.path.join(store_path, METADATA_FILE), 'r') as f:
+		metadata = json.load(f)
+	if metadata['store_version'] > STORE_VERSION:
+		raise RuntimeError('{} was written by a newer session store (version {})'.format(
+			store_path, metadata['store_version']))
+	return metadata
+
+def load_ragged(store_path, column, mmap=True):
+	'''Loads a single ragged column (memory-mapped by default) as a RaggedArray'''
+	mmap_mode = 'r' if mmap else None
+	values = np.load(os.path.join(store_path, column+'.values.npy'), mmap_mode=mmap_mode)
+	offsets = np.load(os.path.join(store_path, column+'.offsets.npy'))
+	return RaggedArray(values, offsets)
+
+def load_session(store_path, columns=None, mmap=True):
+	'''
+	Loads a processed session from the columnar session store
+
+	Args:
+		store_path (str): processed session directory
+		columns (list): only load these columns (default: all columns)
+		mmap (bool): memory-map the ragged columns instead of reading them into memory
+
+	Returns:
+		df (DataFrame): session DataFrame (ragged columns hold per-trial views)
+		error_dict (dict): dictionary containing error mapping
+		behavioral_code_dict (dict): dictionary containing behavioral code mapping
+	'''
+	metadata = load_metadata(store_path)
+	column_order = metadata['column_order']
+	if columns is not None:
+		column_order = [column for column in column_order if column in columns]
+	ragged_columns = [column for column in column_order if column in metadata['ragged_columns']]
+	scalar_columns = [column for column in column_order if column not in ragged_columns]
+	df = pd.read_parquet(os.path.join(store_path, TRIALS_FILE), columns=scalar_columns)
+	for column in ragged_columns:
+		df[column] = ragged_column(load_ragged(store_path, column, mmap=mmap), column)
+	df = df[column_order]
+	error_dict, behavioral_code_dict = metadata_mappings(metadata)
+	return df, error_dict, behavioral_code_dict
+
+def ragged_column(ragged, column):
+	'''session_df column (per-trial views) of a stored RaggedArray'''
+	if column == 'behavioral_code_markers':
+		return [list(map(int, markers)) for markers in ragged]
+	return ragged.to_object_array()
+
+def metadata_mappings(metadata):
+	'''error_dict and behavioral_code_dict of a processed session'''
+	error_dict = defaultdict(str, metadata['error_dict'])
+	behavioral_code_dict = defaultdict(str, {code: name for code, name in metadata['behavioral_code_dict']})
+	return error_dict, behavioral_code_dict
+
+def iter_session(store_path, batch_size, columns=None):
+	'''
+	Loads a processed session <batch_size> trials at a time (i.e. for
+	add_fields.iter_add_fields). Ragged columns are memory-mapped and
+	only the scalar columns of the current batch are read.
+
+	Args:
+		store_path (str): processed session directory
+		batch_size (int): number of trials per batch
+		columns (list): only load these columns (default: all columns)
+
+	Yields:
+		batch_df (DataFrame): session DataFrame rows (indexed by trial in the session)
+	'''
+	import pyarrow.parquet as pq
+	metadata = load_metadata(store_path)
+	column_order = metadata['column_order']
+	if columns is not None:
+		column_order = [column for column in column_order if column in columns]
+	ragged_columns = [column for column in column_order if column in metadata['ragged_columns']]
+	scalar_columns = [column for column in column_order if column not in ragged_columns]
+	raggeds = {column: load_ragged(store_path, column) for column in ragged_columns}
+	trials_file = pq.ParquetFile(os.path.join(store_path, TRIALS_FILE))
+	trial_offset = 0
+	for record_batch in trials_file.iter_batches(batch_size=batch_size, columns=scalar_columns):
+		batch_df = record_batch.to_pandas()
+		batch_offsets = slice(trial_offset, trial_offset+len(batch_df)+1)
+		batch_df.index = pd.RangeIndex(trial_offset, trial_offset+len(batch_df))
+		for column in ragged_columns:
+			# zero-copy views of the memory-mapped values
+			batch_ragged = RaggedArray(raggeds[column].buffer, raggeds[column].offsets[batch_offsets])
+			batch_df[column] = ragged_column(batch_ragged, column)
+		trial_offset += len(batch_df)
+		yield batch_df[column_order]
@@ -0,0 +1,141 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+from ragged import RaggedArray
+from bit_raster import RasterRow, BitRaster
+from session_parse_helper import PARSER_VERSION
+
+# bump whenever the summary table changes (invalidates SummaryCache entries)
+SUMMARY_VERSION = 1
+SUMMARY_KEYS = ['date', 'block', 'condition', 'valence', 'stimuli_name', 'fractal_count_in_block']
+SUMMARY_MEASURES = ['lick_count_window', 'blink_count_window', 'lick_duration', 'blink_duration_offscreen',
+										'blink_duration_sig', 'pupil_data_window', 'pupil_raster_window_avg', 'eye_distance']
+SUMMARY_CACHE_FOLDER = '.summary_cache'
+SUMMARY_CACHE_FILE = 'session_summary.parquet'
+
+def trial_nanmean(column):
+	'''
+	np.nanmean of every trial of a session_df column, for all trials at once:
+	RasterRow windows (i.e. lick_count_window) use the packed bit counts,
+	per-trial arrays (i.e. pupil_data_window) a single bincount, and
+	scalar columns are returned as floats. np.nan rows stay np.nan.
+	'''
+	rows = list(column)
+	means = np.full(len(rows), np.nan)
+	valid = np.array([not (isinstance(row, float) and np.isnan(row)) for row in rows], dtype=bool)
+	valid_rows = [rows[t_index] for t_index in np.flatnonzero(valid)]
+	if not valid_rows:
+		return means
+	if all(isinstance(row, RasterRow) for row in valid_rows):
+		raster, _, starts, stops = BitRaster.from_rows(valid_rows)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			means[valid] = raster.count_range(starts, stops) / (stops - starts)
+		return means
+	if all(np.ndim(row) == 0 for row in valid_rows):
+		return np.asarray(rows, dtype=float)
+	ragged = RaggedArray.from_column(valid_rows)
+	values = ragged.buffer[ragged.offsets[0]:ragged.offsets[-1]]
+	trial_ids = ragged.trial_ids()
+	not_nan = ~np.isnan(values)
+	sums = np.bincount(trial_ids[not_nan], weights=values[not_nan], minlength=len(valid_rows))
+	counts = np.bincount(trial_ids[not_nan], minlength=len(valid_rows))
+	with np.errstate(invalid='ignore', divide='ignore'):
+		means[valid] = sums / counts
+	return means
+
+def trial_measures(df, measures=SUMMARY_MEASURES, keys=SUMMARY_KEYS):
+	'''Columnar table of the summary keys and one float per trial for each measure'''
+	table = pd.DataFrame({key: df[key].values for key in keys if key in df.columns})
+	for measure in measures:
+		if measure in df.columns:
+			table[measure] = trial_nanmean(df[measure])
+	return table
+
+def summarize_sessions(df, measures=SUMMARY_MEASURES, keys=SUMMARY_KEYS):
+	'''
+	Summarizes a (multi-session) session_df in one groupby pass
+
+	Args:
+		df: session_df DataFrame (with add_fields columns)
+		measures: columns summarized (per-trial np.nanmean first, see trial_nanmean)
+		keys: grouping columns
+
+	Returns:
+		summary: one row per group with the number of trials and <measure>_sum,
+			<measure>_count (non-nan trials) for each measure, so groups can be
+			combined again with summary_mean
+	'''
+	table = trial_measures(df, measures, keys)
+	keys = [key for key in keys if key in table.columns]
+	measures = [measure for measure in measures if measure in table.columns]
+	grouped = table.groupby(keys, sort=True, dropna=False)
+	summary = grouped.size().to_frame('trials')
+	for measure in measures:
+		summary[measure+'_sum'] = grouped[measure].sum()
+		summary[measure+'_count'] = grouped[measure].count()
+	return summary.reset_index()
+
+def summary_mean(summary, by, measure):
+	'''Mean of measure (over trials) for every group of <by> columns of a summary table'''
+	grouped = summary.groupby(by, sort=True)[[measure+'_sum', measure+'_count']].sum()
+	with np.errstate(invalid='ignore', divide='ignore'):
+		return grouped[measure+'_sum'] / grouped[measure+'_count'].replace(0, np.nan)
+
+class SummaryCache:
+	'''
+	Keeps the summary table of every session in a single parquet file
+	(<cache_path>/session_summary.parquet) so longitudinal plots can be
+	made from the summaries alone. A date is recomputed when its number
+	of trials, the Session windows (window_lick/window_blink), the offscreen
+	eye values (Session.blink_signal, which depend on every loaded date) or
+	the parser (session_parse_helper.PARSER_VERSION, i.e. re-ingested data)
+	change.
+
+	Args:
+		cache_path (str): directory of the cache file (i.e. <TARGET_PATH>/.summary_cache)
+	'''
+	def __init__(self, cache_path):
+		self.cache_path = cache_path
+		self.cache_file = os.path.join(cache_path, SUMMARY_CACHE_FILE)
+
+	def load(self):
+		'''Cached summary table (None if there is none)'''
+		if not os.path.exists(self.cache_file):
+			return None
+		summary = pd.read_parquet(self.cache_file)
+		return summary[summary['summary_version'] == SUMMARY_VERSION]
+
+	def summarize(self, df, session_obj):
+		'''Summary table of every date in df, only summarizing dates that are not cached'''
+		blink_signal = sorted((key, float(value)) for key, value in session_obj.blink_signal.items())
+		blink_signal_digest = hashlib.sha1(repr(blink_signal).encode()).hexdigest()[:12]
+		cache_key = '{}_{}_{}_{}_{}'.format(SUMMARY_VERSION, PARSER_VERSION, session_obj.window_lick,
+																				session_obj.window_blink, blink_signal_digest)
+		cached = self.load()
+		date_trials = df.groupby('date').size()
+		summaries = []
+		new_dates = []
+		for date, num_trials in date_trials.items():
+			cached_date = None
+			if cached is not None:
+				cached_date = cached[(cached['date'] == date) & (cached['cache_key'] == cache_key)]
+			if cached_date is not None and len(cached_date) and cached_date['trials'].sum() == num_trials:
+				summaries.append(cached_date)
+			else:
+				new_dates.append(date)
+		if new_dates:
+			print('  Summarizing {} session(s): {}'.format(len(new_dates), ', '.join(map(str, new_dates))))
+			new_summary = summarize_sessions(df[df['date'].isin(new_dates)])
+			new_summary['cache_key'] = cache_key
+			new_summary['summary_version'] = SUMMARY_VERSION
+			summaries.append(new_summary)
+			# keep the other cached dates (i.e. not loaded in df)
+			other_dates = [] if cached is None else [cached[~cached['date'].isin(date_trials.index)]]
+			if os.path.exists(self.cache_path) == False:
+				os.makedirs(self.cache_path)
+			pd.concat(summaries + other_dates, ignore_index=True).to_parquet(self.cache_file, index=False)
+		summary = pd.concat(summaries, ignore_index=True)
+		return summary.sort_values(['date'] + [key for key in SUMMARY_KEYS if key != 'date'],
+															 kind='stable').reset_index(drop=True)
@@ -0,0 +1,112 @@
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from frame_manifest import read_frames
+
+# every frame of an MJPG avi is a keyframe, so clips are cut with exact seeks
+SESSION_VIDEO_FOURCC = 'MJPG'
+SESSION_VIDEO_EXTENSION = '.avi'
+SIDECAR_EXTENSION = '.frames.parquet'
+SIDECAR_COLUMNS = ['video_frame', 'frame_number', 'filename', 'timestamp']
+
+def session_video_path(save_folder, folder_path, camera):
+	'''Path of the session video of a camera of an image folder (i.e. <save_folder>/Aragorn_220902_images_cam0.avi)'''
+	folder_name = os.path.basename(os.path.normpath(folder_path))
+	return os.path.join(save_folder, '{}_cam{}{}'.format(folder_name, camera, SESSION_VIDEO_EXTENSION))
+
+class SessionVideo:
+	'''
+	Continuous video of every image of one camera of an image folder,
+	with a sidecar table (<video>.frames.parquet) mapping each video frame
+	to its frame number, image and timestamp (see FrameManifest). Trial
+	clips are cut from it by frame number with random access, so clips
+	of other trials or windows never decode the JPEG archive again.
+
+	Args:
+		video_path (str): session video
+		sidecar (pd.DataFrame): SIDECAR_COLUMNS, one row per video frame
+	'''
+	def __init__(self, video_path, sidecar):
+		self.video_path = video_path
+		self.sidecar = sidecar.reset_index(drop=True)
+		self.frame_numbers = self.sidecar['frame_number'].values
+
+	def __len__(self):
+		return len(self.sidecar)
+
+	def __repr__(self):
+		return 'SessionVideo({}, frames={})'.format(self.video_path, len(self))
+
+	@classmethod
+	def load(cls, video_path, manifest=None, camera=None):
+		'''
+		Session video at video_path, None if it is missing or (with a
+		manifest) no longer has the images of camera in the manifest
+		'''
+		sidecar_path = video_path + SIDECAR_EXTENSION
+		if not os.path.exists(video_path) or not os.path.exists(sidecar_path):
+			return None
+		sidecar = pd.read_parquet(sidecar_path)
+		if manifest is not None and not np.array_equal(sidecar['filename'].values,
+																									 manifest.images(camera)['filename'].values):
+			return None
+		return cls(video_path, sidecar)
+
+	@classmethod
+	def build(cls, manifest, camera, video_path, threads=2, prefetch=8):
+		'''Encodes every image of camera (in frame order) and writes the sidecar'''
+		images = manifest.images(camera)
+		camera_table = manifest.camera(camera)
+		timestamps = camera_table[camera_table['timestamp'] >= 0]
+		timestamps = timestamps[~timestamps['frame_number'].duplicated()].set_index('frame_number')['timestamp']
+		sidecar = pd.DataFrame({'video_frame': np.arange(len(images)),
+														'frame_number': images['frame_number'].values,
+														'filename': images['filename'].values,
+														'timestamp': timestamps.reindex(images['frame_number'].values, fill_value=-1).values})
+		# nominal frame rate (clips are written with the rate of their own segment)
+		frame_ns = np.diff(sidecar['timestamp'].values[sidecar['timestamp'].values >= 0])
+		frame_rate = 1e9 / np.median(frame_ns) if len(frame_ns) > 0 and np.median(frame_ns) > 0 else 30.0
+		frame = cv2.imread(os.path.join(manifest.folder_path, images['filename'].iloc[0]))
+		height, width, layers = frame.shape
+		fourcc = cv2.VideoWriter_fourcc(*SESSION_VIDEO_FOURCC)
+		video = cv2.VideoWriter(video_path, fourcc, frame_rate, (width,height))
+		video.set(cv2.VIDEOWRITER_PROP_QUALITY, 100)
+		for frame in read_frames(manifest.folder_path, images['filename'].tolist(), threads, prefetch):
+			video.write(frame)
+		video.release()
+		sidecar.to_parquet(video_path + SIDECAR_EXTENSION, index=False)
+		return cls(video_path, sidecar)
+
+	def frame_range(self, frame_index_start, frame_index_end):
+		'''Video frames (first, last + 1) of frame numbers frame_index_start to frame_index_end (inclusive)'''
+		return (int(np.searchsorted(self.frame_numbers, frame_index_start, side='left')),
+						int(np.searchsorted(self.frame_numbers, frame_index_end, side='right')))
+
+	def cut(self, frame_index_start, frame_index_end, video_save_path, frame_rate):
+		'''
+		Writes frame numbers frame_index_start to frame_index_end (inclusive) to an mp4
+
+		Returns:
+			frame_count (int): number of frames written
+		'''
+		start, stop = self.frame_range(frame_index_start, frame_index_end)
+		capture = cv2.VideoCapture(self.video_path)
+		width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+		height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+		capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+		fourcc = cv2.VideoWriter_fourcc('m','p','4','v')
+		video = cv2.VideoWriter(video_save_path, fourcc, frame_rate, (width,height))
+		frame = None
+		frame_count = 0
+		for _ in range(stop - start):
+			ok, frame = capture.read(frame)
+			if not ok:
+				break
+			video.write(frame)
+			frame_count += 1
+		capture.release()
+		video.release()
+		return frame_count
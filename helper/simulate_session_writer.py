@@ -0,0 +1,37 @@
+# Simulates a MonkeyLogic session that is still being recorded by copying
+# the trials of a finished .h5 file into a new file one at a time (i.e. to
+# test live_session.LiveSession without a rig)
+#
+# usage: python simulate_session_writer.py <source.h5> <target.h5> [seconds per trial]
+
+import sys
+import time
+import h5py
+
+from live_session import trial_names
+
+TRIAL_INTERVAL = 1.0 # seconds between trials
+
+def simulate_session(source_path, target_path, trial_interval=TRIAL_INTERVAL, num_trials=None):
+	'''
+	Writes everything but the trials of source_path to target_path, then
+	appends one TrialN group every trial_interval seconds (the file is
+	closed after every trial, as MonkeyLogic does)
+	'''
+	with h5py.File(source_path, 'r') as source:
+		trial_list = trial_names(source['ML'])[:num_trials]
+		with h5py.File(target_path, 'w', locking=False) as target:
+			target_ml = target.create_group('ML')
+			for key in source['ML'].keys():
+				if key not in trial_list:
+					source.copy(source['ML'][key], target_ml, name=key)
+		print('Simulating {} trials: {}'.format(len(trial_list), target_path))
+		for trial in trial_list:
+			time.sleep(trial_interval)
+			with h5py.File(target_path, 'a', locking=False) as target:
+				source.copy(source['ML'][trial], target['ML'], name=trial)
+			print('  {} written'.format(trial))
+
+if __name__ == '__main__':
+	trial_interval = float(sys.argv[3]) if len(sys.argv) > 3 else TRIAL_INTERVAL
+	simulate_session(sys.argv[1], sys.argv[2], trial_interval)
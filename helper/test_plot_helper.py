@@ -0,0 +1,49 @@
+import warnings
+
+import numpy as np
+from scipy import stats
+
+from plot_helper import moving_welch, welch_test
+
+def ttest_windows(a, b, N):
+	'''scipy reference: Welch t-test p value of every window of N trials'''
+	p_values = []
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore')
+		for w_index in range(min(len(a), len(b)) - N + 1):
+			p_values.append(stats.ttest_ind(a[w_index:w_index+N], b[w_index:w_index+N], equal_var=False).pvalue)
+	return np.array(p_values)
+
+def check_moving_welch(a, b, N):
+	_, _, p, _ = moving_welch([a, b], N)
+	expected = ttest_windows(a, b, N)
+	p = p[0, :len(expected)]
+	np.testing.assert_array_equal(np.isnan(p), np.isnan(expected))
+	np.testing.assert_allclose(p[~np.isnan(p)], expected[~np.isnan(expected)], rtol=1e-7, atol=1e-12)
+
+def test_moving_welch_random():
+	rng = np.random.default_rng(0)
+	check_moving_welch(rng.random(40), rng.random(40) + 0.2, 10)
+
+def test_moving_welch_nan_only_affects_its_windows():
+	rng = np.random.default_rng(1)
+	a = rng.random(40)
+	b = rng.random(40)
+	a[5] = np.nan
+	check_moving_welch(a, b, 10)
+	_, _, p, _ = moving_welch([a, b], 10)
+	# only windows 0-5 contain trial 5
+	assert np.isnan(p[0, :6]).all()
+	assert not np.isnan(p[0, 6:31]).any()
+
+def test_moving_welch_constant_windows():
+	# constant windows with different means (p=0) and with equal means (np.nan)
+	a = np.concatenate([np.ones(15), np.linspace(0, 1, 15)])
+	b = np.concatenate([np.zeros(10), np.ones(5), np.linspace(1, 0, 15)])
+	check_moving_welch(a, b, 5)
+
+def test_welch_test_constant():
+	_, p = welch_test(1.0, 0.0, 5, 0.0, 0.0, 5)
+	assert p == stats.ttest_ind(np.ones(5), np.zeros(5), equal_var=False).pvalue == 0.0
+	_, p = welch_test(1.0, 0.0, 5, 1.0, 0.0, 5)
+	assert np.isnan(p)
@@ -0,0 +1,69 @@
+import numpy as np
+
+from ragged import RaggedArray
+from bit_raster import RasterRow, BitRaster
+from feature_engine import epoch_times
+
+def trace_buffer(column):
+	'''
+	Returns (buffer, starts, stops) for a per-trial column so that trial i
+	is buffer[starts[i]:stops[i]]. Signal columns share their existing
+	buffer, and RasterRow columns (i.e. lick_raster) are unpacked once.
+	'''
+	column = list(column)
+	if len(column) and all(isinstance(row, RasterRow) for row in column):
+		raster, _, starts, stops = BitRaster.from_rows(column)
+		buffer = np.unpackbits(raster.bits, bitorder='little')
+		return buffer, starts, stops
+	ragged = RaggedArray.from_column(column)
+	return ragged.buffer, ragged.starts, ragged.stops
+
+def aligned_trace_matrix(column, align_times, pre=0, post=None, lengths=None):
+	'''
+	Builds a dense (trials x time) matrix of a per-trial signal aligned to
+	an event, in a single gather
+
+	Args:
+		column: per-trial signal (session_df column, i.e. df['lick_raster'])
+		align_times (np.ndarray): sample of the alignment event in each trial
+		pre (int): samples before the event
+		post (int): samples after the event (default: until the end of the longest trial)
+		lengths (np.ndarray): only use the first <lengths> samples after
+			align_time-pre of each trial (i.e. to match several signals)
+
+	Returns:
+		matrix (np.ndarray): float matrix, np.nan outside of each trial
+	'''
+	buffer, starts, stops = trace_buffer(column)
+	trial_lengths = stops - starts
+	first = np.asarray(align_times, dtype=np.int64) - pre
+	available = trial_lengths - first
+	if lengths is not None:
+		available = np.minimum(available, lengths)
+	if post is None:
+		width = max(int(available.max()), 0) if len(available) else 0
+	else:
+		width = max(pre + post, 0)
+	sample = first[:, None] + np.arange(width)
+	inside = (sample >= 0) & (sample < trial_lengths[:, None]) & \
+		(np.arange(width) < available[:, None])
+	matrix = np.full((len(first), width), np.nan)
+	matrix[inside] = buffer[(starts[:, None] + sample)[inside]]
+	return matrix
+
+def aligned_traces(df, column, event, pre=0, post=None, lengths=None):
+	'''aligned_trace_matrix of session_df[column] aligned to an epoch (i.e. 'CS On')'''
+	align_times, _ = epoch_times(df, event)
+	return aligned_trace_matrix(df[column], align_times, pre, post, lengths)
+
+def mean_sem(matrix):
+	'''
+	Mean and standard error of the mean of each column (time bin),
+	ignoring np.nan (trials that ended before the bin)
+	'''
+	count = np.sum(~np.isnan(matrix), axis=0)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mean = np.nansum(matrix, axis=0) / count
+		deviation = np.nansum((matrix - mean)**2, axis=0)
+		sem = np.sqrt(deviation / (count - 1)) / np.sqrt(count)
+	return mean, sem
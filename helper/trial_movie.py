@@ -11,6 +11,8 @@ import ruptures as rpt
 import matplotlib.animation as animation
 
 from eye_smooth import smooth_eye_data
+from ragged import RaggedArray
+from events import EventIntervals, lick_events
 
 def write_times(session_obj, session_df):
 	'''
@@ -72,8 +74,13 @@ def select_trial(session_df, session_obj):
 	f, axarr = plt.subplots(4, 1)
 	axarr[0].plot(x, trial_lick)
 	axarr[0].set_title('Lick')
-	lick_diff = [0] + list(np.diff(trial_lick))
-	lick_diff_sig = [x_index for x_index, x in enumerate(lick_diff) if abs(x) > 2.5]
+	# lick onsets/offsets (from the events derived at ingest)
+	if 'lick_events' in session_df.columns:
+		trial_events = EventIntervals.from_column([session_df['lick_events'].iloc[trial_selected]])
+	else:
+		trial_events = lick_events(RaggedArray.from_arrays([trial_lick]))
+	lick_onsets, lick_offsets = trial_events[0]
+	lick_diff_sig = sorted(list(lick_onsets) + list(lick_offsets))
 	# algo1 = rpt.Pelt(model="rbf").fit(trial_lick)
 	# change_location1 = algo1.predict(pen=10)
 	for c_index, change_point in enumerate(lick_diff_sig):
@@ -61,24 +61,14 @@ def trial_raster(df, session_obj):
 			lick_raster_time = lick_raster[cs_on:trace_end_extra]
 			blink_raster = fractal_df['blink_raster'].iloc[i]
 			blink_raster_time = blink_raster[cs_on:trace_end_extra]
-			lick_raster_window = []
-			blink_raster_window = []
 			length_window = round((trace_end_extra-cs_on)/10)*10
 			x_range = np.linspace(0,length_window,int(length_window/BIN)+1)
-			for j in x_range:
-				start = int(j)
-				if 1 in lick_raster_time[start:start+BIN]:
-					lick_raster_window.append(1)
-				else:
-					lick_raster_window.append(0)
-				if 1 in blink_raster_time[start:start+BIN]:
-					blink_raster_window.append(1)
-				else:
-					blink_raster_window.append(0)
-			lick_raster_window_index = [bin*(index+1) if bin != 0 else np.nan \
-																		for bin in lick_raster_window] # replace 0 with np.nan
-			blink_raster_window_index = [bin*(index+1) if bin != 0 else np.nan \
-																	for bin in blink_raster_window] # replace 0 with np.nan
+			# any lick/blink in each <BIN>ms bin (window queries on the packed rasters)
+			bin_start = x_range.astype(int)
+			lick_raster_window = lick_raster_time.any(bin_start, bin_start+BIN)
+			blink_raster_window = blink_raster_time.any(bin_start, bin_start+BIN)
+			lick_raster_window_index = np.where(lick_raster_window, index+1, np.nan) # replace 0 with np.nan
+			blink_raster_window_index = np.where(blink_raster_window, index+1, np.nan) # replace 0 with np.nan
 			
 			axarr1[pos_i][pos_j].scatter(x_range, lick_raster_window_index, marker='|', s=3, color=COLORS[f_index])
 			axarr2[pos_i][pos_j].scatter(x_range, blink_raster_window_index, marker='|', s=3, color=COLORS[f_index])
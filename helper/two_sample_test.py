@@ -13,7 +13,8 @@ import warnings
 warnings.filterwarnings("ignore")
 
 # Custom Functions
-from plot_helper import smooth_plot, round_up_to_odd, moving_avg, moving_var, set_plot_params
+from plot_helper import smooth_plot, round_up_to_odd, moving_avg, moving_var, moving_welch, welch_test, set_plot_params
+from bit_raster import window_any
 
 def generate_data_dict(session_df, session_obj):
 
@@ -22,49 +23,21 @@ def generate_data_dict(session_df, session_obj):
 	lick_data_duration = defaultdict(list)
 	blink_data_duration = defaultdict(list)
 
-	PRE_CS = 50 # time before CS-on (for moving average calculation)
-	FIGURE_SAVE_PATH = session_obj.figure_path
-	COLORS = session_obj.colors
+	# single bin lick data (-<WINDOW_THRESHOLD>ms from trace interval end)
+	# Lick/Blink Probability
+	## counts if there was any lick/blink in the specified time window
+	session_df = session_df.assign(lick_any=window_any(session_df['lick_count_window']).astype(int),
+																 blink_any=window_any(session_df['blink_count_window']).astype(int))
+	# Lick/Blink Duration (mean lick voltage in the <window_lick>ms before Trace End, blink time from add_fields)
 	WINDOW_THRESHOLD_LICK = session_obj.window_lick
-	
-	valence_list = sorted(session_df['valence'].unique(), reverse=True)
-	for df_index, valence in enumerate(valence_list):
-
-		df = session_df[session_df['valence'] == valence]
-
-		# valence-specific session lick/blink data
-		lick_data_raster = df['lick_raster'].tolist()
-		blink_data_raster = df['blink_raster'].tolist()
-		# pupil_data = df['eye_pupil'].tolist()
-
-		# single bin lick data (-<WINDOW_THRESHOLD>ms from trace interval end)
-
-		for t_index, trial in enumerate(lick_data_raster):
-		
-			trace_off_time = df['Trace End'].iloc[t_index]
-			# Lick/Blink Probability
-			## counts if there was any lick in the specified time window
-			lick_data_window = df['lick_count_window'].iloc[t_index]
-			if 1 in lick_data_window:
-				lick_data_probability[df_index].append(1)
-			else:
-				lick_data_probability[df_index].append(0)
-
-			## counts if there was any blink in the specified time window
-			blink_data_window = df['blink_count_window'].iloc[t_index]
-			if 1 in blink_data_window:
-				blink_data_probability[df_index].append(1)
-			else:
-				blink_data_probability[df_index].append(0)
-
-			# Lick/Blink Duration
-			lick_raw = df['lick'].iloc[t_index]
-			lick_data_voltage = lick_raw[trace_off_time-WINDOW_THRESHOLD_LICK:trace_off_time]
-			lick_data_voltage_mean = np.mean(lick_data_voltage)
-			lick_data_duration[df_index].append(lick_data_voltage_mean)
-
-			blink_raw = df['blink_duration_offscreen'].iloc[t_index]
-			blink_data_duration[df_index].append(blink_raw)
+	valence_groups = session_df.groupby('valence', sort=False)
+	for df_index, valence in enumerate(sorted(session_df['valence'].unique(), reverse=True)):
+		df = valence_groups.get_group(valence)
+		lick_data_probability[df_index] = df['lick_any'].tolist()
+		blink_data_probability[df_index] = df['blink_any'].tolist()
+		lick_data_duration[df_index] = [np.mean(lick_raw[trace_off_time-WINDOW_THRESHOLD_LICK:trace_off_time])
+																		for lick_raw, trace_off_time in zip(df['lick'], df['Trace End'])]
+		blink_data_duration[df_index] = df['blink_duration_offscreen'].tolist()
 	
 	return lick_data_probability, blink_data_probability, lick_data_duration, blink_data_duration
 
@@ -81,7 +54,9 @@ def two_sample_test(data_type, data_raster, condition, session_obj, direction='f
 
 	verbose = False
 	valence_combinations = list(combinations(range(num_valences), 2))
-	prob_combinations = list(combinations(data_raster.values(), 2))
+	data_list = [np.asarray(data, dtype=float) for data in data_raster.values()]
+	# moving Welch t-test of every window for every valence pair at once
+	pairs, t_moving, p_moving, ma_moving = moving_welch(data_list, window_width)
 	for f_index, valence in enumerate(valence_combinations):
 		if valence == (0, 1):
 			ax = axarr[0][0]
@@ -96,9 +71,11 @@ def two_sample_test(data_type, data_raster, condition, session_obj, direction='f
 		if valence == (2, 3):
 			ax = axarr[1][2]
 		valence_1, valence_2 = LABELS[valence[0]], LABELS[valence[1]]
-		a = prob_combinations[f_index][0]
-		d = prob_combinations[f_index][1]
-		t_all, p_all = ttest_ind(a, d, equal_var=False)
+		a = data_list[valence[0]]
+		d = data_list[valence[1]]
+		p_window = p_moving[pairs.index(valence)]
+		t_all, p_all = welch_test(np.mean(a), np.var(a, ddof=1), len(a),
+															np.mean(d), np.var(d, ddof=1), len(d))
 		ma_vec_a = moving_avg(a, window_width)
 		mv_vec_a = moving_var(a, window_width)
 		ma_vec_d = moving_avg(d, window_width)
@@ -113,12 +90,10 @@ def two_sample_test(data_type, data_raster, condition, session_obj, direction='f
 			pass
 		if direction == 'forwards':
 			for window in range(window_width, min_len):
-				a_windowback = a[window-window_width:window]
-				d_windowback = d[window-window_width:window]
-				t, p = ttest_ind(a_windowback, 
-												d_windowback,
-												equal_var=False)
-				star_pos = max(np.mean(a_windowback),np.mean(d_windowback))+0.05
+				# window of trials [window-window_width, window)
+				p = p_window[window-window_width]
+				star_pos = max(ma_moving[valence[0]][window-window_width],
+											 ma_moving[valence[1]][window-window_width])+0.05
 				if p < 0.001 and three_star_flag:
 					ax.text(window-window_width, star_pos, s='***', ha='center')
 					p_str = "{:.2e}".format(p)